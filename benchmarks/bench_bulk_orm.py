@@ -0,0 +1,93 @@
+"""Compare the bulk helpers of the models with adding and reading the rows one by one, on SQLite.
+
+Usage: python benchmarks/bench_bulk_orm.py (with spatz installed, e.g. ``pip install -e .``)
+"""
+import os
+import tempfile
+import time
+
+from sqlalchemy import Column, Integer, String
+
+from spatz import Spatz, Model
+
+
+class Reading(Model):
+    __tablename__ = "bench_readings"
+    id = Column(Integer, primary_key=True)
+    sensor = Column(String(20))
+    value = Column(Integer)
+
+
+def rows(count, offset=0):
+    return [{"id": offset + i, "sensor": f"sensor-{i % 10}", "value": i} for i in range(1, count + 1)]
+
+
+def timed(name, count, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<36} {elapsed * 1000:>10.1f}ms {count / elapsed:>12.0f} rows/s")
+
+
+def main(count=20000):
+    with tempfile.TemporaryDirectory() as directory:
+        app = Spatz()
+        app.config["DATABASE_URI"] = f"sqlite:///{os.path.join(directory, 'bench.sqlite')}"
+        app.db.init_db()
+        session = app.db.session()
+
+        def per_row_flush():
+            for row in rows(count):
+                session.add(Reading(**row))
+                session.flush()
+            session.commit()
+
+        def add_all():
+            session.add_all(Reading(**row) for row in rows(count, count))
+            session.commit()
+
+        def bulk_insert():
+            Reading.bulk_insert(rows(count, 2 * count))
+            session.commit()
+
+        def bulk_upsert():
+            Reading.bulk_upsert(rows(count, 2 * count), chunk_size=200)
+            session.commit()
+
+        def query_all():
+            sum(reading.value for reading in session.query(Reading).all())
+
+        def iter_all():
+            sum(reading.value for reading in Reading.iter_all(batch_size=1000))
+
+        def offset_pages():
+            offset = 0
+            while True:
+                page = session.query(Reading).order_by(Reading.id).offset(offset).limit(500).all()
+                if not page:
+                    return
+                offset += len(page)
+
+        def keyset_pages():
+            page = Reading.keyset_page(limit=500)
+            while page.next_key is not None:
+                page = Reading.keyset_page(after=page.next_key, limit=500)
+
+        timed("insert: add and flush per row", count, per_row_flush)
+        timed("insert: add_all", count, add_all)
+        timed("insert: Model.bulk_insert", count, bulk_insert)
+        timed("upsert: Model.bulk_upsert", count, bulk_upsert)
+        session.expunge_all()
+        timed("read: query.all", 3 * count, query_all)
+        session.expunge_all()
+        timed("read: Model.iter_all", 3 * count, iter_all)
+        session.expunge_all()
+        timed("pages: offset", 3 * count, offset_pages)
+        session.expunge_all()
+        timed("pages: Model.keyset_page", 3 * count, keyset_pages)
+        app.db.session.remove()
+        app.db.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""The hot path benchmarks of ``spatz.benchmark`` for pytest-benchmark.
+
+Usage: pytest benchmarks/bench_hot_paths.py --benchmark-json=results.json
+(with ``pip install -e .[bench]``), compare runs with
+``--benchmark-compare`` and ``--benchmark-compare-fail=min:10%``.
+"""
+import pytest
+
+from spatz.benchmark import BENCHMARKS
+
+pytest.importorskip("pytest_benchmark")
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+@pytest.mark.parametrize("name", list(BENCHMARKS))
+def test_hot_path(benchmark, name):
+    app, environ = BENCHMARKS[name]()
+
+    def call():
+        body = app(dict(environ), _start_response)
+        for _ in body:
+            pass
+        body.close()
+
+    benchmark(call)
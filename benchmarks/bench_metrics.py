@@ -0,0 +1,46 @@
+"""Measure the per-request overhead of the metrics, in memory and in memory mapped files.
+
+Usage: python benchmarks/bench_metrics.py (with spatz installed, e.g. ``pip install -e .``)
+"""
+import tempfile
+import timeit
+
+from werkzeug.test import EnvironBuilder
+
+from spatz import Spatz
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def bench(metrics_dir=None, enabled=True, number=5000):
+    app = Spatz()
+    if enabled:
+        app.config["METRICS_DIR"] = metrics_dir
+        app.metrics.init_metrics()
+
+    @app.route("/")
+    def index(req, resp):
+        resp.json = {"status": "ok"}
+
+    environ = EnvironBuilder(path="/").get_environ()
+
+    def call():
+        b"".join(app.wsgi_app(dict(environ), start_response))
+
+    call()
+    return min(timeit.repeat(call, number=number, repeat=5)) / number
+
+
+def main():
+    baseline = bench(enabled=False)
+    print(f"{'no metrics':<20} {baseline * 1e6:>8.2f}us per request")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, metrics_dir in (("in memory", None), ("mmap files", directory)):
+            elapsed = bench(metrics_dir)
+            print(f"{name:<20} {elapsed * 1e6:>8.2f}us per request (+{(elapsed - baseline) * 1e6:.2f}us)")
+
+
+if __name__ == "__main__":
+    main()
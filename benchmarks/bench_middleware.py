@@ -0,0 +1,52 @@
+"""Measure the per-request overhead against the middleware depth.
+
+Usage: python benchmarks/bench_middleware.py (with spatz installed, e.g. ``pip install -e .``)
+"""
+import timeit
+
+from werkzeug.test import EnvironBuilder
+
+from spatz import Spatz, Middleware
+
+
+class CountingMiddleware(Middleware):
+    def process_request(self, req):
+        pass
+
+    def process_response(self, req, res):
+        pass
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def bench(depth, number=5000):
+    app = Spatz()
+
+    @app.route("/")
+    def index(req, resp):
+        resp.text = "ok"
+
+    for _ in range(depth):
+        app.add_middleware(CountingMiddleware)
+
+    environ = EnvironBuilder(path="/").get_environ()
+
+    def call():
+        b"".join(app.wsgi_app(dict(environ), start_response))
+
+    call()
+    return min(timeit.repeat(call, number=number, repeat=5)) / number
+
+
+def main():
+    baseline = bench(0)
+    print(f"{'depth':>5} {'per request':>12} {'overhead':>10}")
+    for depth in (0, 1, 2, 5, 10, 15, 20):
+        elapsed = bench(depth)
+        print(f"{depth:>5} {elapsed * 1e6:>10.2f}us {(elapsed - baseline) * 1e6:>8.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Compare the compiled dispatcher with per-request werkzeug map binding.
+
+Usage: python benchmarks/bench_routing.py (with spatz installed, e.g. ``pip install -e .``)
+"""
+import timeit
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from spatz import Spatz
+
+
+def make_app(dispatcher, count):
+    app = Spatz(dispatcher=dispatcher)
+
+    def handler(req, resp, **kwargs):
+        resp.text = "ok"
+
+    for i in range(count):
+        app.add_route(f"/static/page{i}", handler, endpoint=f"static{i}")
+        app.add_route(f"/items{i}/<int:item_id>", handler, endpoint=f"item{i}")
+
+    return app
+
+
+def bench(dispatcher, count, path, number=2000):
+    app = make_app(dispatcher, count)
+    request = Request(EnvironBuilder(path=path).get_environ())
+    app.dispatcher.match(request)
+
+    return timeit.timeit(lambda: app.dispatcher.match(request), number=number) / number
+
+
+def main():
+    print(f"{'routes':>7} {'path':<10} {'werkzeug':>12} {'compiled':>12} {'speedup':>8}")
+    for count in (10, 100, 1000):
+        for kind, path in (
+            ("static", f"/static/page{count - 1}"),
+            ("param", f"/items{count - 1}/42"),
+        ):
+            baseline = bench("werkzeug", count, path)
+            compiled = bench("compiled", count, path)
+            print(
+                f"{count * 2:>7} {kind:<10} {baseline * 1e6:>10.2f}us "
+                f"{compiled * 1e6:>10.2f}us {baseline / compiled:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Compare session-free requests with the previous always-save session middleware.
+
+Usage: python benchmarks/bench_session.py (with spatz installed, e.g. ``pip install -e .``)
+"""
+import timeit
+from datetime import datetime
+
+from werkzeug.test import EnvironBuilder
+
+from spatz import Spatz, ClientSession, SessionMiddleware
+
+
+class EagerSessionMiddleware(SessionMiddleware):
+    """The previous behaviour: load, save and send the cookie on every request."""
+
+    def process_request(self, req):
+        super().process_request(req)
+        req.session.session
+
+    def process_response(self, req, res):
+        config = self.app.config
+        req.session.save()
+        res.set_cookie(
+            config["SESSION_COOKIE_NAME"],
+            req.session.session_key,
+            expires=datetime.utcnow() + config["PERMANENT_SESSION_LIFETIME"],
+            domain=config["SESSION_COOKIE_DOMAIN"],
+            path=config["SESSION_COOKIE_PATH"],
+            secure=config["SESSION_COOKIE_SECURE"],
+            httponly=config["SESSION_COOKIE_HTTPONLY"],
+        )
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def bench(middleware_cls, number=5000):
+    app = Spatz()
+    if middleware_cls is not None:
+        app.add_middleware(middleware_cls)
+
+    @app.route("/")
+    def index(req, resp):
+        resp.text = "no session here"
+
+    session = ClientSession()
+    session.update({"user_id": 42, "roles": ["admin", "editor"], "theme": "dark"})
+    session.save()
+    environ = EnvironBuilder(
+        path="/", headers={"Cookie": f"session={session.session_key}"}
+    ).get_environ()
+
+    def call():
+        b"".join(app.wsgi_app(dict(environ), start_response))
+
+    call()
+    return min(timeit.repeat(call, number=number, repeat=5)) / number
+
+
+def main():
+    for name, middleware_cls in (
+        ("no session middleware", None),
+        ("eager session (before)", EagerSessionMiddleware),
+        ("lazy session (after)", SessionMiddleware),
+    ):
+        print(f"{name:<24} {bench(middleware_cls) * 1e6:>8.2f}us per request")
+
+
+if __name__ == "__main__":
+    main()
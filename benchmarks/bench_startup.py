@@ -0,0 +1,51 @@
+"""Time the registration of 10k routes at startup.
+
+Usage: python benchmarks/bench_startup.py (with spatz installed, e.g. ``pip install -e .``)
+"""
+import time
+
+from spatz import Spatz
+
+COUNT = 10000
+
+
+def handler(req, resp, **kwargs):
+    resp.text = "ok"
+
+
+def routes():
+    for i in range(COUNT):
+        if i % 2:
+            yield (f"/api/resource{i}/<int:item_id>", handler, f"endpoint{i}")
+        else:
+            yield (f"/api/resource{i}", handler, f"endpoint{i}")
+
+
+def one_by_one():
+    app = Spatz()
+    for rule, handler, endpoint in routes():
+        app.add_route(rule, handler, endpoint=endpoint)
+    return app
+
+
+def bulk():
+    app = Spatz()
+    app.add_routes(routes())
+    return app
+
+
+def main():
+    for name, setup in (("add_route", one_by_one), ("add_routes", bulk)):
+        start = time.perf_counter()
+        app = setup()
+        registered = time.perf_counter()
+        app.dispatcher
+        compiled = time.perf_counter()
+        print(
+            f"{name:<11} {COUNT} routes: register {registered - start:.3f}s, "
+            f"compile dispatcher {compiled - registered:.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -11,19 +11,26 @@ NAME = "spatz"
 DESCRIPTION = "WSGI Framework built for learning purposes."
 EMAIL = "afai97202013@gmail.com"
 AUTHOR = "CHI-HUI CHOU"
-REQUIRES_PYTHON = ">=3.6.0"
+REQUIRES_PYTHON = ">=3.7.0"
 VERSION = "0.1.2"
 
 # Which packages are required for this module to be executed?
 REQUIRED = [
     "Jinja2==2.10.3",
-    "parse==1.12.1",
     "requests==2.22.0",
     "requests-wsgi-adapter==0.4.1",
     "WebOb==1.8.5",
     "whitenoise==4.1.4",
 ]
 
+# What packages are optional?
+EXTRAS = {
+    "orjson": ["orjson"],
+    "ujson": ["ujson"],
+    "brotli": ["brotli"],
+    "bench": ["pytest-benchmark"],
+}
+
 # The rest you shouldn't have to touch too much :)
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -58,10 +65,17 @@ setup(
     python_requires=REQUIRES_PYTHON,
     packages=find_packages(exclude=["test_*", "wsgi_demo"]),
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
+    entry_points={
+        "console_scripts": [
+            "spatz=spatz.cli:main",
+            "spatz-bench=spatz.benchmark:main",
+        ]
+    },
     include_package_data=True,
     license="MIT",
     classifiers=[
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.7",
     ],
     setup_requires=["wheel"],
 )
\ No newline at end of file
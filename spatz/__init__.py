@@ -1,5 +1,28 @@
 from .spatz import Spatz
 from .middleware import Middleware, SessionMiddleware
 from .response import Response
-from .database import Model
-from .session import SessionBase, ClientSession
+from .session import SessionBase, ClientSession, LocMemSession, FileSession
+from .cache import CacheMiddleware, LocMemCache, FileCache
+from .compression import CompressionMiddleware
+
+# exported on first use, importing them imports SQLAlchemy
+_LAZY_EXPORTS = {
+    "Model": ".database",
+    "SQLSession": ".database",
+}
+
+
+def __getattr__(name):
+    module = _LAZY_EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from importlib import import_module
+
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_EXPORTS))
@@ -0,0 +1,264 @@
+import asyncio
+import contextvars
+import functools
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from .context import current_request
+from .request import Request
+
+
+class ASGIHandler:
+    """Serve a Spatz application over ASGI.
+
+    Coroutine handlers and middleware methods are awaited on the event loop,
+    synchronous handlers run on a thread pool. Applications without any
+    coroutine run the whole WSGI pipeline on the thread pool, so they behave
+    exactly as under a WSGI server.
+
+    Point the ASGI server to the ``asgi`` attribute of the application, e.g.
+    ``uvicorn app:app.asgi``.
+    """
+
+    # request bodies larger than this are spooled to a temporary file
+    body_memory_size = 1024 * 1024
+
+    def __init__(self, app):
+        self.app = app
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.app.config["ASGI_THREAD_POOL_SIZE"],
+                thread_name_prefix="spatz-asgi",
+            )
+        return self._executor
+
+    def run_sync(self, func, *args, **kwargs):
+        """Run a synchronous callable on the thread pool and return a future to await."""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return loop.run_in_executor(
+            self.executor, functools.partial(context.run, func, *args, **kwargs)
+        )
+
+    def shutdown(self):
+        self.app.background.shutdown()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise RuntimeError(f"Unsupported ASGI scope type: {scope['type']}")
+
+        try:
+            body = await self.read_body(receive, scope)
+        except RequestEntityTooLarge as e:
+            environ = self.get_environ(scope, tempfile.SpooledTemporaryFile())
+            await self.send_response(e, environ, send)
+            return
+
+        with body:
+            environ = self.get_environ(scope, body)
+            if not self.app.is_async or environ["PATH_INFO"].startswith("/static/"):
+                await self.send_wsgi(environ, send)
+                return
+
+            request = Request.from_app(environ, self.app)
+            middleware = self.app.middleware
+            # the request stays the current one while a streamed body is sent
+            token = current_request.set(request)
+            try:
+                if self.app.timing.enabled:
+                    response = await self.app.timing.handle_request_async(
+                        middleware.handle_request_async, request
+                    )
+                else:
+                    response = await middleware.handle_request_async(request)
+                self.app.background.schedule(response)
+                await self.send_response(response, environ, send)
+            finally:
+                current_request.reset(token)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def read_body(self, receive, scope):
+        """Read the request body, spooled to a temporary file past ``body_memory_size``.
+
+        :raises werkzeug.exceptions.RequestEntityTooLarge: if the body is larger than ``MAX_CONTENT_LENGTH``,
+            before reading it when the request has a Content-Length
+        """
+        max_length = self.app.config["MAX_CONTENT_LENGTH"]
+        if max_length is not None:
+            for name, value in scope.get("headers", []):
+                if name.lower() == b"content-length" and value.isdigit() and int(value) > max_length:
+                    raise RequestEntityTooLarge()
+
+        body = tempfile.SpooledTemporaryFile(max_size=self.body_memory_size)
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if max_length is not None and size > max_length:
+                body.close()
+                raise RequestEntityTooLarge()
+            body.write(chunk)
+            more_body = message.get("more_body", False)
+        body.seek(0)
+        return body
+
+    def get_environ(self, scope, body):
+        """Build a WSGI environ from the ASGI connection scope."""
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.input_terminated": True,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                name = f"HTTP_{name}"
+            if name in environ:
+                value = f"{environ[name]},{value}"
+            environ[name] = value
+        return environ
+
+    async def send_wsgi(self, environ, send):
+        """Run the whole WSGI application on the thread pool and send its response."""
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = status
+            started["headers"] = headers
+
+        body = await self.run_sync(self.app, environ, start_response)
+        await self.send_body(body, started, send, threaded=True)
+
+    async def send_response(self, response, environ, send):
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = status
+            started["headers"] = headers
+
+        body = response(environ, start_response)
+        threaded = getattr(response, "is_streamed", False)
+        # closing queues the background tasks, which may wait for room in the queue
+        blocking_close = threaded or bool(getattr(response, "background_tasks", None))
+        async_stream = getattr(response, "async_stream", None)
+        if async_stream is None:
+            await self.send_body(body, started, send, threaded, blocking_close)
+            return
+
+        try:
+            await self.send_body(_encode_async(async_stream, response.charset), started, send)
+        finally:
+            # closed once sent, the background tasks of the response run then
+            await self.close_body(body, blocking_close)
+
+    async def send_body(self, body, started, send, threaded=False, blocking_close=None):
+        """Send the chunks of a WSGI body, or of an async iterator.
+
+        Streamed bodies are iterated on the thread pool so that a slow
+        generator does not block the event loop. Their body is closed there
+        too, as is the one of any response with ``blocking_close``.
+        """
+        if hasattr(body, "__aiter__"):
+            chunks = body.__aiter__()
+
+            async def next_chunk():
+                try:
+                    return await chunks.__anext__()
+                except StopAsyncIteration:
+                    return _END
+
+        elif threaded:
+            chunks = iter(body)
+
+            def next_chunk():
+                return self.run_sync(next, chunks, _END)
+
+        else:
+            chunks = iter(body)
+
+            async def next_chunk():
+                return next(chunks, _END)
+
+        try:
+            chunk = await next_chunk()
+            await self.send_start(started["status"], started["headers"], send)
+
+            while chunk is not _END:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await next_chunk()
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await self.close_body(body, threaded if blocking_close is None else blocking_close)
+
+    async def close_body(self, body, threaded=False):
+        if hasattr(body, "aclose"):
+            await body.aclose()
+        elif hasattr(body, "close"):
+            if threaded:
+                await self.run_sync(body.close)
+            else:
+                body.close()
+
+    async def send_start(self, status, headers, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            }
+        )
+
+
+_END = object()
+
+
+async def _encode_async(iterator, charset):
+    async for chunk in iterator:
+        yield chunk.encode(charset) if isinstance(chunk, str) else chunk
@@ -0,0 +1,125 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+logger = logging.getLogger("spatz.background")
+
+
+class BackgroundTasks:
+    """Run the work deferred by the handlers once their response is sent.
+
+    ``resp.background(func, *args, **kwargs)`` adds a task to the response,
+    it is queued when the server closes the body, after the last chunk was
+    sent, and run by a pool of ``BACKGROUND_WORKERS`` threads, or processes
+    with ``BACKGROUND_EXECUTOR = "process"``.
+
+    At most ``BACKGROUND_QUEUE_SIZE`` tasks wait or run at once. When the
+    queue is full, the thread which sent the response waits for room, which
+    slows down the requests of that thread, for ``BACKGROUND_QUEUE_TIMEOUT``
+    seconds at most, after which it runs the task itself. With a timeout of
+    None, it waits for as long as it takes. The ASGI handler queues the tasks
+    from its thread pool, so the event loop never waits.
+
+    In threads, a task using ``app.db.session`` gets its own session, which
+    is removed once the task is done. In processes, the functions and their
+    arguments must be picklable, and the tasks do not share the application.
+
+    ``shutdown()`` waits for the queued tasks, call it when the server stops.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.pending = 0
+        self._pid = None
+        self._executor = None
+        self._slots = None
+
+    @property
+    def executor(self):
+        """The pool running the tasks, created on first use in each process."""
+        pid = os.getpid()
+        if pid != self._pid:
+            with self.lock:
+                if pid != self._pid:
+                    config = self.app.config
+                    if config["BACKGROUND_EXECUTOR"] == "process":
+                        self._executor = ProcessPoolExecutor(config["BACKGROUND_WORKERS"])
+                    else:
+                        self._executor = ThreadPoolExecutor(
+                            config["BACKGROUND_WORKERS"], thread_name_prefix="spatz-background"
+                        )
+                    self._slots = threading.BoundedSemaphore(config["BACKGROUND_QUEUE_SIZE"])
+                    self.pending = 0
+                    self._pid = pid
+        return self._executor
+
+    def schedule(self, response):
+        """Queue the background tasks of a response once its body is closed."""
+        tasks = getattr(response, "background_tasks", None)
+        if tasks:
+            response.call_on_close(partial(self.submit_all, tasks))
+
+    def submit_all(self, tasks):
+        for func, args, kwargs in tasks:
+            self.submit(func, *args, **kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a task, waiting for room when the queue is full.
+
+        :return: the future of the task, or None if it ran in this thread
+        :rtype: concurrent.futures.Future
+        """
+        executor, slots = self.executor, self._slots
+        queued = time.perf_counter()
+        timeout = self.app.config["BACKGROUND_QUEUE_TIMEOUT"]
+        if not slots.acquire(timeout=timeout):
+            logger.warning("The background queue is full, running %r in the request thread", func)
+            try:
+                self.run(func, args, kwargs)
+            except Exception:
+                logger.exception("Background task %r failed", func)
+                self.app.metrics.observe_background(time.perf_counter() - queued, "failed")
+            else:
+                self.app.metrics.observe_background(time.perf_counter() - queued, "done")
+            return None
+
+        with self.lock:
+            self.pending += 1
+        self.app.metrics.inc_background_queued(1)
+        if isinstance(executor, ProcessPoolExecutor):
+            future = executor.submit(func, *args, **kwargs)
+        else:
+            future = executor.submit(self.run, func, args, kwargs)
+        future.add_done_callback(partial(self._done, func, queued, slots))
+        return future
+
+    def run(self, func, args, kwargs):
+        """Run a task in this thread, with its own database session."""
+        try:
+            return func(*args, **kwargs)
+        finally:
+            session = getattr(self.app._db, "session", None)
+            if session is not None and session.registry.has():
+                session.remove()
+
+    def _done(self, func, queued, slots, future):
+        latency = time.perf_counter() - queued
+        slots.release()
+        with self.lock:
+            self.pending -= 1
+        exc = future.exception()
+        if exc is not None:
+            logger.error("Background task %r failed", func, exc_info=exc)
+        self.app.metrics.inc_background_queued(-1)
+        self.app.metrics.observe_background(latency, "done" if exc is None else "failed")
+
+    def shutdown(self, wait=True):
+        """Stop the pool, by default once the queued tasks are done."""
+        with self.lock:
+            executor, self._executor, self._pid = self._executor, None, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
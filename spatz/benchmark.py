@@ -0,0 +1,288 @@
+"""Micro-benchmarks of the request hot paths.
+
+Each benchmark builds an application and a synthetic WSGI environ, then
+times ``Spatz.__call__`` on it. Run them with the ``spatz-bench`` command::
+
+    spatz-bench --output results.json
+    spatz-bench --compare results.json --threshold 0.1
+
+The second command exits with status 1 when a benchmark is more than 10%
+slower than in ``results.json``.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+from jinja2 import DictLoader, Environment
+from werkzeug.test import EnvironBuilder
+
+from .spatz import Spatz
+from .middleware import Middleware, SessionMiddleware
+from .session import ClientSession
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a function returning an application and the environ to time."""
+
+    def wrapper(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return wrapper
+
+
+class NoopMiddleware(Middleware):
+    def process_request(self, req):
+        pass
+
+    def process_response(self, req, res):
+        pass
+
+
+def _app_with_text_route():
+    app = Spatz()
+
+    @app.route("/")
+    def index(req, resp):
+        resp.text = "ok"
+
+    return app
+
+
+@benchmark("routing.static")
+def bench_static_route():
+    app = Spatz()
+
+    def handler(req, resp):
+        resp.text = "ok"
+
+    for i in range(100):
+        app.add_route(f"/pages/page{i}", handler, endpoint=f"page{i}")
+    return app, EnvironBuilder(path="/pages/page99").get_environ()
+
+
+@benchmark("routing.parameterized")
+def bench_parameterized_route():
+    app = Spatz()
+
+    def handler(req, resp, item_id):
+        resp.text = "ok"
+
+    for i in range(100):
+        app.add_route(f"/items{i}/<int:item_id>", handler, endpoint=f"item{i}")
+    return app, EnvironBuilder(path="/items99/42").get_environ()
+
+
+@benchmark("routing.class_handler")
+def bench_class_handler():
+    app = Spatz()
+
+    @app.route("/books", methods=["GET", "POST"])
+    class Books:
+        def get(self, req, resp):
+            resp.text = "books"
+
+        def post(self, req, resp):
+            resp.text = "created"
+
+    return app, EnvironBuilder(path="/books").get_environ()
+
+
+def _bench_middleware_depth(depth):
+    def setup():
+        app = _app_with_text_route()
+        for _ in range(depth):
+            app.add_middleware(NoopMiddleware)
+        return app, EnvironBuilder(path="/").get_environ()
+
+    return setup
+
+
+for _depth in (0, 5, 20):
+    benchmark(f"middleware.depth_{_depth}")(_bench_middleware_depth(_depth))
+
+
+@benchmark("session.off")
+def bench_session_off():
+    return _app_with_text_route(), EnvironBuilder(path="/").get_environ()
+
+
+@benchmark("session.unused")
+def bench_session_unused():
+    app = _app_with_text_route()
+    app.add_middleware(SessionMiddleware)
+    return app, _session_environ()
+
+
+@benchmark("session.read")
+def bench_session_read():
+    app = Spatz()
+    app.add_middleware(SessionMiddleware)
+
+    @app.route("/")
+    def index(req, resp):
+        resp.text = str(req.session.get("user_id"))
+
+    return app, _session_environ()
+
+
+def _session_environ():
+    session = ClientSession()
+    session.update({"user_id": 42, "roles": ["admin", "editor"]})
+    session.save()
+    return EnvironBuilder(path="/", headers={"Cookie": f"session={session.session_key}"}).get_environ()
+
+
+def _bench_json(size):
+    def setup():
+        app = Spatz()
+        data = [{"id": i, "name": f"item {i}", "price": i * 1.5, "tags": ["a", "b"]} for i in range(size)]
+
+        @app.route("/")
+        def index(req, resp):
+            resp.json = data
+
+        return app, EnvironBuilder(path="/").get_environ()
+
+    return setup
+
+
+for _size in (1, 100, 1000):
+    benchmark(f"json.items_{_size}")(_bench_json(_size))
+
+
+@benchmark("template.render")
+def bench_template():
+    app = Spatz()
+    app.templates_env = Environment(
+        loader=DictLoader(
+            {"page.html": "<ul>{% for item in items %}<li>{{ item.name }}: {{ item.price }}</li>{% endfor %}</ul>"}
+        )
+    )
+    items = [{"name": f"item {i}", "price": i} for i in range(100)]
+
+    @app.route("/")
+    def index(req, resp):
+        resp.html = app.render("page.html", {"items": items})
+
+    return app, EnvironBuilder(path="/").get_environ()
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def run_benchmark(app, environ, number=1000, repeat=5):
+    """Time ``number`` calls of the application, ``repeat`` times.
+
+    :return: the best, median and mean seconds per call, and the calls per second of the best run
+    :rtype: dict
+    """
+
+    def call():
+        body = app(dict(environ), _start_response)
+        for _ in body:
+            pass
+        if hasattr(body, "close"):
+            body.close()
+
+    call()
+    times = [elapsed / number for elapsed in timeit.repeat(call, number=number, repeat=repeat)]
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "ops": 1 / min(times),
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def run(names=None, number=1000, repeat=5, report=None):
+    """Run the benchmarks, all of them or those starting with one of ``names``.
+
+    :return: the results, with the versions of the run
+    :rtype: dict
+    """
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if names and not name.startswith(tuple(names)):
+            continue
+        app, environ = setup()
+        results[name] = run_benchmark(app, environ, number, repeat)
+        if report is not None:
+            report(name, results[name])
+
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "timestamp": time.time(),
+        "results": results,
+    }
+
+
+def compare(run_results, baseline, threshold=0.1):
+    """Returns the benchmarks more than ``threshold`` slower than in the baseline.
+
+    The best times are compared, they are the least sensitive to noise.
+
+    :return: tuples of the name, the baseline and current seconds per call, and their ratio
+    :rtype: list
+    """
+    regressions = []
+    for name, result in run_results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        ratio = result["min"] / before["min"]
+        if ratio > 1 + threshold:
+            regressions.append((name, before["min"], result["min"], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="spatz-bench", description="Benchmark the Spatz hot paths.")
+    parser.add_argument("names", nargs="*", help="run the benchmarks starting with these names")
+    parser.add_argument("-n", "--number", type=int, default=1000, help="calls per timing")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="timings per benchmark")
+    parser.add_argument("-o", "--output", help="save the results as JSON in this file")
+    parser.add_argument("-c", "--compare", help="compare with the JSON results of a previous run")
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=0.1, help="slowdown failing the comparison, defaults to 0.1"
+    )
+    parser.add_argument("-l", "--list", action="store_true", help="list the benchmarks")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print("\n".join(BENCHMARKS))
+        return 0
+
+    def report(name, result):
+        print(f"{name:<28} {result['min'] * 1e6:>12.2f}us {result['ops']:>12.0f} req/s")
+
+    results = run(args.names, args.number, args.repeat, report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after, ratio in regressions:
+            print(f"REGRESSION {name}: {before * 1e6:.2f}us -> {after * 1e6:.2f}us ({ratio:.2f}x)")
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+import time
+
+from .middleware import Middleware
+from .response import Response
+from .utils.store import LocMemStore, private_directory
+
+
+class CacheBase:
+    """Base class of the cache backends.
+
+    Values are pickled, so anything picklable can be cached.
+    """
+
+    @classmethod
+    def from_app(cls, app):
+        """Returns a cache configured from the application config."""
+        raise NotImplementedError("subclasses of CacheBase must provide a from_app() method")
+
+    def get(self, key, default=None):
+        """Returns the value cached under the key, or the default if it is missing or expired."""
+        raise NotImplementedError("subclasses of CacheBase must provide a get() method")
+
+    def set(self, key, value, timeout):
+        """Caches the value under the key for timeout seconds."""
+        raise NotImplementedError("subclasses of CacheBase must provide a set() method")
+
+    def delete(self, key):
+        """Removes the value cached under the key, if any."""
+        raise NotImplementedError("subclasses of CacheBase must provide a delete() method")
+
+    def clear(self):
+        """Removes all the cached values."""
+        raise NotImplementedError("subclasses of CacheBase must provide a clear() method")
+
+
+class LocMemCache(CacheBase):
+    """Cache in the memory of the process.
+
+    The least recently used values are evicted past ``max_entries`` values
+    or ``max_bytes`` of pickled data.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024):
+        self.store = LocMemStore(max_entries=max_entries, max_bytes=max_bytes)
+
+    @classmethod
+    def from_app(cls, app):
+        return cls(
+            max_entries=app.config["CACHE_MAX_ENTRIES"],
+            max_bytes=app.config["CACHE_MAX_BYTES"],
+        )
+
+    def get(self, key, default=None):
+        data = self.store.get(key)
+        if data is None:
+            return default
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout):
+        self.store.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), timeout)
+
+    def delete(self, key):
+        self.store.delete(key)
+
+    def clear(self):
+        self.store.clear()
+
+
+class FileCache(CacheBase):
+    """Cache in files, one per value, shared by the worker processes of the host.
+
+    Files are written atomically and start with their expiry time. Past
+    ``max_entries`` files, expired files and then the oldest ones are removed.
+
+    The directory is created readable by the current user only, and refused
+    when another user owns it or can write to it, since the values are
+    unpickled from its files.
+    """
+
+    _expires = struct.Struct("!d")
+
+    def __init__(self, directory=None, max_entries=1000, cull_interval=60):
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), "spatz_cache")
+        self.directory = private_directory(directory)
+        self.max_entries = max_entries
+        self.cull_interval = cull_interval
+        self.last_cull = time.monotonic()
+
+    @classmethod
+    def from_app(cls, app):
+        return cls(
+            directory=app.config["CACHE_DIR"],
+            max_entries=app.config["CACHE_MAX_ENTRIES"],
+        )
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                (expires,) = self._expires.unpack(f.read(self._expires.size))
+                if expires > time.time():
+                    return pickle.loads(f.read())
+        except (FileNotFoundError, struct.error, EOFError):
+            return default
+        self._unlink(path)
+        return default
+
+    def set(self, key, value, timeout):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._expires.pack(time.time() + timeout))
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            self._unlink(tmp_path)
+            raise
+        self._cull()
+
+    def delete(self, key):
+        self._unlink(self._path(key))
+
+    def clear(self):
+        for path in self._files():
+            self._unlink(path)
+
+    def _files(self):
+        with os.scandir(self.directory) as entries:
+            return [entry.path for entry in entries if not entry.name.startswith(".")]
+
+    def _cull(self):
+        now = time.monotonic()
+        if now - self.last_cull < self.cull_interval:
+            return
+        self.last_cull = now
+
+        files = []
+        for path in self._files():
+            try:
+                with open(path, "rb") as f:
+                    (expires,) = self._expires.unpack(f.read(self._expires.size))
+            except (FileNotFoundError, struct.error):
+                continue
+            if expires <= time.time():
+                self._unlink(path)
+            else:
+                files.append((expires, path))
+
+        files.sort()
+        for _, path in files[: max(0, len(files) - self.max_entries)]:
+            self._unlink(path)
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_cache_backend(name):
+    """Returns the cache class of a CACHE_BACKEND name.
+
+    :param name: "locmem" or "file"
+    :type name: str
+    """
+    return {"locmem": LocMemCache, "file": FileCache}[name]
+
+
+class CacheMiddleware(Middleware):
+    """Cache full responses of the routes added with a ``cache`` timeout.
+
+    Responses are cached by method, host, path, query string and the
+    request headers listed in ``CACHE_VARY_HEADERS``. Only successful GET and
+    HEAD responses are cached, and not when they set cookies, are streamed,
+    are marked ``private`` or ``no-store``, or vary on other request headers.
+    Requests with a session cookie or an Authorization header are
+    personalized, they bypass the cache.
+    The cache is available as ``app.cache``, e.g. to clear it.
+    """
+
+    def __init__(self, app):
+        super().__init__(app)
+        backend = app.config["CACHE_BACKEND"]
+        if backend is None:
+            backend = app.CacheInterface
+        else:
+            backend = get_cache_backend(backend)
+        self.cache = app.cache = backend.from_app(app)
+        self.vary_headers = app.config["CACHE_VARY_HEADERS"]
+        self.session_cookie = app.config["SESSION_COOKIE_NAME"]
+
+    def cache_key(self, req):
+        headers = "|".join(req.headers.get(name, "") for name in self.vary_headers)
+        return f"{req.method}:{req.host}{req.path}?{req.query_string.decode('latin-1')}|{headers}"
+
+    def process_request(self, req):
+        if req.method not in ("GET", "HEAD") or self.session_cookie in req.cookies:
+            return
+        if "Authorization" in req.headers:
+            return
+
+        key = self.cache_key(req)
+        cached = self.cache.get(key)
+        if cached is None:
+            req.cache_key = key
+            return
+
+        status, headers, body = cached
+        return Response(body, status=status, headers=headers)
+
+    def process_response(self, req, res):
+        key = getattr(req, "cache_key", None)
+        if key is None or not isinstance(res, Response) or res.status_code != 200:
+            return
+
+        timeout = self.app.endpoint_options.get(getattr(req, "endpoint", None), {}).get("cache")
+        if not timeout:
+            return
+
+        res.set_body_and_content_type()
+        if res.is_streamed or "Set-Cookie" in res.headers:
+            return
+        if res.cache_control.private or res.cache_control.no_store:
+            return
+        vary = {name.lower() for name in res.vary}
+        if vary - {name.lower() for name in self.vary_headers}:
+            return
+
+        self.cache.set(key, (res.status_code, list(res.headers), res.get_data()), timeout)
@@ -0,0 +1,58 @@
+"""The ``spatz`` command.
+
+Usage: spatz serve myproject.app:app --workers 4 --threads 8 --max-requests 10000
+"""
+import argparse
+import logging
+import os
+import sys
+
+from .server import PreforkServer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="spatz", description="Spatz command line tools.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    serve = commands.add_parser("serve", help="run the application with a preforking server")
+    serve.add_argument("app", help="the application, as module:attribute")
+    serve.add_argument("--host", default="127.0.0.1", help="defaults to 127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000, help="defaults to 8000, 0 picks a free port")
+    serve.add_argument("-w", "--workers", type=int, help="defaults to the number of CPUs")
+    serve.add_argument(
+        "-t", "--threads", type=int, default=1, help="requests served at once by a worker, defaults to 1"
+    )
+    serve.add_argument(
+        "--max-requests", type=int, default=0, help="requests after which a worker is replaced, 0 never"
+    )
+    serve.add_argument(
+        "--max-requests-jitter", type=int, default=0, help="random requests added to --max-requests per worker"
+    )
+    serve.add_argument(
+        "--graceful-timeout", type=float, default=30, help="seconds given to the workers to finish, defaults to 30"
+    )
+    serve.add_argument("--access-log", action="store_true", help="log the requests")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="[%(process)d] %(message)s")
+    # the application module is imported relative to the working directory
+    sys.path.insert(0, os.getcwd())
+
+    server = PreforkServer(
+        args.app,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        threads=args.threads,
+        max_requests=args.max_requests,
+        max_requests_jitter=args.max_requests_jitter,
+        graceful_timeout=args.graceful_timeout,
+        access_log=args.access_log,
+    )
+    server.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
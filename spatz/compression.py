@@ -0,0 +1,151 @@
+import zlib
+
+from .middleware import Middleware
+from .response import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CompressionMiddleware(Middleware):
+    """Compress the responses with brotli or gzip, as accepted by the client.
+
+    Brotli is used when it is installed (``pip install spatz[brotli]``).
+    Bodies smaller than ``COMPRESSION_MIN_SIZE`` bytes, already compressed
+    content types and responses with a Content-Encoding are sent as they are.
+    Streamed bodies are compressed chunk by chunk, each chunk being flushed
+    so that the client receives it without delay.
+    """
+
+    compressed_types = {
+        "application/gzip",
+        "application/octet-stream",
+        "application/pdf",
+        "application/zip",
+        "application/x-7z-compressed",
+        "application/x-bzip2",
+        "application/x-rar-compressed",
+        "font/woff",
+        "font/woff2",
+    }
+    compressed_type_prefixes = ("image/", "video/", "audio/")
+    uncompressed_types = {"image/svg+xml"}
+
+    def __init__(self, app):
+        super().__init__(app)
+        config = app.config
+        self.level = config["COMPRESSION_LEVEL"]
+        self.brotli_quality = config["COMPRESSION_BROTLI_QUALITY"]
+        self.min_size = config["COMPRESSION_MIN_SIZE"]
+        self.encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+    def is_compressible(self, mimetype):
+        if not mimetype or mimetype in self.compressed_types:
+            return False
+        if mimetype in self.uncompressed_types:
+            return True
+        return not mimetype.startswith(self.compressed_type_prefixes)
+
+    def process_response(self, req, res):
+        if not isinstance(res, Response):
+            return
+
+        res.set_body_and_content_type()
+        if res.status_code < 200 or res.status_code in (204, 206, 304):
+            return
+        if "Content-Encoding" in res.headers or not self.is_compressible(res.mimetype):
+            return
+
+        res.vary.add("Accept-Encoding")
+        encoding = req.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return
+
+        if res.is_streamed:
+            if res.async_stream is not None:
+                res.set_body(self._compress_async(res.async_stream, encoding, res.charset))
+            else:
+                res.response = self._compress_iter(res.response, encoding, res.charset)
+            res.headers.pop("Content-Length", None)
+        else:
+            data = res.get_data()
+            if len(data) < self.min_size:
+                return
+            compressed = self.compress(data, encoding)
+            if len(compressed) >= len(data):
+                return
+            res.set_data(compressed)
+
+        res.headers["Content-Encoding"] = encoding
+        etag = res.headers.get("ETag")
+        if etag is not None and not etag.startswith("W/"):
+            res.headers["ETag"] = "W/" + etag
+
+    def compress(self, data, encoding):
+        """Compress a whole body."""
+        compressor = self.compressor(encoding)
+        return compressor.compress(data) + compressor.finish()
+
+    def compressor(self, encoding):
+        if encoding == "br":
+            return _BrotliCompressor(self.brotli_quality)
+        return _GzipCompressor(self.level)
+
+    def _compress_iter(self, iterable, encoding, charset):
+        compressor = self.compressor(encoding)
+        try:
+            for chunk in iterable:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode(charset)
+                data = compressor.compress(chunk) + compressor.flush()
+                if data:
+                    yield data
+            yield compressor.finish()
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    async def _compress_async(self, iterator, encoding, charset):
+        compressor = self.compressor(encoding)
+        try:
+            async for chunk in iterator:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode(charset)
+                data = compressor.compress(chunk) + compressor.flush()
+                if data:
+                    yield data
+            yield compressor.finish()
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+
+class _GzipCompressor:
+    def __init__(self, level):
+        # 16 + MAX_WBITS writes a gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliCompressor:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
@@ -0,0 +1,69 @@
+"""The request being handled, for the helpers which are not given it.
+
+The request is kept in a context variable, so each thread of a threaded
+server, and each task of an ASGI server, sees its own request::
+
+    from spatz.context import request
+
+    def current_user():
+        return request.session.get("user_id")
+
+A streamed body is iterated by the server once the handler has returned,
+the request stays the current one until the body is closed.
+"""
+from contextvars import ContextVar
+
+from werkzeug.local import LocalProxy
+
+current_request = ContextVar("spatz_request", default=None)
+
+
+def get_request():
+    """Returns the request being handled.
+
+    :raises RuntimeError: outside of a request
+    """
+    req = current_request.get()
+    if req is None:
+        raise RuntimeError("Working outside of a request.")
+    return req
+
+
+def has_request():
+    """Whether a request is being handled in this context."""
+    return current_request.get() is not None
+
+
+request = LocalProxy(get_request)
+
+
+def stream_with_request(body, req):
+    """Wrap a WSGI body so that it is iterated and closed with ``req`` as the current request."""
+    return _RequestStream(body, req)
+
+
+class _RequestStream:
+    def __init__(self, body, req):
+        self.body = body
+        self.chunks = iter(body)
+        self.req = req
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = current_request.set(self.req)
+        try:
+            return next(self.chunks)
+        finally:
+            current_request.reset(token)
+
+    def close(self):
+        close = getattr(self.body, "close", None)
+        if close is None:
+            return
+        token = current_request.set(self.req)
+        try:
+            close()
+        finally:
+            current_request.reset(token)
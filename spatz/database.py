@@ -1,22 +1,245 @@
-from sqlalchemy import create_engine
+import logging
+import threading
+import time
+from collections import namedtuple
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import islice
+
+from sqlalchemy import create_engine, event, insert, select
+from sqlalchemy import Column, DateTime, LargeBinary, MetaData, String, Table
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from .context import current_request
 from .middleware import Middleware
+from .session import CreateError, ServerSession
+
+Page = namedtuple("Page", ["items", "next_key"])
+
+
+class BaseModel:
+    """The helpers of the models for large amounts of rows.
+
+    ``bulk_insert`` and ``bulk_upsert`` write rows given as dicts in chunks
+    of ``bulk_chunk_size``, with one statement per chunk instead of a flush
+    per object. ``iter_all`` streams the rows of a large result set and
+    ``keyset_page`` pages through the rows by their key, without ``OFFSET``.
+
+    A multi-row upsert binds a parameter per column of each row, its chunks
+    are made smaller on wide tables to stay under ``bulk_max_parameters``,
+    the lowest limit of SQLite (32766) and PostgreSQL (65535).
+
+    The helpers use the session of the request, or of the thread, unless a
+    session is given, and do not commit.
+    """
+
+    bulk_chunk_size = 1000
+    bulk_max_parameters = 32766
+
+    @classmethod
+    def _session(cls, session):
+        return cls.query.session if session is None else session
+
+    @classmethod
+    def _key_column(cls, column):
+        if column is not None:
+            return column
+        primary_key = cls.__mapper__.primary_key
+        if len(primary_key) != 1:
+            raise AssertionError("Pass the key column of a model with a composite primary key.")
+        return getattr(cls, cls.__mapper__.get_property_by_column(primary_key[0]).key)
+
+    @classmethod
+    def bulk_insert(cls, rows, chunk_size=None, session=None):
+        """Insert rows, each chunk with a single ``executemany``.
+
+        :param rows: the rows, as dicts of the column values
+        :type rows: iterable
+        :param chunk_size: the rows per statement, defaults to ``bulk_chunk_size``
+        :type chunk_size: int, optional
+        :return: the number of rows inserted
+        :rtype: int
+        """
+        session = cls._session(session)
+        statement = insert(cls.__table__)
+        count = 0
+        for chunk in _chunks(rows, chunk_size or cls.bulk_chunk_size):
+            session.execute(statement, chunk)
+            count += len(chunk)
+        return count
+
+    @classmethod
+    def bulk_upsert(cls, rows, index_elements=None, chunk_size=None, session=None):
+        """Insert rows, or update the existing rows with the same key.
+
+        Each chunk is a single multi-row ``INSERT ... VALUES`` with ``ON
+        CONFLICT DO UPDATE`` on SQLite and PostgreSQL, or ``ON DUPLICATE KEY
+        UPDATE`` on MySQL. The rows of a chunk must have the same columns.
+
+        :param rows: the rows, as dicts of the column values
+        :type rows: iterable
+        :param index_elements: the names of the unique columns, defaults to the primary key
+        :type index_elements: list, optional
+        :param chunk_size: the rows per statement, defaults to ``bulk_chunk_size``,
+            at most ``bulk_max_parameters`` divided by the number of columns
+        :type chunk_size: int, optional
+        :raises NotImplementedError: on the other databases
+        :return: the number of rows inserted or updated
+        :rtype: int
+        """
+        session = cls._session(session)
+        dialect = session.get_bind(mapper=cls.__mapper__).dialect.name
+        if index_elements is None:
+            index_elements = [column.name for column in cls.__mapper__.primary_key]
+
+        max_rows = max(1, cls.bulk_max_parameters // len(cls.__table__.columns))
+        count = 0
+        for chunk in _chunks(rows, min(chunk_size or cls.bulk_chunk_size, max_rows)):
+            updated = [name for name in chunk[0] if name not in index_elements]
+            if dialect in ("sqlite", "postgresql"):
+                if dialect == "sqlite":
+                    from sqlalchemy.dialects.sqlite import insert as dialect_insert
+                else:
+                    from sqlalchemy.dialects.postgresql import insert as dialect_insert
+
+                statement = dialect_insert(cls.__table__).values(chunk)
+                values = {name: statement.excluded[name] for name in updated}
+                if values:
+                    statement = statement.on_conflict_do_update(index_elements=index_elements, set_=values)
+                else:
+                    statement = statement.on_conflict_do_nothing(index_elements=index_elements)
+            elif dialect == "mysql":
+                from sqlalchemy.dialects.mysql import insert as dialect_insert
+
+                statement = dialect_insert(cls.__table__).values(chunk)
+                statement = statement.on_duplicate_key_update(
+                    {name: statement.inserted[name] for name in updated or index_elements}
+                )
+            else:
+                raise NotImplementedError(f"Upserts are not supported on {dialect}.")
+
+            session.execute(statement)
+            count += len(chunk)
+        return count
+
+    @classmethod
+    def iter_all(cls, query=None, batch_size=1000):
+        """Iterate over the rows of a query, fetched ``batch_size`` at a time.
+
+        :param query: the query, defaults to all the rows of the model by key
+        :type query: sqlalchemy.orm.Query, optional
+        """
+        if query is None:
+            query = cls.query.order_by(cls._key_column(None))
+        return query.yield_per(batch_size)
+
+    @classmethod
+    def keyset_page(cls, after=None, limit=100, column=None, query=None):
+        """Returns the rows following a key, ordered by the key.
+
+        The next page starts after the ``next_key`` of the page, which is
+        None on the last page::
+
+            page = Item.keyset_page(limit=100)
+            while page.next_key is not None:
+                page = Item.keyset_page(after=page.next_key, limit=100)
 
-Model = declarative_base()
+        :param after: the key of the last row of the previous page, defaults to None for the first page
+        :param limit: the rows per page, defaults to 100
+        :type limit: int, optional
+        :param column: the attribute of a unique column to page by, defaults to the primary key
+        :param query: the query to page through, defaults to all the rows of the model
+        :type query: sqlalchemy.orm.Query, optional
+        :rtype: Page
+        """
+        column = cls._key_column(column)
+        if query is None:
+            query = cls.query
+        if after is not None:
+            query = query.filter(column > after)
+
+        items = query.order_by(column).limit(limit + 1).all()
+        if len(items) <= limit:
+            return Page(items, None)
+        items = items[:limit]
+        return Page(items, getattr(items[-1], column.key))
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+Model = declarative_base(cls=BaseModel)
+
+logger = logging.getLogger("spatz.database")
+
+# the queries of the request being handled
+_request_queries = ContextVar("spatz_request_queries", default=None)
 
 
 class Database:
+    """The database of the application.
+
+    The engine pool is configured by ``DATABASE_POOL_SIZE``,
+    ``DATABASE_MAX_OVERFLOW``, ``DATABASE_POOL_TIMEOUT``,
+    ``DATABASE_POOL_RECYCLE`` and ``DATABASE_POOL_PRE_PING``, the options left
+    to None keep the SQLAlchemy defaults. ``pool_stats`` counts the
+    connections taken from the pool and the time spent waiting for them.
+
+    The queries of each request are counted and timed, and aggregated per
+    endpoint in ``query_stats``. In ``DEBUG``, they are sent in the
+    ``X-DB-Queries`` header. A warning is logged when a statement runs more
+    than ``DATABASE_REPEATED_QUERY_THRESHOLD`` times in a request, which is
+    usually a N+1 query.
+    """
+
+    pool_options = {
+        "DATABASE_POOL_SIZE": "pool_size",
+        "DATABASE_MAX_OVERFLOW": "max_overflow",
+        "DATABASE_POOL_TIMEOUT": "pool_timeout",
+        "DATABASE_POOL_RECYCLE": "pool_recycle",
+        "DATABASE_POOL_PRE_PING": "pool_pre_ping",
+    }
+
     def __init__(self, app):
         self.app = app
         self.Model = Model
+        self.pool_stats = None
+        self.query_stats = None
+
+    def engine_options(self):
+        """Returns the keyword arguments of ``create_engine`` set in the config."""
+        options = {}
+        for key, option in self.pool_options.items():
+            value = self.app.config.get(key)
+            if value is not None:
+                options[option] = value
+        return options
 
     def init_db(self):
-        """Initialize the database abstraction layer, creating the session, the database schema, the middleware."""
+        """Initialize the database abstraction layer, creating the session, the database schema, the middleware.
+
+        The session of a request is only created when the handler uses
+        ``req.db_session``, and it is removed after the response, or when the
+        handler raises. Each request has its own session, whichever threads
+        it runs in, and outside of the requests each thread has its own.
+        """
         database_uri = self.app.config.get("DATABASE_URI", "sqlite:///data.sqlite")
-        self.engine = create_engine(database_uri)
+        self.engine = create_engine(database_uri, **self.engine_options())
+        self.pool_stats = PoolStats(self.engine)
+        self.query_stats = QueryStats()
+        event.listen(self.engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(self.engine, "after_cursor_execute", _after_cursor_execute)
         self.session = scoped_session(
-            sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+            sessionmaker(autocommit=False, autoflush=False, bind=self.engine),
+            scopefunc=_session_scope,
         )
         self.Model.query = self.session.query_property()
         self.Model.metadata.create_all(bind=self.engine)
@@ -24,8 +247,350 @@ class Database:
         class DatabaseMiddleware(Middleware):
             def process_request(self, req):
                 req.db_session = self.app.db.session
+                req.db_queries = RequestQueries()
+                req.db_queries_token = _request_queries.set(req.db_queries)
 
             def process_response(self, req, res):
-                req.db_session.remove()
+                self.end_request(req, res)
+                # werkzeug HTTP exceptions have no headers
+                if self.app.config["DEBUG"] and hasattr(res, "headers"):
+                    res.headers["X-DB-Queries"] = req.db_queries.header()
+
+            def process_exception(self, req, exc):
+                self.end_request(req)
+
+            def end_request(self, req, res=None):
+                # ended once, even when an outer middleware turns the exception into a response
+                token, req.db_queries_token = req.db_queries_token, None
+                if token is None:
+                    return
+
+                _request_queries.reset(token)
+                self.app.db.record_queries(req, req.db_queries)
+
+                if getattr(res, "will_stream", False):
+                    # the body may still query, the session is removed once it is sent
+                    res.call_on_close(partial(self.remove_session, req))
+                else:
+                    self.remove_session(req)
+
+            def remove_session(self, req):
+                session = self.app.db.session.registry.registry.pop(req, None)
+                if session is not None:
+                    session.close()
 
         self.app.add_middleware(DatabaseMiddleware)
+
+    def record_queries(self, req, queries):
+        """Aggregate the queries of a request and warn about the repeated statements."""
+        endpoint = getattr(req, "endpoint", None)
+        self.query_stats.record(endpoint, queries)
+
+        threshold = self.app.config.get("DATABASE_REPEATED_QUERY_THRESHOLD")
+        if threshold is None:
+            return
+        for statement, count in queries.statements.items():
+            if count > threshold:
+                logger.warning(
+                    "Statement run %d times by %s %s (endpoint %s), possible N+1 query: %s",
+                    count,
+                    req.method,
+                    req.path,
+                    endpoint,
+                    statement,
+                )
+
+
+class PoolStats:
+    """Statistics of the connection pool of an engine.
+
+    ``checkouts`` and ``checkins`` count the connections taken from and given
+    back to the pool, ``connects`` the connections opened. ``wait_time`` and
+    ``max_wait`` are the total and the longest time in seconds spent getting
+    a connection from the pool, ``timeouts`` the times the pool was exhausted
+    for longer than its timeout.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.reset()
+
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        # dispose() replaces the pool, e.g. in the workers after a fork
+        event.listen(engine, "engine_disposed", self._on_dispose)
+        self._wrap_connect(engine.pool)
+
+    def reset(self):
+        with self.lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.timeouts = 0
+            self.wait_time = 0.0
+            self.max_wait = 0.0
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.checkins += 1
+
+    def _on_dispose(self, engine):
+        self._wrap_connect(engine.pool)
+
+    def _wrap_connect(self, pool):
+        # SQLAlchemy has no event for the start of a checkout, so the time
+        # spent waiting is measured around the connect method of the pool
+        connect = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return connect()
+            except PoolTimeoutError:
+                with self.lock:
+                    self.timeouts += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.wait_time += elapsed
+                    self.max_wait = max(self.max_wait, elapsed)
+
+        pool.connect = timed_connect
+
+    def as_dict(self):
+        """Returns the statistics and the pool status, e.g. for a metrics endpoint."""
+        with self.lock:
+            stats = {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "timeouts": self.timeouts,
+                "wait_time": self.wait_time,
+                "max_wait": self.max_wait,
+            }
+        pool = self.engine.pool
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            method = getattr(pool, name, None)
+            if callable(method):
+                stats[f"pool_{name}"] = method()
+        return stats
+
+
+class RequestQueries:
+    """The queries run while handling a request."""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.statements = {}
+
+    @property
+    def duplicates(self):
+        """The number of queries repeating a statement already run in the request."""
+        return self.count - len(self.statements)
+
+    def add(self, statement, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+
+    def header(self):
+        return f"count={self.count}, time={self.time * 1000:.2f}ms, duplicates={self.duplicates}"
+
+
+class QueryStats:
+    """The queries of the requests, aggregated per endpoint.
+
+    For each endpoint, ``as_dict()`` gives the number of requests, queries
+    and duplicate queries, the total SQL time in seconds and the most queries
+    run by a single request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, queries):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    "requests": 0,
+                    "queries": 0,
+                    "duplicates": 0,
+                    "time": 0.0,
+                    "max_queries": 0,
+                }
+            stats["requests"] += 1
+            stats["queries"] += queries.count
+            stats["duplicates"] += queries.duplicates
+            stats["time"] += queries.time
+            stats["max_queries"] = max(stats["max_queries"], queries.count)
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+    def as_dict(self):
+        with self.lock:
+            return {endpoint: dict(stats) for endpoint, stats in self.endpoints.items()}
+
+
+def _session_scope():
+    # a session per request, even when the middlewares and the handler of an
+    # ASGI request run in different threads, else a session per thread
+    req = current_request.get()
+    return threading.get_ident() if req is None else req
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _request_queries.get() is not None:
+        context._spatz_query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    queries = _request_queries.get()
+    start = getattr(context, "_spatz_query_start", None)
+    if queries is not None and start is not None:
+        queries.add(statement, time.perf_counter() - start)
+
+
+class SQLSession(ServerSession):
+    """Sessions stored in the ``SESSION_SQL_TABLE`` table of the application database.
+
+    The engine of ``app.db`` is reused, so ``app.db.init_db()`` must be called
+    before adding the session middleware. Sessions are saved with a single
+    upsert statement on SQLite, PostgreSQL and MySQL, and expired sessions are
+    deleted in batches of ``sweep_batch_size`` rows.
+    """
+
+    engine = None
+    table = None
+    sweep_batch_size = 1000
+
+    @classmethod
+    def settings(cls, app):
+        engine = getattr(app.db, "engine", None)
+        if engine is None:
+            raise RuntimeError("SQLSession needs the database, call app.db.init_db() first.")
+
+        table = Table(
+            app.config["SESSION_SQL_TABLE"],
+            MetaData(),
+            Column("session_key", String(64), primary_key=True),
+            Column("data", LargeBinary, nullable=False),
+            Column("expires", DateTime, nullable=False, index=True),
+        )
+        table.create(engine, checkfirst=True)
+
+        settings = super().settings(app)
+        settings.update(engine=engine, table=table)
+        return settings
+
+    def _fetch(self, session_key, touch=True):
+        table = self.table
+        now = datetime.utcnow()
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                table.select().where(table.c.session_key == session_key)
+            ).first()
+        if row is None or row.expires <= now:
+            return None
+
+        # push the expiry back once half of the lifetime is gone
+        if touch and row.expires - now < timedelta(seconds=self.lifetime / 2):
+            with self.engine.begin() as conn:
+                conn.execute(
+                    table.update()
+                    .where(table.c.session_key == session_key)
+                    .values(expires=now + timedelta(seconds=self.lifetime))
+                )
+        return row.data
+
+    def _store(self, session_key, data, must_create):
+        values = {
+            "session_key": session_key,
+            "data": data,
+            "expires": datetime.utcnow() + timedelta(seconds=self.lifetime),
+        }
+        if must_create:
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(self.table.insert().values(**values))
+            except IntegrityError:
+                raise CreateError(session_key)
+            return
+
+        upsert = self._upsert(values)
+        with self.engine.begin() as conn:
+            if upsert is not None:
+                conn.execute(upsert)
+                return
+
+            result = conn.execute(
+                self.table.update()
+                .where(self.table.c.session_key == session_key)
+                .values(data=data, expires=values["expires"])
+            )
+            if result.rowcount == 0:
+                conn.execute(self.table.insert().values(**values))
+
+    def _upsert(self, values):
+        """Returns the single statement upsert of the dialect, or None."""
+        dialect = self.engine.dialect.name
+        if dialect in ("sqlite", "postgresql"):
+            if dialect == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+
+            statement = insert(self.table).values(**values)
+            return statement.on_conflict_do_update(
+                index_elements=[self.table.c.session_key],
+                set_={
+                    "data": statement.excluded.data,
+                    "expires": statement.excluded.expires,
+                },
+            )
+        if dialect == "mysql":
+            from sqlalchemy.dialects.mysql import insert
+
+            statement = insert(self.table).values(**values)
+            return statement.on_duplicate_key_update(
+                data=statement.inserted.data, expires=statement.inserted.expires
+            )
+        return None
+
+    def _remove(self, session_key):
+        with self.engine.begin() as conn:
+            conn.execute(self.table.delete().where(self.table.c.session_key == session_key))
+
+    @classmethod
+    def clear_expired(cls):
+        table = cls.table
+        now = datetime.utcnow()
+        while True:
+            with cls.engine.begin() as conn:
+                keys = [
+                    row.session_key
+                    for row in conn.execute(
+                        select(table.c.session_key)
+                        .where(table.c.expires <= now)
+                        .limit(cls.sweep_batch_size)
+                    )
+                ]
+                if keys:
+                    conn.execute(table.delete().where(table.c.session_key.in_(keys)))
+            if len(keys) < cls.sweep_batch_size:
+                return
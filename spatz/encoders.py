@@ -0,0 +1,97 @@
+import json
+
+
+class JSONEncoder:
+    """Encode JSON with the standard library json module."""
+
+    name = "json"
+
+    def dumps(self, obj):
+        """Serialize the object to JSON ``bytes``."""
+        return json.dumps(obj).encode("utf-8")
+
+    def iter_dumps(self, items, chunk_size=1000):
+        """Serialize an iterable as a JSON array, yielding ``bytes`` chunks.
+
+        Only ``chunk_size`` items are encoded at once, so large lists or
+        generators of rows are never held in memory as a single string.
+
+        :param items: the items of the array
+        :type items: iterable
+        :param chunk_size: number of items encoded per chunk, defaults to 1000
+        :type chunk_size: int, optional
+        """
+        yield b"["
+        first = True
+        chunk = []
+        for item in items:
+            chunk.append(self.dumps(item))
+            if len(chunk) >= chunk_size:
+                yield (b"" if first else b",") + b",".join(chunk)
+                first = False
+                chunk = []
+        if chunk:
+            yield (b"" if first else b",") + b",".join(chunk)
+        yield b"]"
+
+
+class OrjsonEncoder(JSONEncoder):
+    """Encode JSON with orjson, which produces ``bytes`` directly.
+
+    Objects orjson refuses, e.g. dicts with keys which are not strings, are
+    encoded with the standard library instead.
+    """
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self._dumps = orjson.dumps
+
+    def dumps(self, obj):
+        try:
+            return self._dumps(obj)
+        except TypeError:
+            return super().dumps(obj)
+
+
+class UjsonEncoder(JSONEncoder):
+    """Encode JSON with ujson."""
+
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+
+        self._dumps = ujson.dumps
+
+    def dumps(self, obj):
+        return self._dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+ENCODERS = {
+    "orjson": OrjsonEncoder,
+    "ujson": UjsonEncoder,
+    "json": JSONEncoder,
+}
+
+
+def get_json_encoder(name=None):
+    """Return a JSON encoder.
+
+    Without a name, or with ``"auto"``, the fastest installed library is
+    used: orjson, then ujson, falling back to the standard library.
+
+    :param name: "orjson", "ujson", "json" or "auto", defaults to None
+    :type name: str, optional
+    :raises ImportError: if the requested library is not installed
+    """
+    if name is not None and name != "auto":
+        return ENCODERS[name]()
+
+    for encoder_cls in ENCODERS.values():
+        try:
+            return encoder_cls()
+        except ImportError:
+            continue
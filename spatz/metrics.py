@@ -0,0 +1,366 @@
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+
+from .middleware import Middleware
+from .response import Response
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name, type and help of the metric families
+FAMILIES = (
+    ("spatz_requests_total", "counter", "Requests handled, by endpoint, method and status."),
+    ("spatz_requests_in_flight", "gauge", "Requests being handled."),
+    ("spatz_request_duration_seconds", "histogram", "Duration of the requests, by endpoint."),
+    ("spatz_response_size_bytes", "histogram", "Size of the response bodies, by endpoint."),
+    ("spatz_background_tasks_queued", "gauge", "Background tasks waiting or running."),
+    ("spatz_background_tasks_total", "counter", "Background tasks run, by status."),
+    (
+        "spatz_background_task_latency_seconds",
+        "histogram",
+        "Time from the queueing to the end of the background tasks.",
+    ),
+)
+
+
+class Metrics:
+    """Request metrics in the Prometheus text format.
+
+    ``init_metrics()`` adds the middleware counting the requests and the
+    route serving the metrics at ``METRICS_PATH``. Call it after adding the
+    other middlewares, so that their time is measured too.
+
+    The values are kept in memory, or with ``METRICS_DIR`` in one memory
+    mapped file per process of that directory, so the metrics served by any
+    worker sum up the values of all the workers. The directory should be
+    emptied before the server starts, and ``mark_process_dead(pid)`` called
+    when a worker exits, e.g. from the ``child_exit`` hook of gunicorn.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.directory = None
+        self.buckets = DURATION_BUCKETS
+        self.size_buckets = SIZE_BUCKETS
+        self._pid = None
+        self._counters = None
+        self._gauges = None
+        self._keys = {}
+
+    def init_metrics(self):
+        """Initialize the metrics, adding their middleware and route."""
+        config = self.app.config
+        self.directory = config["METRICS_DIR"]
+        self.buckets = tuple(config["METRICS_BUCKETS"])
+
+        metrics = self
+
+        class MetricsMiddleware(Middleware):
+            def process_request(self, req):
+                req.metrics_start = time.perf_counter()
+                metrics.inc_in_flight(1)
+
+            def process_response(self, req, res):
+                metrics.observe(req, res)
+
+            def process_exception(self, req, exc):
+                metrics.observe(req, None)
+
+        self.app.add_middleware(MetricsMiddleware)
+        self.app.add_route(config["METRICS_PATH"], self.metrics_view, endpoint="spatz_metrics")
+
+    def stores(self):
+        """Returns the counter and gauge values of this process."""
+        pid = os.getpid()
+        if pid != self._pid:
+            # opened again after a fork, each process has its own files
+            if self.directory is None:
+                self._counters, self._gauges = DictValues(), DictValues()
+            else:
+                self._counters = MmapValues(os.path.join(self.directory, f"counter_{pid}.db"))
+                self._gauges = MmapValues(os.path.join(self.directory, f"gauge_{pid}.db"))
+            self._pid = pid
+        return self._counters, self._gauges
+
+    def keys(self, endpoint, method, status):
+        """Returns the keys of the values of a kind of request, computed once."""
+        cache_key = (endpoint, method, status)
+        keys = self._keys.get(cache_key)
+        if keys is None:
+            endpoint = "none" if endpoint is None else str(endpoint)
+            labels = {"endpoint": endpoint}
+            keys = self._keys[cache_key] = (
+                _key("spatz_requests_total", {"endpoint": endpoint, "method": method, "status": str(status)}),
+                _histogram_keys("spatz_request_duration_seconds", labels, self.buckets),
+                _histogram_keys("spatz_response_size_bytes", labels, self.size_buckets),
+            )
+        return keys
+
+    def inc_in_flight(self, amount):
+        with self.lock:
+            self.stores()[1].inc(_IN_FLIGHT_KEY, amount)
+
+    def inc_background_queued(self, amount):
+        with self.lock:
+            self.stores()[1].inc(_BACKGROUND_QUEUED_KEY, amount)
+
+    def observe_background(self, latency, status):
+        """Record a background task, ``status`` is ``"done"`` or ``"failed"``."""
+        cache_key = ("background", status)
+        keys = self._keys.get(cache_key)
+        if keys is None:
+            keys = self._keys[cache_key] = (
+                _key("spatz_background_tasks_total", {"status": status}),
+                _histogram_keys("spatz_background_task_latency_seconds", {}, self.buckets),
+            )
+
+        total, latency_keys = keys
+        with self.lock:
+            counters = self.stores()[0]
+            counters.inc(total, 1)
+            _observe(counters, latency_keys, self.buckets, latency)
+
+    def observe(self, req, res):
+        """Record a handled request, ``res`` is None when the handler raised."""
+        # recorded once, even when an outer middleware turns the exception into a response
+        start, req.metrics_start = req.metrics_start, None
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        size = None
+        if res is None:
+            status = 500
+        elif isinstance(res, Response):
+            res.set_body_and_content_type()
+            status = res.status_code
+            size = res.calculate_content_length()
+        else:
+            status = getattr(res, "code", None) or getattr(res, "status_code", 500)
+
+        total, duration_keys, size_keys = self.keys(getattr(req, "endpoint", None), req.method, status)
+        with self.lock:
+            counters, gauges = self.stores()
+            gauges.inc(_IN_FLIGHT_KEY, -1)
+            counters.inc(total, 1)
+            _observe(counters, duration_keys, self.buckets, duration)
+            if size is not None:
+                _observe(counters, size_keys, self.size_buckets, size)
+
+    def collect(self):
+        """Returns the values of all the processes, by key."""
+        if self.directory is None:
+            with self.lock:
+                counters, gauges = self.stores()
+                values = dict(counters.items())
+                values.update(gauges.items())
+            return values
+
+        values = {}
+        for path in glob.glob(os.path.join(self.directory, "*.db")):
+            for key, value in MmapValues.read(path):
+                values[key] = values.get(key, 0.0) + value
+        return values
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format."""
+        samples = {}
+        for key, value in self.collect().items():
+            name, labels = json.loads(key)
+            samples.setdefault(name, []).append((labels, value))
+
+        bounds = {
+            "spatz_request_duration_seconds": self.buckets,
+            "spatz_response_size_bytes": self.size_buckets,
+            "spatz_background_task_latency_seconds": self.buckets,
+        }
+        lines = []
+        for family, kind, help_text in FAMILIES:
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {kind}")
+            if kind == "histogram":
+                lines.extend(_render_histogram(family, samples, bounds[family]))
+            else:
+                for labels, value in samples.get(family, ()):
+                    lines.append(_sample(family, labels, value))
+        return "\n".join(lines) + "\n"
+
+    def metrics_view(self, req, resp):
+        resp.data = self.render()
+        resp.content_type = CONTENT_TYPE
+
+    def mark_process_dead(self, pid):
+        """Forget the gauges of a process that exited."""
+        if self.directory is not None:
+            try:
+                os.unlink(os.path.join(self.directory, f"gauge_{pid}.db"))
+            except FileNotFoundError:
+                pass
+
+
+class DictValues:
+    """Values of a single process."""
+
+    def __init__(self):
+        self.values = {}
+
+    def inc(self, key, amount):
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def items(self):
+        return list(self.values.items())
+
+
+class MmapValues:
+    """Values in a memory mapped file, which other processes can read.
+
+    The file starts with the number of bytes used, followed by the entries:
+    the length of the key, the key padded to 8 bytes and the value as a
+    double.
+    """
+
+    _used = struct.Struct("<i")
+    _length = struct.Struct("<i")
+    _value = struct.Struct("<d")
+    initial_size = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a+b")
+        size = os.fstat(self.file.fileno()).st_size
+        if size == 0:
+            size = self.initial_size
+            self.file.truncate(size)
+        self.capacity = size
+        self.map = mmap.mmap(self.file.fileno(), self.capacity)
+        self.used = self._used.unpack_from(self.map, 0)[0] or 8
+        self.positions = {key: pos for key, _, pos in self._entries(self.map, self.used)}
+
+    def inc(self, key, amount):
+        pos = self.positions.get(key)
+        if pos is None:
+            pos = self._add(key)
+        value = self._value.unpack_from(self.map, pos)[0]
+        self._value.pack_into(self.map, pos, value + amount)
+
+    def items(self):
+        return [(key, value) for key, value, _ in self._entries(self.map, self.used)]
+
+    def _add(self, key):
+        encoded = key.encode("utf-8")
+        padding = 8 - (self._length.size + len(encoded)) % 8
+        entry = (
+            self._length.pack(len(encoded))
+            + encoded
+            + b" " * padding
+            + self._value.pack(0.0)
+        )
+        if self.used + len(entry) > self.capacity:
+            while self.used + len(entry) > self.capacity:
+                self.capacity *= 2
+            self.file.truncate(self.capacity)
+            self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.capacity)
+
+        self.map[self.used : self.used + len(entry)] = entry
+        self.used += len(entry)
+        self._used.pack_into(self.map, 0, self.used)
+        pos = self.used - self._value.size
+        self.positions[key] = pos
+        return pos
+
+    @classmethod
+    def read(cls, path):
+        """Returns the keys and values of a file, without mapping it."""
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < 8:
+            return []
+        used = cls._used.unpack_from(data, 0)[0]
+        return [(key, value) for key, value, _ in cls._entries(data, used)]
+
+    @classmethod
+    def _entries(cls, data, used):
+        pos = 8
+        while pos < used:
+            length = cls._length.unpack_from(data, pos)[0]
+            pos += cls._length.size
+            key = bytes(data[pos : pos + length]).decode("utf-8")
+            pos += length + 8 - (cls._length.size + length) % 8
+            value = cls._value.unpack_from(data, pos)[0]
+            yield key, value, pos
+            pos += cls._value.size
+
+
+def _key(name, labels):
+    return json.dumps([name, labels])
+
+
+_IN_FLIGHT_KEY = _key("spatz_requests_in_flight", {})
+_BACKGROUND_QUEUED_KEY = _key("spatz_background_tasks_queued", {})
+
+
+def _histogram_keys(name, labels, buckets):
+    """Returns the keys of the buckets, the sum and the count of a histogram."""
+    bucket_keys = [
+        _key(f"{name}_bucket", dict(labels, le=_format_bound(bound)))
+        for bound in (*buckets, float("inf"))
+    ]
+    return bucket_keys, _key(f"{name}_sum", labels), _key(f"{name}_count", labels)
+
+
+def _observe(values, keys, buckets, value):
+    # only the bucket of the value is counted, the buckets are cumulated when rendered
+    bucket_keys, sum_key, count_key = keys
+    values.inc(bucket_keys[bisect_left(buckets, value)], 1)
+    values.inc(sum_key, value)
+    values.inc(count_key, 1)
+
+
+def _render_histogram(family, samples, bounds):
+    lines = []
+    series = {}
+    for labels, value in samples.get(f"{family}_bucket", ()):
+        labels = dict(labels)
+        bound = float(labels.pop("le"))
+        buckets = series.get(tuple(sorted(labels.items())))
+        if buckets is None:
+            # every bucket is rendered, the empty ones too
+            buckets = series[tuple(sorted(labels.items()))] = dict.fromkeys(
+                (*map(float, bounds), float("inf")), 0.0
+            )
+        buckets[bound] = buckets.get(bound, 0.0) + value
+
+    sums = {tuple(sorted(labels.items())): value for labels, value in samples.get(f"{family}_sum", ())}
+    counts = {tuple(sorted(labels.items())): value for labels, value in samples.get(f"{family}_count", ())}
+    for labels, buckets in sorted(series.items()):
+        cumulated = 0.0
+        for bound, value in sorted(buckets.items()):
+            cumulated += value
+            lines.append(_sample(f"{family}_bucket", dict(labels, le=_format_bound(bound)), cumulated))
+        lines.append(_sample(f"{family}_sum", dict(labels), sums.get(labels, 0.0)))
+        lines.append(_sample(f"{family}_count", dict(labels), counts.get(labels, 0.0)))
+    return lines
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def _sample(name, labels, value):
+    if labels:
+        pairs = ",".join(f'{label}="{_escape(text)}"' for label, text in labels.items())
+        name = f"{name}{{{pairs}}}"
+    return f"{name} {int(value) if value.is_integer() else repr(value)}"
+
+
+def _escape(text):
+    return str(text).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
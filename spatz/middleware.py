@@ -1,13 +1,84 @@
-from werkzeug.wrappers import Request
+import asyncio
+import time
+from werkzeug.exceptions import RequestEntityTooLarge
 from datetime import datetime, timedelta
 
+from .context import current_request, stream_with_request
+from .request import Request
+from .utils import run_awaitable, await_result
+from .timing import current_timings, timed
+from .session import get_session_backend
+
 
 class Middleware:
+    """Base class of the middlewares.
+
+    The middlewares added to a middleware are compiled into flat lists of
+    ``process_request`` and ``process_response`` methods which a single loop
+    runs around the application, the last added middleware being the
+    outermost one. Methods that are not overridden are left out.
+
+    ``process_request`` may return a response to short-circuit the request:
+    the remaining middlewares and the handler are skipped, and only the
+    middlewares that already processed the request process the response.
+
+    When a ``process_request`` method or the handler raises, the
+    ``process_exception`` methods of the middlewares that processed the
+    request are called, innermost first. The first one returning a response
+    makes it the response of the request, otherwise the exception goes on.
+
+    The methods may be coroutines, they are awaited when the application is
+    served over ASGI.
+
+    Only the root middleware of the application, ``app.middleware``, runs
+    the pipeline, so the middlewares it holds must not override
+    ``handle_request`` or ``__call__``, which would never be called.
+    """
+
     def __init__(self, app):
         self.app = app
+        self.middlewares = []
 
     def add(self, middleware_cls):
-        self.app = middleware_cls(self.app)
+        for name in ("handle_request", "handle_request_async", "__call__"):
+            if getattr(middleware_cls, name) is not getattr(Middleware, name):
+                raise AssertionError(
+                    f"{middleware_cls.__name__} overrides {name}, which the middleware pipeline "
+                    "never calls. Override process_request, process_response or process_exception instead."
+                )
+        self.middlewares.insert(0, middleware_cls(self.app))
+        self.compile()
+
+    def compile(self):
+        """Build the request and response pipelines from the middlewares, on the root middleware."""
+        layers = [self] + self.middlewares
+        self.is_async = False
+        self.request_hooks = []
+        self.response_hooks = []
+        self.async_request_hooks = []
+        self.async_response_hooks = []
+        self.exception_hooks = []
+        self.async_exception_hooks = []
+
+        for layer in layers:
+            process_request = _overridden(layer, "process_request")
+            process_response = _overridden(layer, "process_response")
+            process_exception = _overridden(layer, "process_exception")
+            for hook in (process_request, process_response, process_exception):
+                if hook is not None and asyncio.iscoroutinefunction(hook):
+                    self.is_async = True
+
+            if self.app.timing.enabled:
+                name = type(layer).__name__
+                process_request = timed(process_request, f"{name}.request")
+                process_response = timed(process_response, f"{name}.response")
+
+            self.async_request_hooks.append(process_request)
+            self.async_response_hooks.insert(0, process_response)
+            self.async_exception_hooks.insert(0, process_exception)
+            self.request_hooks.append(_sync(process_request))
+            self.response_hooks.insert(0, _sync(process_response))
+            self.exception_hooks.insert(0, _sync(process_exception))
 
     def process_request(self, req):
         pass
@@ -15,37 +86,166 @@ class Middleware:
     def process_response(self, req, res):
         pass
 
+    def process_exception(self, req, exc):
+        pass
+
     def handle_request(self, req):
-        self.process_request(req)
-        res = self.app.handle_request(req)
-        self.process_response(req, res)
+        res = None
+        processed = 0
+        try:
+            for process_request in self.request_hooks:
+                if process_request is not None:
+                    res = process_request(req)
+                processed += 1
+                if res is not None:
+                    break
+
+            if res is None:
+                res = self.app.handle_request(req)
+        except Exception as exc:
+            hooks = self.exception_hooks
+            for process_exception in hooks[len(hooks) - processed :]:
+                if process_exception is not None:
+                    res = process_exception(req, exc)
+                    if res is not None:
+                        break
+            else:
+                raise
+
+        for process_response in self.response_hooks[len(self.response_hooks) - processed :]:
+            if process_response is not None:
+                process_response(req, res)
+
+        return res
+
+    async def handle_request_async(self, req):
+        res = None
+        processed = 0
+        try:
+            for process_request in self.async_request_hooks:
+                if process_request is not None:
+                    res = await await_result(process_request(req))
+                processed += 1
+                if res is not None:
+                    break
+
+            if res is None:
+                res = await self.app.handle_request_async(req)
+        except Exception as exc:
+            hooks = self.async_exception_hooks
+            for process_exception in hooks[len(hooks) - processed :]:
+                if process_exception is not None:
+                    res = await await_result(process_exception(req, exc))
+                    if res is not None:
+                        break
+            else:
+                raise
+
+        hooks = self.async_response_hooks
+        for process_response in hooks[len(hooks) - processed :]:
+            if process_response is not None:
+                await await_result(process_response(req, res))
 
         return res
 
     def __call__(self, environ, start_response):
-        request = Request(environ)
-        response = self.handle_request(request)
-        return response(environ, start_response)
+        request = Request.from_app(environ, self.app)
+        if request.too_large:
+            # rejected before the body is read
+            return RequestEntityTooLarge()(environ, start_response)
+
+        token = current_request.set(request)
+        try:
+            if self.app.timing.enabled:
+                response = self.app.timing.handle_request(self.handle_request, request)
+            else:
+                response = self.handle_request(request)
+        finally:
+            current_request.reset(token)
+        self.app.background.schedule(response)
+        body = response(environ, start_response)
+        if getattr(response, "is_streamed", False):
+            return stream_with_request(body, request)
+        return body
+
+
+def _overridden(middleware, name):
+    """Return the bound method if the middleware overrides it, else None."""
+    if getattr(type(middleware), name) is getattr(Middleware, name):
+        return None
+    return getattr(middleware, name)
+
+
+def _sync(hook):
+    """Wrap a coroutine method so it runs to completion when called."""
+    if hook is None or not asyncio.iscoroutinefunction(hook):
+        return hook
+
+    def wrapper(*args):
+        return run_awaitable(hook(*args))
+
+    return wrapper
 
 
 class SessionMiddleware(Middleware):
     def __init__(self, app):
         super().__init__(app)
-        self.SessionInterface = app.SessionInterface
+        backend = app.config["SESSION_BACKEND"]
+        if backend is None:
+            backend = app.SessionInterface
+        else:
+            backend = get_session_backend(backend)
+        self.SessionInterface = backend.configure(app)
 
     def process_request(self, req):
         session_key = req.cookies.get(self.app.config["SESSION_COOKIE_NAME"])
         req.session = self.SessionInterface(session_key=session_key)
 
     def process_response(self, req, res):
-        expires = datetime.utcnow() + self.app.config["PERMANENT_SESSION_LIFETIME"]
-        req.session.save()
+        """Save the session and send its cookie only when it is needed.
+
+        A modified session is saved, or its cookie deleted when it was
+        emptied. A session that was only read gets its cookie sent again to
+        refresh the expiry, if ``SESSION_REFRESH_EACH_REQUEST`` is set. An
+        untouched session costs nothing.
+        """
+        session = getattr(req, "session", None)
+        if session is None:
+            return
+
+        config = self.app.config
+        # werkzeug HTTP exceptions have no headers, their cookies are left as they are
+        has_headers = hasattr(res, "headers")
+        if session.modified:
+            if session.is_empty():
+                session.delete()
+                if has_headers and config["SESSION_COOKIE_NAME"] in req.cookies:
+                    res.delete_cookie(
+                        config["SESSION_COOKIE_NAME"],
+                        domain=config["SESSION_COOKIE_DOMAIN"],
+                        path=config["SESSION_COOKIE_PATH"],
+                    )
+                return
+            timings = current_timings.get()
+            start = timings and time.perf_counter()
+            session.save()
+            if timings:
+                timings.add("session-save", start)
+        elif not (session.accessed and config["SESSION_REFRESH_EACH_REQUEST"]):
+            return
+        elif session.session_key is None:
+            # nothing was loaded, a first visit or an unknown or expired key
+            return
+
+        if not has_headers:
+            return
+        expires = datetime.utcnow() + config["PERMANENT_SESSION_LIFETIME"]
         res.set_cookie(
-            self.app.config["SESSION_COOKIE_NAME"],
-            req.session.session_key,
+            config["SESSION_COOKIE_NAME"],
+            session.session_key,
             expires=expires,
-            domain=self.app.config["SESSION_COOKIE_DOMAIN"],
-            path=self.app.config["SESSION_COOKIE_PATH"],
-            secure=self.app.config["SESSION_COOKIE_SECURE"],
-            httponly=self.app.config["SESSION_COOKIE_HTTPONLY"],
+            domain=config["SESSION_COOKIE_DOMAIN"],
+            path=config["SESSION_COOKIE_PATH"],
+            secure=config["SESSION_COOKIE_SECURE"],
+            httponly=config["SESSION_COOKIE_HTTPONLY"],
         )
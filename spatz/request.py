@@ -0,0 +1,127 @@
+import hashlib
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import cached_property
+from werkzeug.wrappers import Request as WerkzeugRequest
+from werkzeug.wsgi import get_input_stream
+
+
+class Request(WerkzeugRequest):
+    """The request given to the handlers.
+
+    Bodies larger than ``max_content_length`` are rejected with ``413
+    Request Entity Too Large``, before they are read when the request has a
+    Content-Length, or as soon as the limit is crossed when it is streamed.
+    ``max_form_memory_size`` bounds the form fields kept in memory.
+
+    Large bodies can be read chunk by chunk with ``iter_body``, written to a
+    file with ``save_body`` or hashed with ``hash_body`` without ever being
+    held in memory.
+    """
+
+    chunk_size = 64 * 1024
+
+    @classmethod
+    def from_app(cls, environ, app):
+        """Create a request with the limits of the application config."""
+        request = cls(environ)
+        request.max_content_length = app.config["MAX_CONTENT_LENGTH"]
+        request.max_form_memory_size = app.config["MAX_FORM_MEMORY_SIZE"]
+        return request
+
+    @property
+    def too_large(self):
+        """Whether the announced Content-Length is over ``max_content_length``."""
+        return (
+            self.max_content_length is not None
+            and self.content_length is not None
+            and self.content_length > self.max_content_length
+        )
+
+    @cached_property
+    def stream(self):
+        stream = get_input_stream(self.environ)
+        if self.max_content_length is not None and self.content_length is None:
+            # a body without Content-Length is only bounded by the limit
+            stream = BoundedStream(stream, self.max_content_length)
+        return stream
+
+    def iter_body(self, chunk_size=None):
+        """Iterate over the body in chunks of ``bytes``.
+
+        :param chunk_size: the maximum size of the chunks, defaults to 64KB
+        :type chunk_size: int, optional
+        :raises werkzeug.exceptions.RequestEntityTooLarge: if the body is larger than ``max_content_length``
+        """
+        if self.too_large:
+            raise RequestEntityTooLarge()
+        read = self.stream.read
+        chunk_size = chunk_size or self.chunk_size
+        while True:
+            chunk = read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def save_body(self, destination, hasher=None):
+        """Write the body to a file, chunk by chunk.
+
+        :param destination: the path of the file, or a binary file object
+        :type destination: str or file
+        :param hasher: a ``hashlib`` object updated with the body, defaults to None
+        :return: the size of the body
+        :rtype: int
+        """
+        if isinstance(destination, (str, bytes)) or hasattr(destination, "__fspath__"):
+            with open(destination, "wb") as f:
+                return self.save_body(f, hasher)
+
+        size = 0
+        for chunk in self.iter_body():
+            destination.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            size += len(chunk)
+        return size
+
+    def hash_body(self, algorithm="sha256"):
+        """Returns the hex digest of the body, hashed chunk by chunk."""
+        hasher = hashlib.new(algorithm)
+        for chunk in self.iter_body():
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+
+class BoundedStream:
+    """Read a stream, raising ``RequestEntityTooLarge`` past ``limit`` bytes."""
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.position = 0
+
+    def _count(self, data):
+        self.position += len(data)
+        if self.position > self.limit:
+            raise RequestEntityTooLarge()
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # read at most one byte over the limit
+            size = self.limit - self.position + 1
+        return self._count(self.stream.read(size))
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = self.limit - self.position + 1
+        return self._count(self.stream.readline(size))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration()
+        return line
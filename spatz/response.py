@@ -1,29 +1,133 @@
-import json
+import asyncio
+import time
 
 from werkzeug.wrappers import Response as WerkzeugResponse
 
+from .encoders import JSONEncoder
+from .timing import current_timings
+
 
 class Response(WerkzeugResponse):
+    """The response given to the handlers.
+
+    Set ``json``, ``html`` or ``text`` and the body and the content type are
+    filled in when the response is sent. ``json_stream`` takes an iterable
+    which is sent as a JSON array, encoded in chunks.
+
+    ``stream``, ``html`` and ``text`` also take an iterator, a generator or an
+    async generator of ``str`` or ``bytes`` chunks. The body is then sent
+    while it is produced, without a Content-Length, so the server uses
+    chunked transfer encoding.
+
+    With ``auto_etag``, an ETag is computed over the final body. Responses
+    with an ETag or a Last-Modified header answer conditional GET and HEAD
+    requests with ``304 Not Modified``.
+
+    ``background(func, *args, **kwargs)`` defers work until the response is
+    sent, see ``spatz.background.BackgroundTasks``.
+    """
+
+    json_encoder = JSONEncoder()
+    auto_etag = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.json = None
+        self.json_stream = None
         self.html = None
         self.text = None
+        self.stream = None
+        self.async_stream = None
+        self.finalized = False
+        self.background_tasks = []
 
     def __call__(self, environ, start_response):
         self.set_body_and_content_type()
+        if "ETag" in self.headers or "Last-Modified" in self.headers:
+            if self.is_streamed:
+                # computing the length would read the whole stream into memory
+                self.automatically_set_content_length = False
+            self.make_conditional(environ)
 
         return super().__call__(environ, start_response)
 
+    def background(self, func, *args, **kwargs):
+        """Call ``func(*args, **kwargs)`` in the background once the response is sent."""
+        self.background_tasks.append((func, args, kwargs))
+
+    @property
+    def will_stream(self):
+        """Whether the body is streamed, known before it is filled in."""
+        if not self.finalized:
+            if self.json_stream is not None:
+                return True
+            for body in (self.html, self.text, self.stream):
+                if body is not None and not isinstance(body, (str, bytes)):
+                    return True
+        return self.is_streamed
+
     def set_body_and_content_type(self):
-        if self.json:
-            self.data = json.dumps(self.json)
+        """Fill in the body and the content type, once.
+
+        Middlewares which need the final body call it themselves, changes to
+        the helper attributes made afterwards are ignored.
+        """
+        if self.finalized:
+            return
+        self.finalized = True
+
+        if self.json is not None:
+            timings = current_timings.get()
+            start = timings and time.perf_counter()
+            self.data = self.json_encoder.dumps(self.json)
+            self.content_type = "application/json"
+            if timings:
+                timings.add("serialize", start)
+
+        if self.json_stream is not None:
+            self.set_body(self.json_encoder.iter_dumps(self.json_stream))
             self.content_type = "application/json"
 
         if self.html:
-            self.data = self.html
+            self.set_body(self.html)
             self.content_type = "text/html"
 
         if self.text:
-            self.data = self.text
+            self.set_body(self.text)
             self.content_type = "text/plain"
+
+        if self.stream is not None:
+            self.set_body(self.stream)
+
+        if self.auto_etag and self.status_code == 200 and not self.is_streamed:
+            self.add_etag()
+
+    def set_body(self, body):
+        """Set a string body, or an iterable body which is streamed."""
+        if isinstance(body, (str, bytes)):
+            self.data = body
+        else:
+            # the length of a stream is unknown, it is sent chunked
+            self.headers.pop("Content-Length", None)
+            if hasattr(body, "__aiter__"):
+                self.async_stream = body
+                self.response = _iterate_async(body)
+            else:
+                self.response = body
+
+
+def _iterate_async(iterator):
+    """Iterate an async iterator from synchronous code, for WSGI servers."""
+    loop = asyncio.new_event_loop()
+    iterator = iterator.__aiter__()
+    try:
+        while True:
+            try:
+                chunk = loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        if hasattr(iterator, "aclose"):
+            loop.run_until_complete(iterator.aclose())
+        loop.close()
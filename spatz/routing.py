@@ -0,0 +1,105 @@
+class MapDispatcher:
+    """Match requests by binding the werkzeug URL map to every request.
+
+    This is the plain werkzeug behaviour: a new ``MapAdapter`` per request and
+    a linear scan over all the rules.
+    """
+
+    def __init__(self, url_map):
+        self.url_map = url_map
+
+    def match(self, request):
+        """Return the ``(endpoint, kwargs)`` pair for the request.
+
+        :param request: requests from clients
+        :type request: werkzeug.wrappers.Request
+        :raises werkzeug.exceptions.HTTPException: on 404, 405 or redirects
+        """
+        return self.url_map.bind_to_environ(request.environ).match()
+
+
+class CompiledDispatcher(MapDispatcher):
+    """Match requests against tables compiled once from the werkzeug URL map.
+
+    Rules without arguments are kept in a hash table keyed by their path.
+    Rules with arguments are bucketed by their first path segment when that
+    segment is static, so only the rules that may match are tried. Anything
+    the tables cannot answer (404, 405, redirects, special rules) falls back
+    to the werkzeug matching, which keeps the results identical.
+    """
+
+    def __init__(self, url_map):
+        super().__init__(url_map)
+        self.static = {}
+        self.buckets = {}
+        self.wildcard = []
+
+        url_map.update()
+        buckets = {}
+        for index, rule in enumerate(url_map.iter_rules()):
+            entry = (index, rule, self._is_simple(rule))
+            if not rule.arguments:
+                self.static.setdefault(rule.rule, []).append(entry)
+                continue
+
+            segment = rule.rule[1:].partition("/")[0]
+            if "<" in segment:
+                self.wildcard.append(entry)
+            else:
+                buckets.setdefault(segment, []).append(entry)
+
+        # keep the werkzeug ordering between a bucket and the wildcard rules
+        for segment, entries in buckets.items():
+            entries = sorted(entries + self.wildcard, key=lambda e: e[0])
+            self.buckets[segment] = [e[1:] for e in entries]
+        self.wildcard = [e[1:] for e in self.wildcard]
+        for path, entries in self.static.items():
+            self.static[path] = [e[1:] for e in entries]
+
+    @staticmethod
+    def _is_simple(rule):
+        """Return True if the rule can be answered without werkzeug."""
+        return not (
+            rule.build_only
+            or rule.defaults
+            or rule.redirect_to is not None
+            or rule.alias
+            or rule.websocket
+            or rule.subdomain
+            or rule.host
+        )
+
+    def match(self, request):
+        path = request.path
+        method = request.method
+
+        entries = self.static.get(path)
+        if entries is not None:
+            for rule, simple in entries:
+                if not simple:
+                    return super().match(request)
+                if rule.methods is None or method in rule.methods:
+                    return rule.endpoint, {}
+
+        candidates = self.buckets.get(path[1:].partition("/")[0], self.wildcard)
+        matched = "|" + path
+        for rule, simple in candidates:
+            if not simple:
+                break
+            try:
+                kwargs = rule.match(matched, method)
+            except Exception:
+                break
+            if kwargs is None:
+                continue
+            if rule.methods is None or method in rule.methods:
+                return rule.endpoint, kwargs
+            break
+
+        return super().match(request)
+
+
+DISPATCHERS = {
+    "werkzeug": MapDispatcher,
+    "compiled": CompiledDispatcher,
+}
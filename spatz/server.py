@@ -0,0 +1,300 @@
+import gc
+import importlib
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+logger = logging.getLogger("spatz.server")
+
+
+def load_app(app_path, reload=False):
+    """Import the application from a ``module:attribute`` path.
+
+    :param app_path: e.g. ``"myproject.app:app"``, the attribute defaults to ``app``
+    :type app_path: str
+    :param reload: import the module again, defaults to False
+    :type reload: bool, optional
+    """
+    module_name, _, name = app_path.partition(":")
+    module = importlib.import_module(module_name)
+    if reload:
+        module = importlib.reload(module)
+    return getattr(module, name or "app")
+
+
+class PreforkServer:
+    """A HTTP server forking worker processes which share the application.
+
+    The application is imported and warmed up once in the parent process,
+    then the objects it allocated are frozen out of the garbage collector so
+    the forked workers share their memory pages copy-on-write. Each worker
+    accepts connections on the shared socket and serves one request per
+    connection, or with ``threads`` more than one, serves that many
+    connections at once from a pool of threads.
+
+    ``SIGHUP`` reloads the application module and replaces the workers
+    gracefully, ``SIGTERM`` and ``SIGINT`` stop the server after the requests
+    in progress. A worker exits after ``max_requests`` requests, plus a random
+    jitter, and is replaced.
+    """
+
+    def __init__(
+        self,
+        app_path,
+        host="127.0.0.1",
+        port=8000,
+        workers=None,
+        max_requests=0,
+        max_requests_jitter=0,
+        graceful_timeout=30,
+        backlog=2048,
+        access_log=False,
+        threads=1,
+    ):
+        self.app_path = app_path
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.access_log = access_log
+        self.threads = threads
+
+        self.app = None
+        self.socket = None
+        self.children = {}
+        self.generation = 0
+        self.alive = True
+        self.reload_requested = False
+
+    def load(self, reload=False):
+        if reload and hasattr(gc, "unfreeze"):
+            # the previous application can be collected once its workers exit
+            gc.unfreeze()
+        app = load_app(self.app_path, reload=reload)
+        app.warmup()
+        gc.collect()
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+        return app
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET6 if ":" in self.host else socket.AF_INET)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        # the workers poll the socket, so that they can stop between requests
+        sock.setblocking(False)
+        self.port = sock.getsockname()[1]
+        return sock
+
+    def run(self):
+        self.app = self.load()
+        self.socket = self.bind()
+        logger.info(
+            "Listening on http://%s:%d with %d workers of %d threads",
+            self.host,
+            self.port,
+            self.workers,
+            self.threads,
+        )
+
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        try:
+            while self.alive:
+                self.reap()
+                if self.reload_requested:
+                    self.reload()
+                self.spawn_workers()
+                time.sleep(0.1)
+        finally:
+            self.stop()
+
+    def handle_stop(self, signum, frame):
+        self.alive = False
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.children.pop(pid, None)
+
+    def spawn_workers(self):
+        running = sum(1 for generation in self.children.values() if generation == self.generation)
+        for _ in range(self.workers - running):
+            self.spawn()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = self.generation
+            return
+
+        code = 0
+        try:
+            max_requests = self.max_requests
+            if max_requests and self.max_requests_jitter:
+                random.seed()
+                max_requests += random.randint(0, self.max_requests_jitter)
+            Worker(
+                self.app, self.socket, self.host, self.port, max_requests, self.access_log, self.threads
+            ).run()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stderr.flush()
+            os._exit(code)
+
+    def reload(self):
+        self.reload_requested = False
+        try:
+            app = self.load(reload=True)
+        except Exception:
+            logger.exception("Reloading %s failed, keeping the running workers", self.app_path)
+            return
+
+        logger.info("Reloaded %s, replacing the workers", self.app_path)
+        old = [pid for pid, generation in self.children.items() if generation == self.generation]
+        self.app = app
+        self.generation += 1
+        self.spawn_workers()
+        self.kill(old, signal.SIGTERM)
+
+    def stop(self):
+        self.kill(list(self.children), signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        self.kill(list(self.children), signal.SIGKILL)
+        self.reap()
+        if self.socket is not None:
+            self.socket.close()
+
+    def kill(self, pids, sig):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                self.children.pop(pid, None)
+
+
+class Worker:
+    """A worker process serving requests from the socket shared with its siblings."""
+
+    def __init__(self, app, sock, host, port, max_requests=0, access_log=False, threads=1):
+        self.app = app
+        self.socket = sock
+        self.host = host
+        self.port = port
+        self.max_requests = max_requests
+        self.access_log = access_log
+        self.threads = threads
+        self.handled = 0
+        self.lock = threading.Lock()
+        self.alive = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.after_fork()
+
+        if self.threads > 1:
+            server = ThreadPoolWSGIServer(
+                (self.host, self.port), self.handler_class(), bind_and_activate=False, threads=self.threads
+            )
+        else:
+            server = WSGIServer((self.host, self.port), self.handler_class(), bind_and_activate=False)
+        server.socket = self.socket
+        server.server_name = self.host
+        server.server_port = self.port
+        server.setup_environ()
+        server.set_app(self.wsgi_app)
+        server.timeout = 1.0
+
+        parent = os.getppid()
+        try:
+            while self.alive and not (self.max_requests and self.handled >= self.max_requests):
+                server.handle_request()
+                if os.getppid() != parent:
+                    # the parent died without stopping the workers
+                    return
+        finally:
+            if self.threads > 1:
+                # finish the requests in progress
+                server.executor.shutdown(wait=True)
+            self.app.background.shutdown()
+
+    def after_fork(self):
+        # connections opened by the parent must not be shared by the workers
+        db = self.app._db
+        engine = getattr(db, "engine", None)
+        if engine is not None:
+            engine.dispose(close=False)
+
+    def handle_stop(self, signum, frame):
+        self.alive = False
+
+    def wsgi_app(self, environ, start_response):
+        with self.lock:
+            self.handled += 1
+        return self.app(environ, start_response)
+
+    def handler_class(self):
+        access_log = self.access_log
+
+        class RequestHandler(WSGIRequestHandler):
+            def log_message(self, format, *args):
+                if access_log:
+                    super().log_message(format, *args)
+
+        return RequestHandler
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """A WSGI server handling the connections in a pool of threads.
+
+    At most twice as many connections as threads are accepted before they
+    are handled, the others wait in the listen backlog of the socket, where
+    the other workers can accept them.
+    """
+
+    def __init__(self, *args, threads=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="spatz-worker")
+        self.slots = threading.BoundedSemaphore(threads * 2)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
@@ -1,20 +1,48 @@
+import os
+import pickle
+import secrets
+import string
+import tempfile
+import time
+from datetime import timedelta
+
 from itsdangerous import URLSafeSerializer, BadSignature
 
+from .utils.store import CreateError, LocMemStore, private_directory
+
 
 class SessionBase:
+    """Base class of the sessions.
+
+    The session data is loaded lazily, the first time the session is used,
+    so requests that never touch the session do not pay for loading it.
+    ``accessed`` and ``modified`` tell whether the session was used or
+    changed during the request.
+    """
+
     def __init__(self, session_key=None, no_load=False):
         self._session_key = session_key
         self.accessed = False
         self.modified = False
         if session_key is None or no_load:
-            self._session = {}
+            self._session_cache = {}
         else:
-            self._session = self.load()
+            self._session_cache = None
 
     @property
     def session_key(self):
         return self._session_key
 
+    @property
+    def _session(self):
+        if self._session_cache is None:
+            self._session_cache = self.load()
+        return self._session_cache
+
+    @_session.setter
+    def _session(self, value):
+        self._session_cache = value
+
     @property
     def session(self):
         self.accessed = True
@@ -56,6 +84,10 @@ class SessionBase:
     def has_key(self, key):
         return key in self.session
 
+    def is_empty(self):
+        """Return True if the session holds no data."""
+        return not self._session
+
     def keys(self):
         return self.session.keys()
 
@@ -82,6 +114,16 @@ class SessionBase:
         self.accessed = True
         self.modified = True
 
+    @classmethod
+    def configure(cls, app):
+        """
+        Returns the session class to use for the given application.
+
+        Backends reading their settings from the application config return a
+        subclass bound to these settings, the default returns the class itself.
+        """
+        return cls
+
     # Methods that child classes must implement.
 
     def exists(self, session_key):
@@ -142,15 +184,23 @@ class SessionBase:
 
 
 class ClientSession(SessionBase):
+    secret_key = "default"
+
     def __init__(self, app=None, session_key=None, no_load=False):
         if app is None:
-            secret_key = "default"
+            secret_key = self.secret_key
         else:
             secret_key = app.config["SECRET_KEY"]
 
         self.serializer = URLSafeSerializer(secret_key)
         super(ClientSession, self).__init__(session_key, no_load)
 
+    @classmethod
+    def configure(cls, app):
+        if app.config["SECRET_KEY"] is None:
+            return cls
+        return type(cls.__name__, (cls,), {"secret_key": app.config["SECRET_KEY"]})
+
     def load(self):
         try:
             return self.serializer.loads(self.session_key, salt="client-session")
@@ -184,5 +234,244 @@ class ClientSession(SessionBase):
         pass
 
 
-class LocMemSession(SessionBase):
-    pass
+class ServerSession(SessionBase):
+    """Base class of the sessions stored on the server, keyed by a random session id.
+
+    The cookie only carries the session id. Subclasses store the pickled
+    session data by implementing ``_fetch``, ``_store`` and ``_remove``.
+    Sessions expire after ``PERMANENT_SESSION_LIFETIME`` without being used,
+    and expired sessions are swept from the store every
+    ``SESSION_SWEEP_INTERVAL`` seconds while sessions are saved.
+    """
+
+    lifetime = timedelta(days=1).total_seconds()
+    sweep_interval = 3600.0
+    last_sweep = 0.0
+
+    @classmethod
+    def configure(cls, app):
+        return type(cls.__name__, (cls,), cls.settings(app))
+
+    @classmethod
+    def settings(cls, app):
+        """Returns the class attributes of the session class bound to the application."""
+        return {
+            "lifetime": app.config["PERMANENT_SESSION_LIFETIME"].total_seconds(),
+            "sweep_interval": app.config["SESSION_SWEEP_INTERVAL"],
+            "last_sweep": time.monotonic(),
+        }
+
+    def exists(self, session_key):
+        return self._fetch(session_key, touch=False) is not None
+
+    def create(self):
+        while True:
+            self._session_key = secrets.token_urlsafe(32)
+            try:
+                self.save(must_create=True)
+            except CreateError:
+                continue
+            self.modified = True
+            return
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = pickle.dumps(self._session, pickle.HIGHEST_PROTOCOL)
+        self._store(self.session_key, data, must_create)
+        self._sweep()
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        self._remove(session_key)
+
+    def load(self):
+        data = self._fetch(self.session_key)
+        if data is None:
+            self._session_key = None
+            return {}
+        return pickle.loads(data)
+
+    def cycle_key(self):
+        """Keeps the session data under a new key and removes the old one."""
+        data = self._session
+        key = self.session_key
+        self._session_key = None
+        self._session = data
+        self.create()
+        if key is not None:
+            self.delete(key)
+
+    @classmethod
+    def _sweep(cls):
+        now = time.monotonic()
+        if now - cls.last_sweep >= cls.sweep_interval:
+            cls.last_sweep = now
+            cls.clear_expired()
+
+    def _fetch(self, session_key, touch=True):
+        """
+        Returns the pickled data stored under the key, or None if it is missing
+        or expired. If 'touch' is True, the expiry of the session is pushed back.
+        """
+        raise NotImplementedError(
+            "subclasses of ServerSession must provide a _fetch() method"
+        )
+
+    def _store(self, session_key, data, must_create):
+        """
+        Stores the pickled data under the key. If 'must_create' is True and the
+        key already exists, CreateError is raised.
+        """
+        raise NotImplementedError(
+            "subclasses of ServerSession must provide a _store() method"
+        )
+
+    def _remove(self, session_key):
+        """
+        Removes the data stored under the key, if any.
+        """
+        raise NotImplementedError(
+            "subclasses of ServerSession must provide a _remove() method"
+        )
+
+
+class LocMemSession(ServerSession):
+    """Sessions stored in the memory of the process.
+
+    The least recently used sessions are evicted past
+    ``SESSION_LOCMEM_MAX_ENTRIES`` sessions or ``SESSION_LOCMEM_MAX_BYTES`` of
+    pickled data. Sessions are not shared between processes.
+    """
+
+    store = LocMemStore()
+
+    @classmethod
+    def settings(cls, app):
+        settings = super().settings(app)
+        settings["store"] = LocMemStore(
+            max_entries=app.config["SESSION_LOCMEM_MAX_ENTRIES"],
+            max_bytes=app.config["SESSION_LOCMEM_MAX_BYTES"],
+        )
+        return settings
+
+    def _fetch(self, session_key, touch=True):
+        return self.store.get(session_key, self.lifetime if touch else None)
+
+    def _store(self, session_key, data, must_create):
+        self.store.set(session_key, data, self.lifetime, must_create=must_create)
+
+    def _remove(self, session_key):
+        self.store.delete(session_key)
+
+    @classmethod
+    def clear_expired(cls):
+        cls.store.clear_expired()
+
+
+class FileSession(ServerSession):
+    """Sessions stored in files, one per session, under ``SESSION_FILE_DIR``.
+
+    Sessions survive restarts and are shared by all the worker processes of
+    the host. Files are written atomically and the expiry is tracked with
+    their modification time.
+
+    The directory is created readable by the current user only, and refused
+    when another user owns it or can write to it, since the sessions are
+    unpickled from its files.
+    """
+
+    directory = os.path.join(tempfile.gettempdir(), "spatz_sessions")
+    prefix = "spatz_session_"
+
+    @classmethod
+    def settings(cls, app):
+        settings = super().settings(app)
+        if app.config["SESSION_FILE_DIR"] is not None:
+            settings["directory"] = app.config["SESSION_FILE_DIR"]
+        private_directory(settings.get("directory", cls.directory))
+        return settings
+
+    def _path(self, session_key):
+        # session keys come from the cookie, never let them leave the directory
+        if not session_key or not _SESSION_KEY_CHARS.issuperset(session_key):
+            return None
+        return os.path.join(self.directory, self.prefix + session_key)
+
+    def _fetch(self, session_key, touch=True):
+        path = self._path(session_key)
+        if path is None:
+            return None
+        try:
+            modified = os.path.getmtime(path)
+            if modified + self.lifetime <= time.time():
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+            if not data:
+                # created by another worker which did not write it yet
+                return None
+            # push the expiry back once half of the lifetime is gone
+            if touch and modified + self.lifetime / 2 <= time.time():
+                os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _store(self, session_key, data, must_create):
+        path = self._path(session_key)
+        if must_create:
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+            except FileExistsError:
+                raise CreateError(session_key)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _remove(self, session_key):
+        path = self._path(session_key)
+        if path is None:
+            return
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def clear_expired(cls):
+        expired = time.time() - cls.lifetime
+        with os.scandir(cls.directory) as entries:
+            for entry in entries:
+                if not entry.name.startswith(cls.prefix):
+                    continue
+                try:
+                    if entry.stat().st_mtime <= expired:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+_SESSION_KEY_CHARS = frozenset(string.ascii_letters + string.digits + "-_")
+
+
+def get_session_backend(name):
+    """Returns the session class of a SESSION_BACKEND name.
+
+    :param name: "client", "locmem", "file" or "sql"
+    :type name: str
+    """
+    if name == "sql":
+        from .database import SQLSession
+
+        return SQLSession
+    return {"client": ClientSession, "locmem": LocMemSession, "file": FileSession}[name]
@@ -1,22 +1,26 @@
 import os
+import time
+import threading
+import asyncio
 import inspect
 from datetime import datetime, timedelta
+from types import MappingProxyType
 
 from werkzeug.routing import Map, Rule
-from werkzeug.wrappers import Request
-from werkzeug.exceptions import NotFound, HTTPException, MethodNotAllowed
-from parse import parse
-from requests import Session as RequestsSession
-from wsgiadapter import WSGIAdapter as RequestsWSGIAdapter
-from jinja2 import Environment, FileSystemLoader
-from whitenoise import WhiteNoise
-
-from sqlalchemy.ext.declarative import declarative_base
+from werkzeug.exceptions import HTTPException, MethodNotAllowed
+from werkzeug.http import is_resource_modified
 
 from .middleware import Middleware
 from .response import Response
-from .database import Database
+from .metrics import Metrics, DURATION_BUCKETS
 from .session import ClientSession
+from .cache import LocMemCache
+from .routing import DISPATCHERS
+from .asgi import ASGIHandler
+from .background import BackgroundTasks
+from .encoders import get_json_encoder
+from .timing import Timing, current_timings
+from .utils import run_awaitable
 
 
 class Spatz:
@@ -24,6 +28,9 @@ class Spatz:
     Including Jinga Template Engine, Whitenoise Static files management, SQLAlchemy ORM...
 
     You can replace the template engine or static files directory if you know well Jinga2 Template and whitenoise.
+
+    Requests are matched by a dispatcher compiled from the routes, pass ``dispatcher="werkzeug"``
+    to bind the werkzeug URL map on every request instead.
     """
 
     # the default configuration
@@ -38,67 +45,370 @@ class Spatz:
         "SESSION_COOKIE_SECURE": False,
         "SESSION_COOKIE_SAMESITE": None,
         "PERMANENT_SESSION_LIFETIME": timedelta(days=1),
+        "SESSION_REFRESH_EACH_REQUEST": True,
+        "SESSION_BACKEND": None,
+        "SESSION_SWEEP_INTERVAL": 3600,
+        "SESSION_LOCMEM_MAX_ENTRIES": 10000,
+        "SESSION_LOCMEM_MAX_BYTES": 64 * 1024 * 1024,
+        "SESSION_FILE_DIR": None,
+        "SESSION_SQL_TABLE": "spatz_sessions",
+        "CACHE_BACKEND": None,
+        "CACHE_MAX_ENTRIES": 1000,
+        "CACHE_MAX_BYTES": 64 * 1024 * 1024,
+        "CACHE_DIR": None,
+        "CACHE_VARY_HEADERS": ["Accept", "Accept-Encoding"],
+        "ASGI_THREAD_POOL_SIZE": None,
+        "AUTO_ETAG": False,
+        "JSON_ENCODER": "json",
+        "TEMPLATES_AUTO_RELOAD": None,
+        "TEMPLATES_BYTECODE_CACHE_DIR": None,
+        "COMPRESSION_LEVEL": 6,
+        "COMPRESSION_BROTLI_QUALITY": 4,
+        "COMPRESSION_MIN_SIZE": 500,
+        "DATABASE_POOL_SIZE": None,
+        "DATABASE_MAX_OVERFLOW": None,
+        "DATABASE_POOL_TIMEOUT": None,
+        "DATABASE_POOL_RECYCLE": None,
+        "DATABASE_POOL_PRE_PING": None,
+        "DATABASE_REPEATED_QUERY_THRESHOLD": 10,
+        "TIMING_HEADER": None,
+        "TIMING_SAMPLES": 1000,
+        "TIMING_PROFILE_RATE": 0.0,
+        "TIMING_PROFILE_THRESHOLD": 1.0,
+        "TIMING_PROFILE_DIR": None,
+        "TIMING_PROFILER": "cprofile",
+        "METRICS_PATH": "/metrics",
+        "METRICS_DIR": None,
+        "METRICS_BUCKETS": DURATION_BUCKETS,
+        "MAX_CONTENT_LENGTH": None,
+        "MAX_FORM_MEMORY_SIZE": None,
+        "BACKGROUND_EXECUTOR": "thread",
+        "BACKGROUND_WORKERS": 4,
+        "BACKGROUND_QUEUE_SIZE": 1000,
+        "BACKGROUND_QUEUE_TIMEOUT": None,
     }
 
-    def __init__(self, templates_dir="templates", static_dir="static"):
+    def __init__(self, templates_dir="templates", static_dir="static", dispatcher="compiled"):
 
         self.routes = Map()
+        self.registered_rules = set()
         self.handlers = {}
-
-        self.templates_env = Environment(
-            loader=FileSystemLoader(os.path.abspath(templates_dir))
-        )
+        self.dispatch_table = {}
+        self.endpoint_options = {}
+        self.has_async_handlers = False
+        self.dispatcher_class = DISPATCHERS[dispatcher]
+        self._dispatcher = None
+        self.frozen = False
+        # guards the registration of the routes and the lazy attributes
+        self._lock = threading.RLock()
+
+        self.templates_dir = os.path.abspath(templates_dir)
+        self._templates_env = None
         self.exception_handler = {}
-        self.whitenoise = WhiteNoise(
-            self.wsgi_app, root=static_dir, prefix="static/", max_age=31536000
-        )
+        self.static_dir = static_dir
+        self._whitenoise = None
+        self.timing = Timing(self)
         self.middleware = Middleware(self)
-        self.db = Database(self)
+        self.middleware.compile()
+        self._db = None
+        self.metrics = Metrics(self)
+        self.background = BackgroundTasks(self)
         self.config = self.default_config.copy()
 
         # session interface
         self.SessionInterface = ClientSession
 
         # cache interface
-        self.CacheInterface = None
+        self.CacheInterface = LocMemCache
+
+        # JSON encoder of the responses, created from the config on first use
+        self._json_encoder = None
+
+        # ASGI entry point
+        self.asgi = ASGIHandler(self)
 
     def __call__(self, environ, start_response):
         return self.whitenoise(environ, start_response)
 
+    @property
+    def whitenoise(self):
+        """The WhiteNoise application serving the static files, created on first use."""
+        if self._whitenoise is None:
+            from whitenoise import WhiteNoise
+
+            with self._lock:
+                if self._whitenoise is None:
+                    self._whitenoise = WhiteNoise(
+                        self.wsgi_app, root=self.static_dir, prefix="static/", max_age=31536000
+                    )
+        return self._whitenoise
+
+    @whitenoise.setter
+    def whitenoise(self, whitenoise):
+        self._whitenoise = whitenoise
+
+    @property
+    def json_encoder(self):
+        """The JSON encoder of the responses.
+
+        ``JSON_ENCODER`` names it: ``"json"``, the standard library, by
+        default, ``"orjson"``, ``"ujson"``, or ``"auto"`` for the fastest one
+        installed. The fast encoders do not produce the same output.
+        """
+        if self._json_encoder is None:
+            self._json_encoder = get_json_encoder(self.config["JSON_ENCODER"])
+        return self._json_encoder
+
+    @json_encoder.setter
+    def json_encoder(self, encoder):
+        self._json_encoder = encoder
+
+    @property
+    def db(self):
+        """The database of the application, SQLAlchemy is only imported on first use."""
+        if self._db is None:
+            from .database import Database
+
+            with self._lock:
+                if self._db is None:
+                    self._db = Database(self)
+        return self._db
+
     def wsgi_app(self, environ, start_response):
         return self.middleware(environ, start_response)
 
-    def add_route(self, rule, handler, endpoint=None, methods=["GET"]):
+    def add_route(
+        self,
+        rule,
+        handler,
+        endpoint=None,
+        methods=["GET"],
+        factory=None,
+        cache=None,
+        etag=None,
+        last_modified=None,
+    ):
         """Add a URL Rule.
 
+        Class-based handlers are instantiated once here and their methods are
+        reused for every request. Pass a ``factory`` to get a fresh instance
+        per request instead.
+
         :param url: the URL rule.
         :type url: str
-        :param handler: the function handling a request
+        :param handler: the function or the class handling a request
         :type handler: callable
         :param endpoint: the endpoint for registered URL rule, defaults to None
         :type endpoint: str, optional
         :param methods: allowed methods, defaults to ["GET"]
         :type methods: list, optional
+        :param factory: callable returning a class-based handler instance per request, defaults to None
+        :type factory: callable, optional
+        :param cache: seconds to cache the responses for, with the CacheMiddleware, defaults to None
+        :type cache: int, optional
+        :param etag: True to add an ETag computed over the body, False to never add one,
+            or a callable taking the request and the URL arguments and returning the ETag
+            before the handler runs, defaults to None which follows the AUTO_ETAG config
+        :type etag: bool or callable, optional
+        :param last_modified: callable taking the request and the URL arguments and returning
+            the last modification datetime before the handler runs, defaults to None
+        :type last_modified: callable, optional
         """
-
-        # check if the rule exists
-        for r in self.routes.iter_rules():
-            if rule == r.rule:
-                raise AssertionError("Such URL already exists.")
-
         if endpoint is None:
             endpoint = handler.__name__
 
+        with self._lock:
+            self._check_route(rule, handler, endpoint, self.registered_rules, self.handlers)
+            self._register_route(rule, handler, endpoint, methods, factory)
+            options = {"cache": cache, "etag": etag, "last_modified": last_modified}
+            options = {name: value for name, value in options.items() if value is not None}
+            if options:
+                self.endpoint_options.setdefault(endpoint, {}).update(options)
+            self._dispatcher = None
+
+    def add_routes(self, routes):
+        """Add many URL Rules at once.
+
+        All the rules are checked before any of them is added, and none of
+        them is kept if one fails to compile. The URL map is sorted and the
+        dispatcher compiled only once for the whole batch.
+
+        :param routes: ``(rule, handler)`` tuples, optionally followed by the endpoint and the methods
+        :type routes: iterable
+        """
+        with self._lock:
+            rules = set(self.registered_rules)
+            handlers = dict(self.handlers)
+            checked = []
+            for route in routes:
+                rule, handler, endpoint, methods = (tuple(route) + (None, None))[:4]
+                if endpoint is None:
+                    endpoint = handler.__name__
+                if methods is None:
+                    methods = ["GET"]
+
+                self._check_route(rule, handler, endpoint, rules, handlers)
+                rules.add(rule)
+                handlers[endpoint] = handler
+                checked.append((rule, handler, endpoint, methods))
+
+            state = (
+                {endpoint: dict(table) for endpoint, table in self.dispatch_table.items()},
+                set(self.registered_rules),
+                dict(self.handlers),
+                self.has_async_handlers,
+                list(self.routes.iter_rules()),
+            )
+            try:
+                for route in checked:
+                    self._register_route(*route)
+            except Exception:
+                self.dispatch_table, self.registered_rules, self.handlers, self.has_async_handlers, old = state
+                self.routes = Map([rule.empty() for rule in old])
+                raise
+            finally:
+                self._dispatcher = None
+
+    def _check_route(self, rule, handler, endpoint, rules, handlers):
+        if self.frozen:
+            raise AssertionError("Routes cannot be added once the application is frozen.")
+        if rule in rules:
+            raise AssertionError("Such URL already exists.")
+        if handlers.get(endpoint, handler) is not handler:
+            raise AssertionError("Such endpoint already exists.")
+
+    def _register_route(self, rule, handler, endpoint, methods, factory=None):
+        methods = list(methods)
+        table = self.dispatch_table.setdefault(endpoint, {})
+
         # class-based handler
         if inspect.isclass(handler):
-            for method in ["post", "put", "delete"]:
+            for method in ["post", "put", "patch", "delete", "options"]:
                 if hasattr(handler, method):
                     methods.append(method)
 
-        rule = Rule(rule, endpoint=endpoint, methods=methods)
+            rule = Rule(rule, endpoint=endpoint, methods=methods)
+            instance = handler() if factory is None else None
+            for method in rule.methods:
+                name = method.lower()
+                if name == "head" and not hasattr(handler, name):
+                    name = "get"
+                if not hasattr(handler, name):
+                    continue
+                if factory is None:
+                    table[method] = getattr(instance, name)
+                else:
+                    table[method] = _per_request_handler(factory, name, getattr(handler, name))
+        else:
+            rule = Rule(rule, endpoint=endpoint, methods=methods)
+            table.update(dict.fromkeys(rule.methods, handler))
+
+        self.has_async_handlers = self.has_async_handlers or any(
+            asyncio.iscoroutinefunction(method) for method in table.values()
+        )
+
         self.routes.add(rule)
+        self.registered_rules.add(rule.rule)
         self.handlers[endpoint] = handler
 
+    @property
+    def dispatcher(self):
+        """The dispatcher matching requests to endpoints.
+
+        It is compiled from the registered routes on first use and rebuilt
+        only when a route is added.
+        """
+        dispatcher = self._dispatcher
+        if dispatcher is None:
+            with self._lock:
+                if self._dispatcher is None:
+                    self._dispatcher = self.dispatcher_class(self.routes)
+                dispatcher = self._dispatcher
+        return dispatcher
+
+    @property
+    def templates_env(self):
+        """The Jinja environment of the templates.
+
+        It is created on first use from the config. Templates are checked for
+        changes on every render only when ``TEMPLATES_AUTO_RELOAD`` is set,
+        or by default in ``DEBUG``. With ``TEMPLATES_BYTECODE_CACHE_DIR``, the
+        compiled templates are cached in that directory, shared by the workers
+        and across restarts.
+        """
+        if self._templates_env is None:
+            with self._lock:
+                if self._templates_env is None:
+                    self._templates_env = self._create_templates_env()
+        return self._templates_env
+
+    @templates_env.setter
+    def templates_env(self, env):
+        self._templates_env = env
+
+    def _create_templates_env(self):
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+        auto_reload = self.config["TEMPLATES_AUTO_RELOAD"]
+        if auto_reload is None:
+            auto_reload = bool(self.config["DEBUG"])
+
+        bytecode_cache = None
+        cache_dir = self.config["TEMPLATES_BYTECODE_CACHE_DIR"]
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+        return Environment(
+            loader=FileSystemLoader(self.templates_dir),
+            auto_reload=auto_reload,
+            bytecode_cache=bytecode_cache,
+        )
+
+    def freeze(self):
+        """Stop accepting new routes and middlewares, e.g. once the application is started.
+
+        The dispatcher is compiled and the route tables become read-only, so
+        the threads of a threaded server share them without locking.
+        """
+        with self._lock:
+            if self.frozen:
+                return
+            self.frozen = True
+            self.dispatcher
+            self.registered_rules = frozenset(self.registered_rules)
+            self.handlers = MappingProxyType(self.handlers)
+            self.dispatch_table = MappingProxyType(
+                {endpoint: MappingProxyType(table) for endpoint, table in self.dispatch_table.items()}
+            )
+            self.endpoint_options = MappingProxyType(self.endpoint_options)
+
+    def warmup(self):
+        """Prepare the application before it serves requests.
+
+        The routes are frozen and the dispatcher compiled, the templates
+        compiled and the optional subsystems in use imported, so that
+        workers forked afterwards share them and the first requests do not
+        pay for them.
+        """
+        self.freeze()
+        self.middleware.compile()
+        self.whitenoise
+        if os.path.isdir(self.templates_dir):
+            self.precompile_templates()
+
+    def precompile_templates(self):
+        """Compile all the templates, e.g. when a worker boots.
+
+        :return: the names of the compiled templates
+        :rtype: list
+        """
+        env = self.templates_env
+        names = env.list_templates()
+        for name in names:
+            env.get_template(name)
+        return names
+
     def route(self, rule, **kwargs):
         def wrapper(handler):
             self.add_route(rule, handler, **kwargs)
@@ -106,39 +416,140 @@ class Spatz:
 
         return wrapper
 
+    @property
+    def is_async(self):
+        """True if a handler or a middleware is a coroutine."""
+        return self.has_async_handlers or self.middleware.is_async
+
+    def resolve(self, request):
+        """Return the handler and its keyword arguments for the request.
+
+        :raises werkzeug.exceptions.HTTPException: on 404, 405 or redirects
+        """
+        endpoint, kwargs = self.dispatcher.match(request)
+        request.endpoint = endpoint
+        methods = self.dispatch_table[endpoint]
+        handler = methods.get(request.method)
+        if handler is None:
+            raise MethodNotAllowed(valid_methods=list(methods))
+
+        return handler, kwargs
+
+    def not_modified(self, request, response, kwargs):
+        """Apply the conditional GET options of the endpoint to the response.
+
+        Returns True if the ETag or the last modification time given up front
+        by the route match the request, the response is then already a
+        ``304 Not Modified`` and the handler is skipped.
+        """
+        response.auto_etag = self.config["AUTO_ETAG"]
+        options = self.endpoint_options.get(request.endpoint)
+        if options is None:
+            return False
+
+        etag = options.get("etag")
+        last_modified = options.get("last_modified")
+        if isinstance(etag, bool):
+            response.auto_etag = etag
+            etag = None
+        if etag is None and last_modified is None:
+            return False
+
+        if etag is not None:
+            etag = etag(request, **kwargs)
+            response.set_etag(etag)
+        if last_modified is not None:
+            last_modified = last_modified(request, **kwargs)
+            response.last_modified = last_modified
+
+        # only the precondition is evaluated, the body is not filled in yet
+        if request.method not in ("GET", "HEAD") or is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified
+        ):
+            return False
+        response.status_code = 304
+        return True
+
     def handle_request(self, request):
         """Handle requests and dispatch the requests to view functions
 
         :param request: requests from clients
-        :type request: webob.Request
+        :type request: spatz.request.Request
         :return: responses from view functions
         :rtype: webob.Response
         """
         response = Response()
         response.render = self.render
+        response.json_encoder = self.json_encoder
 
-        urls = self.routes.bind_to_environ(request.environ)
+        timings = current_timings.get()
+        start = timings and time.perf_counter()
         try:
-            endpoints, kwargs = urls.match()
-            handler = self.handlers[endpoints]
+            handler, kwargs = self.resolve(request)
+            if timings:
+                start = timings.add("route", start)
+            if self.not_modified(request, response, kwargs):
+                return response
+            run_awaitable(handler(request, response, **kwargs))
+            if timings:
+                timings.add("handler", start)
+
+        except HTTPException as e:
+            return e
 
-            # class-based handler
-            if inspect.isclass(handler):
-                handler = getattr(handler(), request.method.lower(), None)
-            if not handler:
-                raise MethodNotAllowed()
+        return response
 
-            handler(request, response, **kwargs)
+    async def handle_request_async(self, request):
+        """Handle requests served over ASGI.
+
+        Coroutine handlers are awaited, the other handlers run on the thread pool.
+        """
+        response = Response()
+        response.render = self.render
+        response.json_encoder = self.json_encoder
+
+        timings = current_timings.get()
+        start = timings and time.perf_counter()
+        try:
+            handler, kwargs = self.resolve(request)
+            if timings:
+                start = timings.add("route", start)
+            if self.not_modified(request, response, kwargs):
+                return response
+            if asyncio.iscoroutinefunction(handler):
+                await handler(request, response, **kwargs)
+            else:
+                await self.asgi.run_sync(handler, request, response, **kwargs)
+            if timings:
+                timings.add("handler", start)
 
         except HTTPException as e:
             return e
 
         return response
 
-    def render(self, template_name, context=None):
+    def render(self, template_name, context=None, stream=False):
+        """Render a template.
+
+        :param template_name: the name of the template in the templates directory
+        :type template_name: str
+        :param context: the template variables, defaults to None
+        :type context: dict, optional
+        :param stream: return a generator of the rendered chunks, to be set as a streamed body, defaults to False
+        :type stream: bool, optional
+        """
         if context is None:
             context = {}
-        return self.templates_env.get_template(template_name).render(**context)
+        template = self.templates_env.get_template(template_name)
+        if stream:
+            return template.generate(**context)
+
+        timings = current_timings.get()
+        start = timings and time.perf_counter()
+        html = template.render(**context)
+        if timings:
+            timings.add("render", start)
+        return html
 
     def default_response(self, response):
         response.status_code = 404
@@ -147,9 +558,28 @@ class Spatz:
         return response
 
     def test_session(self, base_url="http://testserver"):
+        from requests import Session as RequestsSession
+        from wsgiadapter import WSGIAdapter as RequestsWSGIAdapter
+
         session = RequestsSession()
         session.mount(prefix=base_url, adapter=RequestsWSGIAdapter(self))
         return session
 
     def add_middleware(self, middleware_cls):
+        if self.frozen:
+            raise AssertionError("Middlewares cannot be added once the application is frozen.")
         self.middleware.add(middleware_cls)
+
+
+def _per_request_handler(factory, name, method):
+    if asyncio.iscoroutinefunction(method):
+
+        async def handler(request, response, **kwargs):
+            return await getattr(factory(), name)(request, response, **kwargs)
+
+    else:
+
+        def handler(request, response, **kwargs):
+            return getattr(factory(), name)(request, response, **kwargs)
+
+    return handler
@@ -0,0 +1,265 @@
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+# the timings of the request being handled
+current_timings = ContextVar("spatz_timings", default=None)
+
+
+class RequestTimings:
+    """The phases of a request and their durations in seconds.
+
+    Phases are recorded in the order they end, so nested phases, e.g. the
+    ``render`` phase inside the ``handler`` phase, come first.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.phases = []
+        self.start = time.perf_counter()
+        self.total = None
+        self.profile_path = None
+
+    def add(self, name, start):
+        """Record a phase started at ``start``, returns the time it ended."""
+        end = time.perf_counter()
+        self.phases.append((name, end - start))
+        return end
+
+    def header(self):
+        """The phases formatted as a ``Server-Timing`` header."""
+        entries = [f"{name};dur={duration * 1000:.3f}" for name, duration in self.phases]
+        if self.total is not None:
+            entries.append(f"total;dur={self.total * 1000:.3f}")
+        return ", ".join(entries)
+
+
+class EndpointTimings:
+    """Durations of the requests of an endpoint.
+
+    The last ``max_samples`` durations are kept to compute the percentiles.
+    """
+
+    def __init__(self, max_samples):
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=max_samples)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.samples.append(duration)
+
+    def percentile(self, percent):
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        index = max(0, -(-len(samples) * percent // 100) - 1)
+        return samples[int(index)]
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class Timing:
+    """Timings of the phases of the requests.
+
+    Once ``init_timing()`` is called, the route matching, each middleware
+    method, the handler, the template rendering, the serialization and the
+    session saving are timed. The timings are sent in a ``Server-Timing``
+    header if ``TIMING_HEADER`` is set, or by default in ``DEBUG`` only, as
+    they tell clients about the internals. They are passed to the listeners,
+    and the durations are aggregated per endpoint.
+
+    With ``TIMING_PROFILE_RATE`` above 0, that fraction of the WSGI requests
+    is profiled, and the profiles of the requests slower than
+    ``TIMING_PROFILE_THRESHOLD`` seconds are written to
+    ``TIMING_PROFILE_DIR``.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.enabled = False
+        self.listeners = []
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def init_timing(self):
+        """Start timing the requests."""
+        self.enabled = True
+        self.app.middleware.compile()
+
+    def add_listener(self, listener):
+        """Call ``listener(req, res, timings)`` after each request."""
+        self.listeners.append(listener)
+
+    def handle_request(self, handle_request, req):
+        timings = RequestTimings(req)
+        token = current_timings.set(timings)
+        profiler = self.start_profiler()
+        try:
+            res = handle_request(req)
+            self.finalize(res)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+            current_timings.reset(token)
+        self.finish(req, res, timings, profiler)
+        return res
+
+    async def handle_request_async(self, handle_request, req):
+        timings = RequestTimings(req)
+        token = current_timings.set(timings)
+        try:
+            res = await handle_request(req)
+            self.finalize(res)
+        finally:
+            current_timings.reset(token)
+        self.finish(req, res, timings)
+        return res
+
+    @staticmethod
+    def finalize(res):
+        # serialize the body while the request is timed
+        set_body_and_content_type = getattr(res, "set_body_and_content_type", None)
+        if set_body_and_content_type is not None:
+            set_body_and_content_type()
+
+    def finish(self, req, res, timings, profiler=None):
+        timings.total = time.perf_counter() - timings.start
+        endpoint = getattr(req, "endpoint", None)
+
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointTimings(
+                    self.app.config["TIMING_SAMPLES"]
+                )
+            stats.add(timings.total)
+
+        if profiler is not None and timings.total >= self.app.config["TIMING_PROFILE_THRESHOLD"]:
+            timings.profile_path = profiler.dump(self.profile_dir(), endpoint)
+
+        send_header = self.app.config["TIMING_HEADER"]
+        if send_header is None:
+            send_header = self.app.config["DEBUG"]
+        if send_header and hasattr(res, "headers"):
+            res.headers["Server-Timing"] = timings.header()
+
+        for listener in self.listeners:
+            listener(req, res, timings)
+
+    def start_profiler(self):
+        rate = self.app.config["TIMING_PROFILE_RATE"]
+        if not rate or random.random() >= rate:
+            return None
+        if self.app.config["TIMING_PROFILER"] == "pyinstrument":
+            profiler = PyinstrumentProfiler()
+        else:
+            profiler = CProfileProfiler()
+        profiler.start()
+        return profiler
+
+    def profile_dir(self):
+        directory = self.app.config["TIMING_PROFILE_DIR"]
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), "spatz_profiles")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def as_dict(self):
+        """Returns the count, the mean and the percentiles of the durations of each endpoint."""
+        with self.lock:
+            return {endpoint: stats.as_dict() for endpoint, stats in self.endpoints.items()}
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+
+class CProfileProfiler:
+    extension = "prof"
+
+    def __init__(self):
+        import cProfile
+
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, directory, endpoint):
+        path = _profile_path(directory, endpoint, self.extension)
+        self.profile.dump_stats(path)
+        return path
+
+
+class PyinstrumentProfiler:
+    extension = "html"
+
+    def __init__(self):
+        from pyinstrument import Profiler
+
+        self.profiler = Profiler()
+
+    def start(self):
+        self.profiler.start()
+
+    def stop(self):
+        self.profiler.stop()
+
+    def dump(self, directory, endpoint):
+        path = _profile_path(directory, endpoint, self.extension)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.profiler.output_html())
+        return path
+
+
+def _profile_path(directory, endpoint, extension):
+    endpoint = "".join(c if c.isalnum() or c in "-_." else "_" for c in str(endpoint))
+    name = f"{endpoint}-{time.time():.6f}-{os.getpid()}.{extension}"
+    return os.path.join(directory, name)
+
+
+def timed(hook, name):
+    """Wrap a middleware method so it is recorded as a phase of the request."""
+    if hook is None:
+        return None
+
+    if asyncio.iscoroutinefunction(hook):
+
+        async def async_wrapper(*args):
+            start = time.perf_counter()
+            try:
+                return await hook(*args)
+            finally:
+                timings = current_timings.get()
+                if timings is not None:
+                    timings.add(name, start)
+
+        return async_wrapper
+
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return hook(*args)
+        finally:
+            timings = current_timings.get()
+            if timings is not None:
+                timings.add(name, start)
+
+    return wrapper
@@ -0,0 +1,24 @@
+import asyncio
+import inspect
+
+
+def run_awaitable(result):
+    """Run the result to completion if it is awaitable and return its value.
+
+    Lets coroutine handlers and middleware methods work when the application
+    is served over WSGI.
+    """
+    if not inspect.isawaitable(result):
+        return result
+
+    async def wait():
+        return await result
+
+    return asyncio.run(wait())
+
+
+async def await_result(result):
+    """Await the result if it is awaitable and return its value."""
+    if inspect.isawaitable(result):
+        return await result
+    return result
@@ -0,0 +1,107 @@
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+
+
+class CreateError(Exception):
+    """Raised when a new entry cannot be stored because its key already exists."""
+
+
+def private_directory(path):
+    """Create a directory only the current user can access, or check an existing one.
+
+    The sessions and the cache unpickle the files of their directory, so a
+    directory another user owns or can write to must never be trusted.
+
+    :raises PermissionError: if the directory is owned by another user, or writable by others
+    :return: the path
+    :rtype: str
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"{path} is not a directory.")
+    if hasattr(os, "getuid") and info.st_uid != os.getuid():
+        raise PermissionError(f"{path} is owned by another user.")
+    if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"{path} is writable by other users.")
+    return path
+
+
+class LocMemStore:
+    """Thread-safe LRU store of ``bytes`` values with expiry times.
+
+    The least recently used entries are evicted once there are more than
+    ``max_entries`` entries or their data takes more than ``max_bytes``.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, lifetime=None):
+        """Returns the data under the key, or None if it is missing or expired.
+
+        A found entry becomes the most recently used one and, if a lifetime is
+        given, its expiry is pushed back by that lifetime.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires <= now:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            if lifetime is not None:
+                self._entries[key] = (now + lifetime, data)
+            return data
+
+    def contains(self, key):
+        return self.get(key) is not None
+
+    def set(self, key, data, lifetime, must_create=False):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if must_create and entry[0] > now:
+                    raise CreateError(key)
+                self._remove(key)
+            self._entries[key] = (now + lifetime, data)
+            self.size += len(data)
+            while self._entries and (
+                len(self._entries) > self.max_entries or self.size > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def clear_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (expires, _) in self._entries.items() if expires <= now]
+            for key in expired:
+                self._remove(key)
+        return len(expired)
+
+    def _remove(self, key):
+        self.size -= len(self._entries.pop(key)[1])
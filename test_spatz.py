@@ -1,10 +1,35 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import threading
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
 import pytest
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, event, literal, select
+from werkzeug.exceptions import Forbidden
+from werkzeug.test import EnvironBuilder
 
 from spatz import Spatz
 from spatz import Middleware, SessionMiddleware
 from spatz import Model
-from spatz import SessionBase, ClientSession
+from spatz import SessionBase, ClientSession, LocMemSession, FileSession, SQLSession
+from spatz.session import LocMemStore
+from spatz import CacheMiddleware, LocMemCache, FileCache
+from spatz import CompressionMiddleware
+from spatz.metrics import MmapValues
+from spatz.context import get_request, has_request, request as current_request
+from spatz import benchmark
+from spatz import Response
+from spatz.encoders import JSONEncoder, get_json_encoder
 
 
 FILE_DIR = "css"
@@ -19,6 +44,29 @@ def _create_static(static_dir):
     return asset
 
 
+async def _asgi_request(app, method="GET", path="/", body=b"", headers=()):
+    messages = []
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": b"",
+        "headers": [(b"host", b"testserver"), *headers],
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app.asgi(scope, receive, send)
+
+    start = messages[0]
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return start["status"], dict(start["headers"]), body
+
+
 # tests
 def test_basic_route_adding(app):
     @app.route("/home")
@@ -38,6 +86,69 @@ def test_route_overlap_throws_exception(app):
             resp.text = "Hello"
 
 
+def test_endpoint_overlap_throws_exception(app):
+    def home(req, resp):
+        resp.text = "Hello"
+
+    def other_home(req, resp):
+        resp.text = "Hello"
+
+    app.add_route("/home", home)
+    app.add_route("/index", home)
+
+    with pytest.raises(AssertionError):
+        app.add_route("/other", other_home, endpoint="home")
+
+
+def test_bulk_route_adding(app, client):
+    def home(req, resp):
+        resp.text = "home"
+
+    def about(req, resp):
+        resp.text = "about"
+
+    def contact(req, resp):
+        resp.text = "contact"
+
+    app.add_routes(
+        [("/home", home), ("/about", about, "about_page", ["GET"]), ("/contact", contact, "contact_page")]
+    )
+
+    assert client.get("http://testserver/home").text == "home"
+    assert client.get("http://testserver/about").text == "about"
+    assert client.get("http://testserver/contact").text == "contact"
+    assert "about_page" in app.handlers
+    assert client.post("http://testserver/contact").status_code == 405
+
+
+def test_bulk_route_overlap_adds_nothing(app):
+    def home(req, resp):
+        resp.text = "home"
+
+    with pytest.raises(AssertionError):
+        app.add_routes([("/home", home), ("/home", home)])
+
+    assert list(app.routes.iter_rules()) == []
+
+
+def test_bulk_route_failing_rule_adds_nothing(app, client):
+    def home(req, resp):
+        resp.text = "home"
+
+    def broken(req, resp):
+        resp.text = "broken"
+
+    app.add_route("/home", home)
+    with pytest.raises(LookupError):
+        app.add_routes([("/first", broken), ("/second/<unknown:value>", broken, "second")])
+
+    assert [rule.rule for rule in app.routes.iter_rules()] == ["/home"]
+    assert app.registered_rules == {"/home"}
+    assert set(app.handlers) == set(app.dispatch_table) == {"home"}
+    assert client.get("http://testserver/home").text == "home"
+    assert client.get("http://testserver/first").status_code == 404
+
+
 def test_spatz_test_client_send_requests(app, client):
     RESPONSE_TEXT = "Great Work"
 
@@ -57,6 +168,70 @@ def test_parameterized_route(app, client):
     assert client.get("http://testserver/ashley").text == "hello, ashley"
 
 
+def test_compiled_dispatcher_matches_like_werkzeug():
+    apps = [Spatz(dispatcher="compiled"), Spatz(dispatcher="werkzeug")]
+    responses = []
+
+    for app in apps:
+
+        @app.route("/users")
+        def users(req, resp):
+            resp.text = "users"
+
+        @app.route("/users/<int:user_id>")
+        def user(req, resp, user_id):
+            resp.text = f"user {user_id}"
+
+        @app.route("/<string:name>/profile")
+        def profile(req, resp, name):
+            resp.text = f"profile {name}"
+
+        @app.route("/folder/", methods=["GET"])
+        def folder(req, resp):
+            resp.text = "folder"
+
+        client = app.test_session()
+        responses.append(
+            [
+                (r.status_code, r.text)
+                for r in (
+                    client.get("http://testserver/users"),
+                    client.get("http://testserver/users/42"),
+                    client.get("http://testserver/users/john"),
+                    client.get("http://testserver/john/profile"),
+                    client.get("http://testserver/folder", allow_redirects=False),
+                    client.get("http://testserver/folder/"),
+                    client.post("http://testserver/folder/"),
+                    client.get("http://testserver/users/profile"),
+                    client.get("http://testserver/missing/page"),
+                )
+            ]
+        )
+
+    assert responses[0] == responses[1]
+    assert responses[0][1] == (200, "user 42")
+    assert responses[0][2][0] == 404
+    assert responses[0][3] == (200, "profile john")
+    assert responses[0][4][0] == 308
+    assert responses[0][6][0] == 405
+    assert responses[0][7] == (200, "profile users")
+    assert responses[0][8][0] == 404
+
+
+def test_dispatcher_is_rebuilt_when_routes_change(app, client):
+    @app.route("/first")
+    def first(req, resp):
+        resp.text = "first"
+
+    assert client.get("http://testserver/first").text == "first"
+
+    @app.route("/second")
+    def second(req, resp):
+        resp.text = "second"
+
+    assert client.get("http://testserver/second").text == "second"
+
+
 def test_default_404_response(client):
     response = client.get("http://testserver/doesnotexist")
 
@@ -94,6 +269,53 @@ def test_class_based_handler_not_allowed_method(app, client):
     assert client.get("http://testserver/book").status_code == 405
 
 
+def test_class_based_handler_instance_is_reused(app, client):
+    @app.route("/counter")
+    class CounterResource:
+        def __init__(self):
+            self.hits = 0
+
+        def get(self, req, resp):
+            self.hits += 1
+            resp.text = str(self.hits)
+
+    client.get("http://testserver/counter")
+
+    assert client.get("http://testserver/counter").text == "2"
+    assert client.head("http://testserver/counter").status_code == 200
+
+
+def test_class_based_handler_factory(app, client):
+    class CounterResource:
+        def __init__(self):
+            self.hits = 0
+
+        def get(self, req, resp):
+            self.hits += 1
+            resp.text = str(self.hits)
+
+    app.add_route("/counter", CounterResource, factory=CounterResource)
+    client.get("http://testserver/counter")
+
+    assert client.get("http://testserver/counter").text == "1"
+
+
+def test_class_based_handler_allowed_methods(app, client):
+    @app.route("/book")
+    class BookResource:
+        def post(self, req, resp):
+            resp.text = "created"
+
+        def patch(self, req, resp):
+            resp.text = "patched"
+
+    response = client.get("http://testserver/book")
+
+    assert response.status_code == 405
+    assert set(response.headers["Allow"].split(", ")) == {"PATCH", "POST"}
+    assert client.patch("http://testserver/book").text == "patched"
+
+
 def test_alternative_route(app, client):
     response_text = "haha"
 
@@ -178,6 +400,91 @@ def test_middleware_methods_are_called(app, client):
     assert process_response_called is True
 
 
+def test_middleware_order(app, client):
+    calls = []
+
+    def make_middleware(name):
+        class RecordingMiddleware(Middleware):
+            def process_request(self, req):
+                calls.append(f"{name} request")
+
+            def process_response(self, req, resp):
+                calls.append(f"{name} response")
+
+        return RecordingMiddleware
+
+    app.add_middleware(make_middleware("inner"))
+    app.add_middleware(make_middleware("outer"))
+
+    @app.route("/")
+    def index(req, res):
+        calls.append("handler")
+
+    client.get("http://testserver/")
+
+    assert calls == [
+        "outer request",
+        "inner request",
+        "handler",
+        "inner response",
+        "outer response",
+    ]
+
+
+def test_middleware_short_circuit(app, client):
+    calls = []
+
+    class InnerMiddleware(Middleware):
+        def process_request(self, req):
+            calls.append("inner request")
+
+        def process_response(self, req, resp):
+            calls.append("inner response")
+
+    class BlockingMiddleware(Middleware):
+        def process_request(self, req):
+            resp = Response()
+            resp.status_code = 403
+            resp.text = "Forbidden"
+            return resp
+
+        def process_response(self, req, resp):
+            calls.append("blocking response")
+
+    class OuterMiddleware(Middleware):
+        def process_response(self, req, resp):
+            calls.append("outer response")
+
+    app.add_middleware(InnerMiddleware)
+    app.add_middleware(BlockingMiddleware)
+    app.add_middleware(OuterMiddleware)
+
+    @app.route("/")
+    def index(req, res):
+        calls.append("handler")
+
+    response = client.get("http://testserver/")
+
+    assert response.status_code == 403
+    assert response.text == "Forbidden"
+    assert calls == ["blocking response", "outer response"]
+
+
+def test_middlewares_get_the_application(app, client):
+    class NoopMiddleware(Middleware):
+        def process_request(self, req):
+            pass
+
+    app.add_middleware(NoopMiddleware)
+    app.add_middleware(SessionMiddleware)
+
+    @app.route("/")
+    def index(req, res):
+        res.text = "ok"
+
+    assert client.get("http://testserver/").text == "ok"
+
+
 def test_allowed_methods_for_function_based_handlers(app, client):
     @app.route("/home", methods=["POST"])
     def home(req, resp):
@@ -199,6 +506,74 @@ def test_json_response_helper(app, client):
     assert json_body["name"] == "spatz"
 
 
+def test_json_response_helper_with_empty_body(app, client):
+    @app.route("/json")
+    def json_handler(req, resp):
+        resp.json = []
+
+    response = client.get("http://testserver/json")
+
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json() == []
+
+
+def test_json_stream_response(app, client):
+    @app.route("/rows")
+    def rows_handler(req, resp):
+        resp.json_stream = ({"id": i} for i in range(2500))
+
+    response = client.get("http://testserver/rows")
+
+    assert response.headers["Content-Type"] == "application/json"
+    assert "Content-Length" not in response.headers
+    assert response.json() == [{"id": i} for i in range(2500)]
+
+
+@pytest.mark.parametrize("name", ["json", "orjson", "ujson"])
+def test_json_encoders(name):
+    try:
+        encoder = get_json_encoder(name)
+    except ImportError:
+        pytest.skip(f"{name} is not installed")
+
+    data = {"name": "spatz", "items": [1, 2.5, None, True], "unicode": "Spätzle"}
+
+    assert isinstance(encoder.dumps(data), bytes)
+    assert json.loads(encoder.dumps(data)) == data
+    assert json.loads(b"".join(encoder.iter_dumps(iter([data] * 3), chunk_size=2))) == [data] * 3
+    assert b"".join(encoder.iter_dumps([])) == b"[]"
+
+
+def test_json_encoder_is_opt_in(app, client):
+    @app.route("/json")
+    def json_handler(req, resp):
+        resp.json = {"name": "spatz", "ids": [1, 2]}
+
+    assert type(app.json_encoder) is JSONEncoder
+    assert client.get("http://testserver/json").content == json.dumps({"name": "spatz", "ids": [1, 2]}).encode()
+
+    try:
+        encoder = get_json_encoder("orjson")
+    except ImportError:
+        pytest.skip("orjson is not installed")
+    # keys which are not strings fall back to the standard library
+    assert encoder.dumps({1: "one"}) == b'{"1": "one"}'
+
+
+def test_json_encoder_is_pluggable(app, client):
+    class UpperEncoder(JSONEncoder):
+        def dumps(self, obj):
+            return super().dumps(obj).upper()
+
+    app.json_encoder = UpperEncoder()
+
+    @app.route("/json")
+    def json_handler(req, resp):
+        resp.json = {"name": "spatz"}
+
+    assert client.get("http://testserver/json").json() == {"NAME": "SPATZ"}
+
+
 def test_html_response_helper(app, client):
     @app.route("/html")
     def html_handler(req, resp):
@@ -213,6 +588,58 @@ def test_html_response_helper(app, client):
     assert "Greatest Framework" in response.text
 
 
+def test_streaming_response(app, client):
+    @app.route("/export.csv")
+    def export(req, resp):
+        def rows():
+            yield "id,name\n"
+            for i in range(3):
+                yield f"{i},row {i}\n"
+
+        resp.content_type = "text/csv"
+        resp.stream = rows()
+
+    response = client.get("http://testserver/export.csv")
+
+    assert response.headers["Content-Type"] == "text/csv"
+    assert "Content-Length" not in response.headers
+    assert response.text == "id,name\n0,row 0\n1,row 1\n2,row 2\n"
+
+
+def test_async_streaming_response(app, client):
+    @app.route("/events")
+    async def events(req, resp):
+        async def chunks():
+            for i in range(3):
+                await asyncio.sleep(0)
+                yield f"event {i}\n"
+
+        resp.text = chunks()
+
+    expected = b"event 0\nevent 1\nevent 2\n"
+
+    assert client.get("http://testserver/events").content == expected
+    status, headers, body = asyncio.run(_asgi_request(app, path="/events"))
+    assert status == 200
+    assert b"content-length" not in headers
+    assert body == expected
+
+
+def test_streamed_template(app, client):
+    @app.route("/html")
+    def html_handler(req, resp):
+        resp.html = resp.render(
+            "index.html", context={"title": "Streamed", "name": "Spatz"}, stream=True
+        )
+
+    response = client.get("http://testserver/html")
+
+    assert "text/html" in response.headers["Content-Type"]
+    assert "Content-Length" not in response.headers
+    assert "Streamed" in response.text
+    assert asyncio.run(_asgi_request(app, path="/html"))[2] == response.content
+
+
 def test_text_response_helper(app, client):
     response_text = "Just Plain Text"
 
@@ -274,6 +701,65 @@ def test_database_schema(app, client):
     assert response.text == "John john@example.com"
 
 
+def test_model_bulk_helpers(app, tmp_path):
+    app.config["DATABASE_URI"] = f"sqlite:///{tmp_path / 'bulk.sqlite'}"
+
+    class Product(Model):
+        __tablename__ = "bulk_products"
+        id = Column(Integer, primary_key=True)
+        sku = Column(String(20), unique=True)
+        price = Column(Integer)
+
+    app.db.init_db()
+    session = app.db.session()
+    statements = []
+    event.listen(app.db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    rows = ({"id": i, "sku": f"sku-{i}", "price": i} for i in range(1, 251))
+    assert Product.bulk_insert(rows, chunk_size=100) == 250
+    session.commit()
+    # one statement per chunk
+    assert len([statement for statement in statements if statement.startswith("INSERT")]) == 3
+    assert session.query(Product).count() == 250
+
+    updated = [{"id": i, "sku": f"sku-{i}", "price": i * 10} for i in range(241, 261)]
+    assert Product.bulk_upsert(updated) == 20
+    session.commit()
+    assert session.query(Product).count() == 260
+    assert session.get(Product, 245).price == 2450
+    assert session.get(Product, 1).price == 1
+
+    # at most 30 parameters per statement, so 10 rows of 3 columns
+    statements.clear()
+    Product.bulk_max_parameters = 30
+    assert Product.bulk_upsert(updated) == 20
+    assert len([statement for statement in statements if statement.startswith("INSERT")]) == 2
+    del Product.bulk_max_parameters
+
+    # upserted by another unique column
+    Product.bulk_upsert([{"sku": "sku-1", "price": 7}], index_elements=["sku"])
+    session.commit()
+    assert session.get(Product, 1).price == 7
+
+    assert [product.id for product in Product.iter_all(batch_size=50)] == list(range(1, 261))
+    cheap = Product.query.filter(Product.price < 5).order_by(Product.id)
+    assert [product.id for product in Product.iter_all(cheap, batch_size=2)] == [2, 3, 4]
+
+    keys = []
+    page = Product.keyset_page(limit=100)
+    keys.extend(product.id for product in page.items)
+    while page.next_key is not None:
+        page = Product.keyset_page(after=page.next_key, limit=100)
+        keys.extend(product.id for product in page.items)
+    assert keys == list(range(1, 261))
+
+    page = Product.keyset_page(after="sku-97", limit=1, column=Product.sku)
+    assert [product.sku for product in page.items] == ["sku-98"]
+    assert page.next_key == "sku-98"
+    assert Product.keyset_page(after="sku-98", limit=1, column=Product.sku).next_key is None
+    app.db.session.remove()
+
+
 def test_base_session():
     session = SessionBase()
 
@@ -318,3 +804,1697 @@ def test_session_middleware(app, client):
     response = client.get("http://testserver/get-session", cookies=response.cookies)
 
     assert response.text == "value"
+
+
+def test_asgi_sync_handler(app):
+    @app.route("/hello/<name>")
+    def hello(req, resp, name):
+        resp.text = f"hello, {name}"
+
+    status, headers, body = asyncio.run(_asgi_request(app, path="/hello/john"))
+
+    assert status == 200
+    assert headers[b"content-type"].startswith(b"text/plain")
+    assert body == b"hello, john"
+
+
+def test_asgi_async_handler_and_middleware(app):
+    calls = []
+
+    class AsyncMiddleware(Middleware):
+        async def process_request(self, req):
+            calls.append("request")
+
+        async def process_response(self, req, resp):
+            calls.append("response")
+
+    app.add_middleware(AsyncMiddleware)
+
+    @app.route("/async", methods=["POST"])
+    async def async_handler(req, resp):
+        await asyncio.sleep(0)
+        resp.json = {"body": req.get_data(as_text=True)}
+
+    @app.route("/sync")
+    def sync_handler(req, resp):
+        resp.text = "sync"
+
+    status, _, body = asyncio.run(_asgi_request(app, "POST", "/async", body=b"data"))
+    assert status == 200
+    assert json.loads(body) == {"body": "data"}
+    assert calls == ["request", "response"]
+
+    assert asyncio.run(_asgi_request(app, path="/sync"))[2] == b"sync"
+    assert asyncio.run(_asgi_request(app, path="/missing"))[0] == 404
+
+
+def test_asgi_serves_concurrent_slow_requests(app):
+    @app.route("/slow")
+    async def slow(req, resp):
+        await asyncio.sleep(0.2)
+        resp.text = "done"
+
+    async def many():
+        return await asyncio.gather(*(_asgi_request(app, path="/slow") for _ in range(100)))
+
+    start = time.perf_counter()
+    results = asyncio.run(many())
+
+    assert time.perf_counter() - start < 2
+    assert all(body == b"done" for _, _, body in results)
+
+
+def test_async_handler_under_wsgi(app, client):
+    @app.route("/async")
+    async def async_handler(req, resp):
+        resp.text = "async"
+
+    assert client.get("http://testserver/async").text == "async"
+
+
+def test_session_is_loaded_lazily():
+    session = ClientSession()
+    session["key"] = "value"
+    session.save()
+
+    loads = []
+
+    class CountingSession(ClientSession):
+        def load(self):
+            loads.append(self.session_key)
+            return super().load()
+
+    session2 = CountingSession(session_key=session.session_key)
+    assert loads == []
+    assert session2["key"] == "value"
+    assert session2.get("key") == "value"
+    assert len(loads) == 1
+
+
+def test_session_middleware_skips_untouched_session(app, client):
+    app.add_middleware(SessionMiddleware)
+
+    @app.route("/set-session")
+    def set_session(req, res):
+        req.session["key"] = "value"
+
+    @app.route("/get-session")
+    def get_session(req, res):
+        res.text = req.session["key"]
+
+    @app.route("/no-session")
+    def no_session(req, res):
+        res.text = "no session"
+
+    cookies = client.get("http://testserver/set-session").cookies
+
+    response = client.get("http://testserver/no-session", cookies=cookies)
+    assert "Set-Cookie" not in response.headers
+
+    response = client.get("http://testserver/get-session", cookies=cookies)
+    assert response.text == "value"
+    assert response.cookies["session"] == cookies["session"]
+
+    app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+    response = client.get("http://testserver/get-session", cookies=cookies)
+    assert "Set-Cookie" not in response.headers
+
+
+def test_session_middleware_deletes_cleared_session(app, client):
+    app.add_middleware(SessionMiddleware)
+
+    @app.route("/set-session")
+    def set_session(req, res):
+        req.session["key"] = "value"
+
+    @app.route("/clear-session")
+    def clear_session(req, res):
+        req.session.clear()
+
+    cookies = client.get("http://testserver/set-session").cookies
+    response = client.get("http://testserver/clear-session", cookies=cookies)
+
+    assert "session=;" in response.headers["Set-Cookie"]
+
+
+def test_session_middleware_with_http_exception(app, client):
+    app.config["SESSION_BACKEND"] = "locmem"
+    app.add_middleware(SessionMiddleware)
+
+    @app.route("/login")
+    def login(req, res):
+        req.session["user"] = "alice"
+
+    @app.route("/forbidden")
+    def forbidden(req, res):
+        req.session["attempts"] = 1
+        raise Forbidden()
+
+    @app.route("/logout")
+    def logout(req, res):
+        req.session.clear()
+        raise Forbidden()
+
+    cookies = client.get("http://testserver/login").cookies
+    client.cookies.clear()
+    for path in ("/forbidden", "/logout"):
+        response = client.get(f"http://testserver{path}", cookies=cookies)
+        client.cookies.clear()
+        assert response.status_code == 403
+        assert "Set-Cookie" not in response.headers
+
+
+def _locmem_session_class(lifetime=60, max_entries=100, max_bytes=1024 * 1024):
+    return type(
+        "TestLocMemSession",
+        (LocMemSession,),
+        {"lifetime": lifetime, "store": LocMemStore(max_entries, max_bytes)},
+    )
+
+
+def test_locmem_session():
+    Session = _locmem_session_class()
+    session = Session()
+    session["key"] = "value"
+    session.save()
+
+    assert session.session_key is not None
+    assert Session().exists(session.session_key)
+
+    session2 = Session(session_key=session.session_key)
+    assert session2["key"] == "value"
+
+    session2["key"] = "changed"
+    assert Session(session_key=session.session_key)["key"] == "value"
+
+    session2.delete()
+    assert Session(session_key=session.session_key).get("key") is None
+
+
+def test_locmem_session_unknown_key_gets_a_new_key():
+    Session = _locmem_session_class()
+    session = Session(session_key="forged")
+
+    assert session.get("key") is None
+    session["key"] = "value"
+    session.save()
+
+    assert session.session_key not in (None, "forged")
+
+
+def test_locmem_session_cycle_key():
+    Session = _locmem_session_class()
+    session = Session()
+    session["key"] = "value"
+    session.save()
+    old_key = session.session_key
+
+    session.cycle_key()
+
+    assert session.session_key != old_key
+    assert not Session().exists(old_key)
+    assert Session(session_key=session.session_key)["key"] == "value"
+
+
+def test_locmem_session_eviction():
+    Session = _locmem_session_class(max_entries=3)
+    keys = []
+    for i in range(5):
+        session = Session()
+        session["i"] = i
+        session.save()
+        keys.append(session.session_key)
+
+    assert len(Session.store) == 3
+    assert not Session().exists(keys[0])
+    assert Session().exists(keys[4])
+
+    Session = _locmem_session_class(max_bytes=1000)
+    for i in range(5):
+        session = Session()
+        session["data"] = "x" * 400
+        session.save()
+
+    assert Session.store.size <= 1000
+    assert len(Session.store) == 2
+
+
+def test_locmem_session_expiry():
+    Session = _locmem_session_class(lifetime=0.05)
+    session = Session()
+    session["key"] = "value"
+    session.save()
+
+    time.sleep(0.1)
+    Session.clear_expired()
+
+    assert len(Session.store) == 0
+    assert Session(session_key=session.session_key).get("key") is None
+
+
+def test_locmem_session_middleware(app, client):
+    app.SessionInterface = LocMemSession
+    app.add_middleware(SessionMiddleware)
+
+    @app.route("/set-session")
+    def set_session(req, res):
+        req.session["key"] = "value"
+
+    @app.route("/get-session")
+    def get_session(req, res):
+        res.text = req.session["key"]
+
+    response = client.get("http://testserver/set-session")
+    session_key = response.cookies["session"]
+
+    assert len(session_key) < 64
+    response = client.get("http://testserver/get-session", cookies=response.cookies)
+    assert response.text == "value"
+    assert response.cookies["session"] == session_key
+
+
+def _session_round_trip(Session):
+    session = Session()
+    session["key"] = "value"
+    session.save()
+    session_key = session.session_key
+
+    assert Session().exists(session_key)
+    assert Session(session_key=session_key)["key"] == "value"
+
+    session = Session(session_key=session_key)
+    session["key"] = "changed"
+    session.save()
+    assert session.session_key == session_key
+    assert Session(session_key=session_key)["key"] == "changed"
+
+    session.delete()
+    assert not Session().exists(session_key)
+    assert Session(session_key=session_key).get("key") is None
+
+
+def test_file_session(app, tmp_path):
+    app.config["SESSION_FILE_DIR"] = str(tmp_path)
+    Session = FileSession.configure(app)
+
+    _session_round_trip(Session)
+
+    session = Session(session_key="../../etc/passwd")
+    assert session.get("key") is None
+    session["key"] = "value"
+    session.save()
+    assert session.session_key != "../../etc/passwd"
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_file_session_refuses_unsafe_directory(app, tmp_path):
+    app.config["SESSION_FILE_DIR"] = str(tmp_path / "sessions")
+    FileSession.configure(app)
+    assert (tmp_path / "sessions").stat().st_mode & 0o777 == 0o700
+
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    app.config["SESSION_FILE_DIR"] = str(shared)
+    with pytest.raises(PermissionError):
+        FileSession.configure(app)
+
+
+def test_file_session_clear_expired(app, tmp_path):
+    app.config["SESSION_FILE_DIR"] = str(tmp_path)
+    app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(seconds=60)
+    Session = FileSession.configure(app)
+
+    keys = []
+    for i in range(3):
+        session = Session()
+        session["i"] = i
+        session.save()
+        keys.append(session.session_key)
+
+    old = time.time() - 120
+    os.utime(tmp_path / (Session.prefix + keys[0]), (old, old))
+
+    assert Session(session_key=keys[0]).get("i") is None
+    Session.clear_expired()
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_sql_session(app, tmp_path):
+    app.config["DATABASE_URI"] = f"sqlite:///{tmp_path / 'sessions.sqlite'}"
+    app.db.init_db()
+    Session = SQLSession.configure(app)
+
+    _session_round_trip(Session)
+
+
+def test_sql_session_clear_expired(app, tmp_path):
+    app.config["DATABASE_URI"] = f"sqlite:///{tmp_path / 'sessions.sqlite'}"
+    app.db.init_db()
+    Session = SQLSession.configure(app)
+    Session.sweep_batch_size = 2
+
+    for i in range(6):
+        session = Session()
+        session["i"] = i
+        session.save()
+
+    with Session.engine.begin() as conn:
+        conn.execute(
+            Session.table.update().values(expires=datetime.utcnow() - timedelta(seconds=1))
+        )
+        conn.execute(
+            Session.table.update()
+            .where(Session.table.c.session_key == session.session_key)
+            .values(expires=datetime.utcnow() + timedelta(seconds=60))
+        )
+
+    Session.clear_expired()
+
+    with Session.engine.connect() as conn:
+        rows = conn.execute(Session.table.select()).fetchall()
+    assert [row.session_key for row in rows] == [session.session_key]
+
+
+def test_sql_session_requires_database(app):
+    with pytest.raises(RuntimeError):
+        SQLSession.configure(app)
+
+
+@pytest.mark.parametrize("backend", ["locmem", "file", "sql"])
+def test_session_backend_from_config(app, client, tmp_path, backend):
+    app.config["SESSION_BACKEND"] = backend
+    app.config["SESSION_FILE_DIR"] = str(tmp_path / "sessions")
+    if backend == "sql":
+        app.config["DATABASE_URI"] = f"sqlite:///{tmp_path / 'sessions.sqlite'}"
+        app.db.init_db()
+    app.add_middleware(SessionMiddleware)
+
+    @app.route("/set-session")
+    def set_session(req, res):
+        req.session["key"] = "value"
+
+    @app.route("/get-session")
+    def get_session(req, res):
+        res.text = req.session["key"]
+
+    response = client.get("http://testserver/set-session")
+    response = client.get("http://testserver/get-session", cookies=response.cookies)
+
+    assert response.text == "value"
+
+
+@pytest.mark.parametrize("backend", [None, "locmem", "file", "sql"])
+def test_session_first_visit_reads_session(app, client, tmp_path, backend):
+    app.config["SESSION_BACKEND"] = backend
+    app.config["SESSION_FILE_DIR"] = str(tmp_path / "sessions")
+    if backend == "sql":
+        app.config["DATABASE_URI"] = f"sqlite:///{tmp_path / 'sessions.sqlite'}"
+        app.db.init_db()
+    app.add_middleware(SessionMiddleware)
+
+    @app.route("/get-session")
+    def get_session(req, res):
+        res.text = str(req.session.get("user_id"))
+
+    response = client.get("http://testserver/get-session")
+    assert response.status_code == 200
+    assert response.text == "None"
+    assert "Set-Cookie" not in response.headers
+
+    # an unknown or expired key is not sent back either
+    response = client.get("http://testserver/get-session", cookies={"session": "unknown"})
+    assert response.status_code == 200
+    assert response.text == "None"
+    if backend is not None:
+        assert "Set-Cookie" not in response.headers
+
+
+def test_response_cache(app, client):
+    app.add_middleware(CacheMiddleware)
+    calls = []
+
+    @app.route("/cached/<int:item_id>", cache=60)
+    def cached(req, resp, item_id):
+        calls.append(item_id)
+        resp.json = {"item": item_id, "calls": len(calls)}
+
+    @app.route("/uncached")
+    def uncached(req, resp):
+        calls.append("uncached")
+        resp.text = "uncached"
+
+    first = client.get("http://testserver/cached/1")
+    second = client.get("http://testserver/cached/1")
+
+    assert first.json() == second.json() == {"item": 1, "calls": 1}
+    assert second.headers["Content-Type"] == "application/json"
+    assert calls == [1]
+
+    client.get("http://testserver/cached/1?page=2")
+    client.get("http://testserver/cached/1", headers={"Accept": "text/html"})
+    client.post("http://testserver/cached/1")
+    assert calls == [1, 1, 1]
+
+    client.get("http://testserver/uncached")
+    client.get("http://testserver/uncached")
+    assert calls == [1, 1, 1, "uncached", "uncached"]
+
+    app.cache.clear()
+    client.get("http://testserver/cached/1")
+    assert calls == [1, 1, 1, "uncached", "uncached", 1]
+
+
+def test_response_cache_keys_on_host_and_skips_sessions(app, client):
+    app.add_middleware(SessionMiddleware)
+    app.add_middleware(CacheMiddleware)
+
+    @app.route("/whoami", cache=60)
+    def whoami(req, resp):
+        resp.text = f"{req.host} {req.session.get('user', 'anonymous')}"
+
+    @app.route("/login")
+    def login(req, resp):
+        req.session["user"] = "alice"
+
+    def get(path, host, **kwargs):
+        return client.get(f"http://testserver{path}", headers={"Host": host}, **kwargs)
+
+    assert get("/whoami", "one.example").text == "one.example anonymous"
+    assert get("/whoami", "two.example").text == "two.example anonymous"
+
+    cookies = get("/login", "one.example").cookies
+    assert get("/whoami", "one.example", cookies=cookies).text == "one.example alice"
+    client.cookies.clear()
+    assert get("/whoami", "one.example").text == "one.example anonymous"
+
+
+def test_response_cache_skips_authorized_requests(app, client):
+    app.add_middleware(CacheMiddleware)
+
+    @app.route("/whoami", cache=60)
+    def whoami(req, resp):
+        resp.text = req.headers.get("Authorization", "anonymous")
+
+    def get(**headers):
+        return client.get("http://testserver/whoami", headers=headers).text
+
+    assert get(Authorization="Bearer alice") == "Bearer alice"
+    assert get(Authorization="Bearer bob") == "Bearer bob"
+    assert get() == "anonymous"
+    assert get(Authorization="Bearer alice") == "Bearer alice"
+
+
+def test_file_cache_refuses_unsafe_directory(tmp_path):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    with pytest.raises(PermissionError):
+        FileCache(str(shared))
+
+
+def test_response_cache_skips_private_responses(app, client):
+    app.add_middleware(CacheMiddleware)
+    calls = []
+
+    @app.route("/cookie", cache=60)
+    def cookie(req, resp):
+        calls.append("cookie")
+        resp.set_cookie("name", "value")
+
+    @app.route("/vary", cache=60)
+    def vary(req, resp):
+        calls.append("vary")
+        resp.vary.add("Authorization")
+
+    @app.route("/error", cache=60)
+    def error(req, resp):
+        calls.append("error")
+        resp.status_code = 500
+
+    for _ in range(2):
+        for path in ("cookie", "vary", "error"):
+            client.get(f"http://testserver/{path}")
+
+    assert calls == ["cookie", "vary", "error"] * 2
+
+
+@pytest.mark.parametrize("cache_cls", [LocMemCache, FileCache])
+def test_cache_backends(tmp_path, cache_cls):
+    cache = cache_cls() if cache_cls is LocMemCache else cache_cls(str(tmp_path))
+
+    cache.set("key", {"value": 1}, 60)
+    assert cache.get("key") == {"value": 1}
+    assert cache.get("missing", "default") == "default"
+
+    cache.set("expired", "value", -1)
+    assert cache.get("expired") is None
+
+    cache.delete("key")
+    assert cache.get("key") is None
+
+    cache.set("key", "value", 60)
+    cache.clear()
+    assert cache.get("key") is None
+
+
+def test_file_cache_is_shared_and_culled(tmp_path):
+    cache = FileCache(str(tmp_path), max_entries=3, cull_interval=0)
+    other = FileCache(str(tmp_path))
+
+    for i in range(5):
+        cache.set(f"key{i}", i, 60 + i)
+
+    assert other.get("key4") == 4
+    assert len(list(tmp_path.iterdir())) == 3
+    assert other.get("key0") is None
+
+
+def test_locmem_cache_evicts_by_size():
+    cache = LocMemCache(max_bytes=2000)
+    for i in range(5):
+        cache.set(f"key{i}", "x" * 600, 60)
+
+    assert cache.store.size <= 2000
+    assert cache.get("key0") is None
+    assert cache.get("key4") == "x" * 600
+
+
+def test_auto_etag_answers_not_modified(app, client):
+    app.config["AUTO_ETAG"] = True
+
+    @app.route("/etag")
+    def etag(req, resp):
+        resp.text = "cacheable"
+
+    @app.route("/stream")
+    def stream(req, resp):
+        resp.stream = iter([b"a", b"b"])
+
+    response = client.get("http://testserver/etag")
+    etag = response.headers["ETag"]
+    assert etag
+
+    response = client.get("http://testserver/etag", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    response = client.get("http://testserver/etag", headers={"If-None-Match": '"other"'})
+    assert response.status_code == 200
+    assert response.text == "cacheable"
+
+    assert "ETag" not in client.get("http://testserver/stream").headers
+
+
+def test_route_etag_option(app, client):
+    @app.route("/etag", etag=True)
+    def etag(req, resp):
+        resp.json = {"name": "spatz"}
+
+    @app.route("/plain")
+    def plain(req, resp):
+        resp.text = "plain"
+
+    etag = client.get("http://testserver/etag").headers["ETag"]
+    response = client.get("http://testserver/etag", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert "ETag" not in client.get("http://testserver/plain").headers
+
+
+def test_etag_up_front_skips_handler(app, client):
+    calls = []
+
+    @app.route("/items/<int:id>", etag=lambda req, id: f"item-{id}-v1")
+    def item(req, resp, id):
+        calls.append(id)
+        resp.json = {"id": id}
+
+    response = client.get("http://testserver/items/1")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"item-1-v1"'
+    assert calls == [1]
+
+    response = client.get("http://testserver/items/1", headers={"If-None-Match": '"item-1-v1"'})
+    assert response.status_code == 304
+    assert calls == [1]
+
+    response = client.get("http://testserver/items/2", headers={"If-None-Match": '"item-1-v1"'})
+    assert response.status_code == 200
+    assert calls == [1, 2]
+
+
+def test_etag_up_front_with_streamed_body(app):
+    @app.route("/events", etag=lambda req: "events-v1")
+    def events(req, resp):
+        resp.stream = (f"event {i}\n" for i in range(3))
+
+    @app.route("/rows", etag=lambda req: "rows-v1")
+    def rows(req, resp):
+        resp.json_stream = iter([{"id": 1}, {"id": 2}])
+
+    for path, body in [("/events", b"event 0\nevent 1\nevent 2\n"), ("/rows", b'[{"id": 1},{"id": 2}]')]:
+        environ = EnvironBuilder(path=path).get_environ()
+        started = []
+        chunks = app(environ, lambda status, headers, exc_info=None: started.append((status, dict(headers))))
+        assert b"".join(chunks) == body
+        status, headers = started[0]
+        assert status == "200 OK"
+        assert "Content-Length" not in headers
+        assert headers["ETag"] == f'"{path[1:]}-v1"'
+
+    environ = EnvironBuilder(path="/events", headers={"If-None-Match": '"events-v1"'}).get_environ()
+    started = []
+    assert b"".join(app(environ, lambda status, headers, exc_info=None: started.append(status))) == b""
+    assert started == ["304 NOT MODIFIED"]
+
+
+def test_last_modified_up_front(app, client):
+    updated = datetime(2020, 1, 1)
+    calls = []
+
+    @app.route("/page", last_modified=lambda req: updated)
+    def page(req, resp):
+        calls.append(1)
+        resp.text = "page"
+
+    response = client.get("http://testserver/page")
+    assert response.headers["Last-Modified"] == "Wed, 01 Jan 2020 00:00:00 GMT"
+
+    response = client.get(
+        "http://testserver/page", headers={"If-Modified-Since": "Thu, 02 Jan 2020 00:00:00 GMT"}
+    )
+    assert response.status_code == 304
+    assert len(calls) == 1
+
+    response = client.get(
+        "http://testserver/page", headers={"If-Modified-Since": "Tue, 31 Dec 2019 00:00:00 GMT"}
+    )
+    assert response.status_code == 200
+    assert len(calls) == 2
+
+
+def test_conditional_post_is_unaffected(app, client):
+    app.config["AUTO_ETAG"] = True
+
+    @app.route("/submit", methods=["POST"])
+    def submit(req, resp):
+        resp.text = "done"
+
+    response = client.post("http://testserver/submit", headers={"If-None-Match": "*"})
+    assert response.status_code == 200
+    assert response.text == "done"
+
+
+def test_templates_env_follows_config(app, tmp_path):
+    app.config["DEBUG"] = True
+    assert app.templates_env.auto_reload is True
+    assert app.templates_env.bytecode_cache is None
+
+    production = Spatz(templates_dir=str(tmp_path))
+    production.config["TEMPLATES_BYTECODE_CACHE_DIR"] = str(tmp_path / "cache")
+    assert production.templates_env.auto_reload is False
+    assert production.templates_env.bytecode_cache is not None
+
+
+def test_precompile_templates_fills_bytecode_cache(tmp_path):
+    templates = tmp_path / "templates"
+    (templates / "partials").mkdir(parents=True)
+    (templates / "index.html").write_text("<h1>{{ title }}</h1>")
+    (templates / "partials" / "item.html").write_text("<li>{{ item }}</li>")
+    cache_dir = tmp_path / "cache"
+
+    app = Spatz(templates_dir=str(templates))
+    app.config["TEMPLATES_BYTECODE_CACHE_DIR"] = str(cache_dir)
+
+    assert sorted(app.precompile_templates()) == ["index.html", "partials/item.html"]
+    assert len(list(cache_dir.iterdir())) == 2
+
+    worker = Spatz(templates_dir=str(templates))
+    worker.config["TEMPLATES_BYTECODE_CACHE_DIR"] = str(cache_dir)
+    assert worker.render("index.html", {"title": "cached"}) == "<h1>cached</h1>"
+
+
+def test_compression_negotiates_gzip(app, client):
+    app.add_middleware(CompressionMiddleware)
+    body = {"items": [{"id": i, "name": "spatz"} for i in range(100)]}
+
+    @app.route("/items")
+    def items(req, resp):
+        resp.json = body
+
+    @app.route("/small")
+    def small(req, resp):
+        resp.text = "tiny"
+
+    @app.route("/image")
+    def image(req, resp):
+        resp.stream = b"\x89PNG" + b"\x00" * 2000
+        resp.content_type = "image/png"
+
+    response = client.get("http://testserver/items", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert int(response.headers["Content-Length"]) < len(json.dumps(body))
+    assert json.loads(zlib.decompress(response.content, 16 + zlib.MAX_WBITS)) == body
+
+    response = client.get("http://testserver/items", headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+
+    response = client.get("http://testserver/small", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+    response = client.get("http://testserver/image", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_compression_streams_chunks(app):
+    app.add_middleware(CompressionMiddleware)
+
+    @app.route("/rows")
+    def rows(req, resp):
+        resp.stream = (f"row {i}\n" for i in range(3))
+        resp.content_type = "text/plain"
+
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["headers"] = dict(headers)
+
+    environ = EnvironBuilder(path="/rows", headers={"Accept-Encoding": "gzip"}).get_environ()
+    chunks = list(app(environ, start_response))
+
+    assert started["headers"]["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in started["headers"]
+    assert len(chunks) == 4
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(chunks[0]) == b"row 0\n"
+    assert decompressor.decompress(b"".join(chunks[1:])) == b"row 1\nrow 2\n"
+
+
+def test_compression_keeps_etag_conditional(app, client):
+    app.config["AUTO_ETAG"] = True
+    app.add_middleware(CompressionMiddleware)
+
+    @app.route("/page")
+    def page(req, resp):
+        resp.html = "<p>spatz</p>" * 100
+
+    etag = client.get("http://testserver/page", headers={"Accept-Encoding": "gzip"}).headers["ETag"]
+    assert etag.startswith("W/")
+
+    response = client.get(
+        "http://testserver/page", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+
+def test_compression_of_async_stream_over_asgi(app):
+    app.add_middleware(CompressionMiddleware)
+
+    @app.route("/events")
+    async def events(req, resp):
+        async def generate():
+            for i in range(3):
+                yield f"event {i}\n"
+
+        resp.stream = generate()
+        resp.content_type = "text/plain"
+
+    status, headers, body = asyncio.run(
+        _asgi_request(app, path="/events", headers=[(b"accept-encoding", b"gzip")])
+    )
+    assert headers[b"content-encoding"] == b"gzip"
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == b"event 0\nevent 1\nevent 2\n"
+
+
+def test_middleware_overriding_handle_request_is_refused(app):
+    class WrappingMiddleware(Middleware):
+        def handle_request(self, req):
+            return super().handle_request(req)
+
+    with pytest.raises(AssertionError):
+        app.add_middleware(WrappingMiddleware)
+
+    app.add_middleware(SessionMiddleware)
+    # only the root middleware compiles the pipeline
+    assert not hasattr(app.middleware.middlewares[0], "request_hooks")
+
+
+def test_middleware_process_exception(app, client):
+    calls = []
+
+    class Recover(Middleware):
+        def process_exception(self, req, exc):
+            calls.append(("recover", type(exc).__name__))
+            return Response("recovered", status=500)
+
+        def process_response(self, req, res):
+            calls.append("recover response")
+
+    class Inner(Middleware):
+        def process_exception(self, req, exc):
+            calls.append(("inner", type(exc).__name__))
+
+    app.add_middleware(Inner)
+    app.add_middleware(Recover)
+
+    @app.route("/boom")
+    def boom(req, resp):
+        raise ValueError("boom")
+
+    response = client.get("http://testserver/boom")
+    assert response.status_code == 500
+    assert response.text == "recovered"
+    assert calls == [("inner", "ValueError"), ("recover", "ValueError"), "recover response"]
+
+
+def test_middleware_exception_is_raised_when_unhandled(app, client):
+    class Observe(Middleware):
+        def process_exception(self, req, exc):
+            req.seen = exc
+
+    app.add_middleware(Observe)
+
+    @app.route("/boom")
+    def boom(req, resp):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        client.get("http://testserver/boom")
+
+
+def test_database_pool_options_and_lazy_session(app, client, tmp_path):
+    app.config["DATABASE_URI"] = "sqlite://"
+    app.config["DATABASE_POOL_SIZE"] = 3
+    app.config["DATABASE_POOL_PRE_PING"] = True
+    app.db.init_db()
+
+    assert app.db.engine.pool.size == 3
+    assert app.db.engine.pool._pre_ping is True
+    app.db.pool_stats.reset()
+
+    @app.route("/static-page")
+    def static_page(req, resp):
+        resp.text = "no database"
+
+    @app.route("/count")
+    def count(req, resp):
+        resp.text = str(req.db_session.execute(select(literal(1))).scalar())
+
+    @app.route("/boom")
+    def boom(req, resp):
+        req.db_session.execute(select(literal(1)))
+        raise ValueError("boom")
+
+    client.get("http://testserver/static-page")
+    assert not app.db.session.registry.has()
+    assert app.db.pool_stats.checkouts == 0
+
+    assert client.get("http://testserver/count").text == "1"
+    assert not app.db.session.registry.has()
+    stats = app.db.pool_stats.as_dict()
+    assert stats["checkouts"] == stats["checkins"] == 1
+    assert stats["wait_time"] >= stats["max_wait"] > 0
+
+    with pytest.raises(ValueError):
+        client.get("http://testserver/boom")
+    assert not app.db.session.registry.has()
+    assert app.db.pool_stats.checkins == 2
+
+    # the workers dispose of the pool inherited from the parent process
+    app.db.engine.dispose()
+    app.db.pool_stats.reset()
+    assert client.get("http://testserver/count").text == "1"
+    stats = app.db.pool_stats.as_dict()
+    assert stats["checkouts"] == 1
+    assert stats["wait_time"] >= stats["max_wait"] > 0
+
+
+def test_middleware_process_exception_over_asgi(app):
+    class Recover(Middleware):
+        async def process_exception(self, req, exc):
+            return Response(f"recovered from {exc}", status=500)
+
+    app.add_middleware(Recover)
+
+    @app.route("/boom")
+    async def boom(req, resp):
+        raise ValueError("boom")
+
+    status, headers, body = asyncio.run(_asgi_request(app, path="/boom"))
+    assert status == 500
+    assert body == b"recovered from boom"
+
+
+def test_database_records_queries_per_request(app, client, caplog):
+    app.config["DATABASE_URI"] = "sqlite://"
+    app.config["DATABASE_REPEATED_QUERY_THRESHOLD"] = 3
+    app.db.init_db()
+
+    @app.route("/one")
+    def one(req, resp):
+        req.db_session.execute(select(literal(1)))
+        resp.text = "one"
+
+    @app.route("/loop")
+    def loop(req, resp):
+        for i in range(5):
+            req.db_session.execute(select(literal(i)))
+        resp.text = "loop"
+
+    response = client.get("http://testserver/one")
+    assert "X-DB-Queries" not in response.headers
+
+    app.config["DEBUG"] = True
+    response = client.get("http://testserver/one")
+    assert response.headers["X-DB-Queries"].startswith("count=1, time=")
+    assert response.headers["X-DB-Queries"].endswith("duplicates=0")
+    assert not caplog.records
+
+    with caplog.at_level("WARNING", logger="spatz.database"):
+        response = client.get("http://testserver/loop")
+    assert response.headers["X-DB-Queries"].endswith("duplicates=4")
+    assert "possible N+1 query" in caplog.text
+
+    stats = app.db.query_stats.as_dict()
+    assert stats["one"]["requests"] == 2
+    assert stats["one"]["queries"] == 2
+    assert stats["loop"]["max_queries"] == 5
+    assert stats["loop"]["duplicates"] == 4
+    assert stats["loop"]["time"] > 0
+
+
+def test_database_middleware_debug_on_http_exceptions(app, client):
+    app.config["DATABASE_URI"] = "sqlite://"
+    app.config["DEBUG"] = True
+    app.db.init_db()
+
+    @app.route("/only-get")
+    def only_get(req, resp):
+        resp.text = "get"
+
+    assert client.get("http://testserver/missing").status_code == 404
+    assert client.post("http://testserver/only-get").status_code == 405
+
+
+def test_database_middleware_ends_recovered_requests_once(app, client):
+    app.config["DATABASE_URI"] = "sqlite://"
+    app.db.init_db()
+
+    class RecoveringMiddleware(Middleware):
+        def process_exception(self, req, exc):
+            res = Response(status=500)
+            res.text = "recovered"
+            return res
+
+    app.add_middleware(RecoveringMiddleware)
+
+    @app.route("/boom")
+    def boom(req, resp):
+        req.db_session.execute(select(literal(1)))
+        raise ValueError("boom")
+
+    response = client.get("http://testserver/boom")
+    assert response.status_code == 500
+    assert response.text == "recovered"
+
+    stats = app.db.query_stats.as_dict()
+    assert stats["boom"]["requests"] == 1
+    assert stats["boom"]["queries"] == 1
+
+
+def test_timing_records_phases(app, client):
+    app.config["TIMING_HEADER"] = True
+    app.add_middleware(SessionMiddleware)
+    app.timing.init_timing()
+    seen = []
+    app.timing.add_listener(lambda req, res, timings: seen.append(timings))
+
+    @app.route("/page")
+    def page(req, resp):
+        req.session["visited"] = True
+        resp.html = resp.render("index.html", {"title": "Timed", "name": "spatz"})
+
+    @app.route("/api")
+    def api(req, resp):
+        resp.json = {"name": "spatz"}
+
+    response = client.get("http://testserver/page")
+    phases = [name for name, duration in seen[0].phases]
+    assert phases == [
+        "SessionMiddleware.request",
+        "route",
+        "render",
+        "handler",
+        "session-save",
+        "SessionMiddleware.response",
+    ]
+    header = response.headers["Server-Timing"]
+    assert header.startswith("SessionMiddleware.request;dur=")
+    assert "total;dur=" in header
+
+    client.get("http://testserver/api")
+    assert "serialize" in [name for name, duration in seen[1].phases]
+
+    for _ in range(3):
+        client.get("http://testserver/api")
+    stats = app.timing.as_dict()
+    assert stats["page"]["count"] == 1
+    assert stats["api"]["count"] == 4
+    assert 0 < stats["api"]["p50"] <= stats["api"]["p95"] <= stats["api"]["p99"]
+
+
+def test_timing_header_only_in_debug_by_default(app, client):
+    app.timing.init_timing()
+
+    @app.route("/api")
+    def api(req, resp):
+        resp.json = {"name": "spatz"}
+
+    assert "Server-Timing" not in client.get("http://testserver/api").headers
+    app.config["DEBUG"] = True
+    assert "total;dur=" in client.get("http://testserver/api").headers["Server-Timing"]
+
+
+def test_timing_profiles_slow_requests(app, client, tmp_path):
+    app.config["TIMING_HEADER"] = False
+    app.config["TIMING_PROFILE_RATE"] = 1.0
+    app.config["TIMING_PROFILE_THRESHOLD"] = 0.1
+    app.config["TIMING_PROFILE_DIR"] = str(tmp_path)
+    app.timing.init_timing()
+
+    @app.route("/fast")
+    def fast(req, resp):
+        resp.text = "fast"
+
+    @app.route("/slow")
+    def slow(req, resp):
+        time.sleep(0.2)
+        resp.text = "slow"
+
+    response = client.get("http://testserver/fast")
+    assert "Server-Timing" not in response.headers
+    assert list(tmp_path.iterdir()) == []
+
+    client.get("http://testserver/slow")
+    (profile,) = tmp_path.iterdir()
+    assert profile.name.startswith("slow-")
+    assert profile.suffix == ".prof"
+
+
+def test_timing_over_asgi(app):
+    app.config["TIMING_HEADER"] = True
+    app.timing.init_timing()
+
+    @app.route("/async")
+    async def handler(req, resp):
+        resp.json = {"async": True}
+
+    status, headers, body = asyncio.run(_asgi_request(app, path="/async"))
+    assert b"handler;dur=" in headers[b"server-timing"]
+    assert b"serialize;dur=" in headers[b"server-timing"]
+
+
+def test_metrics_endpoint(app, client):
+    app.metrics.init_metrics()
+
+    @app.route("/items")
+    def items(req, resp):
+        resp.json = {"items": [1, 2, 3]}
+
+    @app.route("/boom")
+    def boom(req, resp):
+        raise ValueError("boom")
+
+    client.get("http://testserver/items")
+    client.get("http://testserver/items")
+    client.get("http://testserver/missing")
+    with pytest.raises(ValueError):
+        client.get("http://testserver/boom")
+
+    response = client.get("http://testserver/metrics")
+    assert response.headers["Content-Type"] == "text/plain; version=0.0.4; charset=utf-8"
+    lines = response.text.splitlines()
+    assert "# TYPE spatz_requests_total counter" in lines
+    assert 'spatz_requests_total{endpoint="items",method="GET",status="200"} 2' in lines
+    assert 'spatz_requests_total{endpoint="none",method="GET",status="404"} 1' in lines
+    assert 'spatz_requests_total{endpoint="boom",method="GET",status="500"} 1' in lines
+    assert 'spatz_request_duration_seconds_bucket{endpoint="items",le="+Inf"} 2' in lines
+    assert 'spatz_request_duration_seconds_count{endpoint="items"} 2' in lines
+    assert any(line.startswith('spatz_request_duration_seconds_bucket{endpoint="items",le="0.005"} ') for line in lines)
+    assert 'spatz_response_size_bytes_bucket{endpoint="items",le="100.0"} 2' in lines
+    assert 'spatz_response_size_bytes_bucket{endpoint="items",le="1000.0"} 2' in lines
+    assert 'spatz_response_size_bytes_sum{endpoint="items"} ' + str(2 * len(json.dumps({"items": [1, 2, 3]}))) in lines
+    # the request serving the metrics is in flight
+    assert "spatz_requests_in_flight 1" in lines
+
+
+def test_metrics_count_recovered_requests_once(app, client):
+    app.metrics.init_metrics()
+
+    class RecoveringMiddleware(Middleware):
+        def process_exception(self, req, exc):
+            res = Response(status=500)
+            res.text = "recovered"
+            return res
+
+    app.add_middleware(RecoveringMiddleware)
+
+    @app.route("/boom")
+    def boom(req, resp):
+        raise ValueError("boom")
+
+    assert client.get("http://testserver/boom").text == "recovered"
+
+    lines = app.metrics.render().splitlines()
+    assert 'spatz_requests_total{endpoint="boom",method="GET",status="500"} 1' in lines
+    assert 'spatz_request_duration_seconds_count{endpoint="boom"} 1' in lines
+    assert "spatz_requests_in_flight 0" in lines
+
+
+def test_metrics_are_shared_by_processes(app, client, tmp_path):
+    app.config["METRICS_DIR"] = str(tmp_path)
+    app.metrics.init_metrics()
+
+    @app.route("/items")
+    def items(req, resp):
+        resp.text = "items"
+
+    client.get("http://testserver/items")
+
+    # another worker process writing in the same directory
+    other = MmapValues(str(tmp_path / "counter_999999.db"))
+    for _ in range(300):
+        other.inc('["spatz_requests_total", {"endpoint": "items", "method": "GET", "status": "200"}]', 1)
+    other.inc('["spatz_requests_total", {"endpoint": "' + "x" * 70000 + '", "method": "GET", "status": "200"}]', 1)
+    gauges = MmapValues(str(tmp_path / "gauge_999999.db"))
+    gauges.inc('["spatz_requests_in_flight", {}]', 3)
+
+    lines = client.get("http://testserver/metrics").text.splitlines()
+    assert 'spatz_requests_total{endpoint="items",method="GET",status="200"} 301' in lines
+    assert "spatz_requests_in_flight 4" in lines
+
+    app.metrics.mark_process_dead(999999)
+    lines = client.get("http://testserver/metrics").text.splitlines()
+    assert "spatz_requests_in_flight 1" in lines
+
+
+def test_benchmark_suite_saves_and_compares(tmp_path, capsys):
+    output = tmp_path / "results.json"
+    assert benchmark.main(["routing", "-n", "5", "-r", "2", "-o", str(output)]) == 0
+
+    results = json.loads(output.read_text())
+    assert set(results["results"]) == {"routing.static", "routing.parameterized", "routing.class_handler"}
+    assert results["results"]["routing.static"]["min"] > 0
+
+    assert benchmark.main(["routing.static", "-n", "5", "-r", "2", "-c", str(output), "-t", "100"]) == 0
+
+    slower = json.loads(output.read_text())
+    slower["results"]["routing.static"]["min"] *= 2
+    assert benchmark.compare(slower, results, threshold=0.5) == [
+        ("routing.static", results["results"]["routing.static"]["min"], slower["results"]["routing.static"]["min"], 2.0)
+    ]
+    assert benchmark.compare(slower, results, threshold=1.5) == []
+
+
+@pytest.mark.parametrize("name", list(benchmark.BENCHMARKS))
+def test_benchmark_apps_respond(name):
+    app, environ = benchmark.BENCHMARKS[name]()
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = status
+
+    b"".join(app(dict(environ), start_response))
+    assert started["status"] == "200 OK"
+
+
+def test_request_too_large_is_rejected_before_reading(app, client):
+    app.config["MAX_CONTENT_LENGTH"] = 1000
+    calls = []
+
+    @app.route("/upload", methods=["POST"])
+    def upload(req, resp):
+        calls.append(1)
+        resp.text = str(len(req.get_data()))
+
+    assert client.post("http://testserver/upload", data=b"x" * 1000).text == "1000"
+
+    response = client.post("http://testserver/upload", data=b"x" * 1001)
+    assert response.status_code == 413
+    assert calls == [1]
+
+
+def test_request_body_streaming_helpers(app, client, tmp_path):
+    body = os.urandom(200 * 1024)
+
+    @app.route("/save", methods=["POST"])
+    def save(req, resp):
+        hasher = hashlib.md5()
+        size = req.save_body(tmp_path / "upload.bin", hasher=hasher)
+        resp.json = {"size": size, "md5": hasher.hexdigest()}
+
+    @app.route("/hash", methods=["POST"])
+    def hash_body(req, resp):
+        resp.text = req.hash_body()
+
+    @app.route("/chunks", methods=["POST"])
+    def chunks(req, resp):
+        resp.json = [len(chunk) for chunk in req.iter_body(chunk_size=100 * 1024)]
+
+    assert client.post("http://testserver/save", data=body).json() == {
+        "size": len(body),
+        "md5": hashlib.md5(body).hexdigest(),
+    }
+    assert (tmp_path / "upload.bin").read_bytes() == body
+    assert client.post("http://testserver/hash", data=body).text == hashlib.sha256(body).hexdigest()
+    assert client.post("http://testserver/chunks", data=body).json() == [102400, 102400]
+
+
+def test_streamed_request_over_limit(app):
+    app.config["MAX_CONTENT_LENGTH"] = 1000
+
+    @app.route("/upload", methods=["POST"])
+    def upload(req, resp):
+        resp.text = str(sum(len(chunk) for chunk in req.iter_body(chunk_size=100)))
+
+    def post(size):
+        environ = EnvironBuilder(path="/upload", method="POST", input_stream=io.BytesIO(b"x" * size)).get_environ()
+        environ.pop("CONTENT_LENGTH", None)
+        environ["wsgi.input_terminated"] = True
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = status
+
+        body = b"".join(app(environ, start_response))
+        return started["status"], body
+
+    assert post(1000) == ("200 OK", b"1000")
+    assert post(1001)[0] == "413 REQUEST ENTITY TOO LARGE"
+
+
+def test_form_memory_limit(app, client):
+    app.config["MAX_FORM_MEMORY_SIZE"] = 100
+
+    @app.route("/form", methods=["POST"])
+    def form(req, resp):
+        resp.text = req.form["name"]
+
+    files = {"name": (None, "spatz")}
+    assert client.post("http://testserver/form", files=files).text == "spatz"
+
+    files = {"name": (None, "x" * 200)}
+    assert client.post("http://testserver/form", files=files).status_code == 413
+
+
+def test_asgi_request_too_large(app):
+    app.config["MAX_CONTENT_LENGTH"] = 10
+
+    @app.route("/upload", methods=["POST"])
+    async def upload(req, resp):
+        resp.text = req.get_data(as_text=True)
+
+    status, headers, body = asyncio.run(
+        _asgi_request(app, "POST", "/upload", b"x" * 11, [(b"content-length", b"11")])
+    )
+    assert status == 413
+
+    status, headers, body = asyncio.run(_asgi_request(app, "POST", "/upload", b"x" * 11))
+    assert status == 413
+
+    status, headers, body = asyncio.run(_asgi_request(app, "POST", "/upload", b"x" * 10))
+    assert (status, body) == (200, b"x" * 10)
+
+
+# the cumulative import time of spatz, in microseconds
+IMPORT_TIME_BUDGET = 500000
+
+
+def test_import_time_budget():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import spatz"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imported = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        imported[name.strip()] = int(cumulative)
+
+    for module in ("sqlalchemy", "jinja2", "whitenoise", "requests", "wsgiadapter", "parse"):
+        assert module not in imported, f"{module} is imported by import spatz"
+    assert imported["spatz"] < IMPORT_TIME_BUDGET
+
+
+def test_optional_subsystems_load_on_first_use(tmp_path):
+    app = Spatz(static_dir=str(tmp_path))
+    assert app._db is None and app._whitenoise is None and app._templates_env is None
+
+    assert app.db.Model is Model
+    assert app.whitenoise is app.whitenoise
+    assert app.templates_env is app.templates_env
+
+
+def test_frozen_app_rejects_routes(app):
+    @app.route("/home")
+    def home(req, resp):
+        resp.text = "home"
+
+    app.warmup()
+    assert app.frozen
+
+    with pytest.raises(AssertionError):
+        app.add_route("/other", home, endpoint="other")
+    with pytest.raises(AssertionError):
+        app.add_routes([("/other", home, "other")])
+    with pytest.raises(AssertionError):
+        app.add_middleware(Middleware)
+    with pytest.raises(TypeError):
+        app.handlers["other"] = home
+    with pytest.raises(TypeError):
+        app.dispatch_table["home"]["POST"] = home
+    assert app.test_session().get("http://testserver/home").text == "home"
+
+
+def test_request_context(app, client):
+    def user_name():
+        return current_request.args.get("name", "anonymous")
+
+    @app.route("/hello")
+    def hello(req, resp):
+        assert has_request() and get_request() is req
+        resp.text = f"hello {user_name()}"
+
+    assert client.get("http://testserver/hello?name=spatz").text == "hello spatz"
+    assert client.get("http://testserver/hello").text == "hello anonymous"
+
+    assert not has_request()
+    with pytest.raises(RuntimeError):
+        get_request()
+
+
+def _call(app, path, headers=None):
+    environ = EnvironBuilder(path=path, headers=headers).get_environ()
+    status = []
+    body = app(environ, lambda s, h, exc_info=None: status.append(s))
+    try:
+        return status[0], b"".join(body).decode()
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
+def test_streamed_body_keeps_the_request_and_its_db_session(app, tmp_path):
+    app.config["DATABASE_URI"] = f"sqlite:///{tmp_path / 'stream.sqlite'}"
+
+    class StreamedNote(Model):
+        __tablename__ = "streamed_notes"
+        id = Column(Integer, primary_key=True)
+        text = Column(String(20))
+
+    app.db.init_db()
+    app.db.session.add_all([StreamedNote(text="a"), StreamedNote(text="b")])
+    app.db.session.commit()
+    app.db.session.remove()
+    seen = []
+
+    def notes(req, resp):
+        handler_session = req.db_session()
+
+        def chunks():
+            seen.append((get_request() is req, app.db.session() is handler_session))
+            for note in StreamedNote.query.order_by(StreamedNote.id):
+                yield f"{note.text}\n"
+
+        resp.stream = chunks()
+
+    async def notes_async(req, resp):
+        notes(req, resp)
+
+    app.add_route("/notes", notes)
+    app.add_route("/async-notes", notes_async)
+
+    body = app(EnvironBuilder(path="/notes").get_environ(), lambda s, h, exc_info=None: None)
+    assert b"".join(body) == b"a\nb\n"
+    assert seen == [(True, True)]
+    # the session lives until the server closes the body
+    assert app.db.session.registry.registry
+    body.close()
+    assert not app.db.session.registry.registry
+    assert not has_request()
+
+    # a SQLite connection is used by the thread which opened it only
+    app.config["ASGI_THREAD_POOL_SIZE"] = 1
+    for path in ("/notes", "/async-notes"):
+        assert asyncio.run(_asgi_request(app, path=path))[2] == b"a\nb\n"
+        assert seen[-1] == (True, True)
+        assert not app.db.session.registry.registry
+
+
+def test_threaded_requests_do_not_leak(app, tmp_path):
+    app.config["DATABASE_URI"] = f"sqlite:///{tmp_path / 'threads.sqlite'}"
+    app.db.init_db()
+    app.add_middleware(SessionMiddleware)
+    sessions = set()
+    lock = threading.Lock()
+
+    @app.route("/items/<int:item_id>")
+    def item(req, resp, item_id):
+        db_session = req.db_session()
+        req.session["item_id"] = item_id
+        with lock:
+            assert id(db_session) not in sessions
+            sessions.add(id(db_session))
+        time.sleep(0.001)
+        # the state seen after a switch to the other threads is still ours
+        assert get_request() is req
+        assert app.db.session() is db_session
+        assert db_session.execute(select(literal(item_id))).scalar() == item_id
+        with lock:
+            sessions.remove(id(db_session))
+        resp.text = f"{current_request.path} {req.session['item_id']}"
+
+    app.warmup()
+    with ThreadPoolExecutor(16) as executor:
+        results = list(executor.map(lambda i: _call(app, f"/items/{i}"), range(400)))
+
+    assert results == [("200 OK", f"/items/{i} {i}") for i in range(400)]
+    assert not sessions
+    assert not app.db.session.registry.registry
+
+
+def test_threaded_io_bound_handlers_scale(app):
+    @app.route("/slow")
+    def slow(req, resp):
+        time.sleep(0.05)
+        resp.text = "done"
+
+    app.warmup()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda i: _call(app, "/slow"), range(16)))
+    elapsed = time.perf_counter() - start
+
+    assert results == [("200 OK", "done")] * 16
+    # 0.8s in a single thread
+    assert elapsed < 0.4
+
+
+def test_background_tasks_run_after_the_response(app):
+    events = []
+
+    def task(name, suffix=""):
+        events.append((name + suffix, has_request()))
+
+    @app.route("/")
+    def index(req, resp):
+        resp.background(task, "sync", suffix="!")
+        resp.text = "sent"
+        events.append(("handler", True))
+
+    @app.route("/async")
+    async def index_async(req, resp):
+        resp.background(task, "async")
+        resp.text = "sent"
+
+    body = app(EnvironBuilder(path="/").get_environ(), lambda s, h, exc_info=None: None)
+    assert b"".join(body) == b"sent"
+    app.background.shutdown()
+    assert events == [("handler", True)]
+
+    # queued once the server closes the body
+    body.close()
+    app.background.shutdown()
+    assert events == [("handler", True), ("sync!", False)]
+
+    assert asyncio.run(_asgi_request(app, path="/async"))[2] == b"sent"
+    app.background.shutdown()
+    assert events[-1] == ("async", False)
+
+
+def test_background_tasks_get_their_own_db_session(app, tmp_path):
+    app.config["DATABASE_URI"] = f"sqlite:///{tmp_path / 'background.sqlite'}"
+
+    class AuditEntry(Model):
+        __tablename__ = "audit_entries"
+        id = Column(Integer, primary_key=True)
+        path = Column(String(100))
+
+    app.db.init_db()
+    sessions = []
+
+    def audit(path):
+        session = app.db.session()
+        sessions.append(session)
+        session.add(AuditEntry(path=path))
+        session.commit()
+
+    @app.route("/audited")
+    def audited(req, resp):
+        sessions.append(req.db_session())
+        resp.background(audit, req.path)
+        resp.text = "ok"
+
+    assert _call(app, "/audited") == ("200 OK", "ok")
+    app.background.shutdown()
+
+    assert sessions[0] is not sessions[1]
+    assert [entry.path for entry in app.db.session().query(AuditEntry)] == ["/audited"]
+    app.db.session.remove()
+    assert not app.db.session.registry.registry
+
+
+def test_background_queue_backpressure_and_metrics(app, caplog):
+    app.config["BACKGROUND_WORKERS"] = 1
+    app.config["BACKGROUND_QUEUE_SIZE"] = 1
+    app.config["BACKGROUND_QUEUE_TIMEOUT"] = 0.05
+    release = threading.Event()
+    threads = []
+
+    def blocking():
+        release.wait(5)
+
+    def record():
+        threads.append(threading.current_thread())
+
+    def failing():
+        raise ValueError("failed")
+
+    assert app.background.submit(blocking) is not None
+    assert app.background.pending == 1
+    # the queue is full, so the task runs in this thread after the timeout
+    assert app.background.submit(record) is None
+    assert threads == [threading.current_thread()]
+
+    release.set()
+    app.background.submit(failing)
+    app.background.shutdown()
+    assert app.background.pending == 0
+    assert "Background task" in caplog.text
+
+    text = app.metrics.render()
+    assert 'spatz_background_tasks_total{status="done"} 2' in text
+    assert 'spatz_background_tasks_total{status="failed"} 1' in text
+    assert "spatz_background_tasks_queued 0" in text
+    assert 'spatz_background_task_latency_seconds_count 3' in text
+
+
+def test_background_queue_waits_without_timeout(app):
+    app.config["BACKGROUND_WORKERS"] = 1
+    app.config["BACKGROUND_QUEUE_SIZE"] = 1
+    app.config["BACKGROUND_QUEUE_TIMEOUT"] = None
+    release = threading.Event()
+    futures = []
+
+    app.background.submit(release.wait, 5)
+    waiting = threading.Thread(target=lambda: futures.append(app.background.submit(len, "")))
+    waiting.start()
+    waiting.join(0.1)
+    # no timeout: the task waits for room instead of running in the request thread
+    assert waiting.is_alive() and futures == []
+
+    release.set()
+    waiting.join(5)
+    assert futures[0] is not None and futures[0].result(5) == 0
+    app.background.shutdown()
+
+
+def test_asgi_queues_background_tasks_off_the_event_loop(app):
+    threads = []
+    submit_all = app.background.submit_all
+
+    def record_submit_all(tasks):
+        threads.append(threading.current_thread())
+        submit_all(tasks)
+
+    app.background.submit_all = record_submit_all
+
+    @app.route("/async")
+    async def index_async(req, resp):
+        resp.background(len, "")
+        resp.text = "sent"
+
+    @app.route("/sync")
+    def index_sync(req, resp):
+        resp.background(len, "")
+        resp.text = "sent"
+
+    assert asyncio.run(_asgi_request(app, path="/async"))[2] == b"sent"
+    assert asyncio.run(_asgi_request(app, path="/sync"))[2] == b"sent"
+    app.background.shutdown()
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="the prefork server needs fork()")
+def test_prefork_server(tmp_path):
+    module = tmp_path / "served_app.py"
+    module.write_text(
+        "import os\n"
+        "from spatz import Spatz\n"
+        "app = Spatz()\n"
+        "@app.route('/')\n"
+        "def index(req, resp):\n"
+        "    resp.text = f'v1 {os.getpid()}'\n"
+    )
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "spatz.cli", "serve", "served_app:app", "--port", "0", "-w", "1", "--max-requests", "2"],
+        cwd=str(tmp_path),
+        env=env,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        line = ""
+        while "Listening on" not in line:
+            line = server.stderr.readline()
+            assert line, "the server did not start"
+        url = next(word for word in line.split() if word.startswith("http://"))
+
+        def get():
+            with urllib.request.urlopen(url, timeout=5) as response:
+                return response.read().decode().split()
+
+        responses = [get() for _ in range(3)]
+        assert [version for version, pid in responses] == ["v1"] * 3
+        # the worker is replaced after two requests
+        assert responses[0][1] == responses[1][1] != responses[2][1]
+
+        # a different size, so that the cached bytecode is not reused
+        module.write_text(module.read_text().replace("v1", "reloaded"))
+        server.send_signal(signal.SIGHUP)
+        deadline = time.monotonic() + 5
+        while get()[0] != "reloaded":
+            assert time.monotonic() < deadline, "the server did not reload"
+            time.sleep(0.1)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=10) == 0